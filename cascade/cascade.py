@@ -31,6 +31,8 @@ import base64
 import datetime
 import enum
 import hashlib
+import hmac
+import http.server
 import json
 import logging
 import logging.handlers
@@ -42,11 +44,16 @@ except ImportError:
     pass
 import queue
 import random
+import shutil
+import socket
+import socketserver
 import subprocess
 import sys
 import threading
 import time
-from typing import Tuple
+from typing import List, Tuple
+import urllib.error
+import urllib.request
 # non-stdlib imports
 import azure.common
 import azure.cosmosdb.table as azuretable
@@ -79,7 +86,25 @@ _DOCKER_AUTH_MAP = None
 _DOCKER_AUTH_MAP_LOCK = threading.Lock()
 _DIRECTDL_LOCK = threading.Lock()
 _CONCURRENT_DOWNLOADS_ALLOWED = 10
+_CONCURRENT_PULLS_PER_NODE = int(
+    os.getenv('SHIPYARD_CONCURRENT_PULLS_PER_NODE', default='4'))
 _RECORD_PERF = int(os.getenv('SHIPYARD_TIMING', default='0'))
+_PERF_RECORDER = None
+_P2P_PORT = None
+_P2P_UPLOAD_SEMAPHORE = None
+_P2P_SEED_TIME = 0
+_P2P_PEER_TIMEOUT = 30
+_P2P_HEARTBEAT_INTERVAL = 60
+_P2P_PEER_EXPIRY = 180
+_P2P_TOKEN_HEADER = 'X-Shipyard-P2P-Token'
+_P2P_COPY_BUFSIZE = 4194304
+_P2P_PEERS_PK_SUFFIX = '$p2p'
+_IMAGE_CACHE_CONNECTIONS = int(
+    os.getenv('SHIPYARD_IMAGE_CACHE_CONNECTIONS', default='0'))
+_IMAGE_CACHE_PK_SUFFIX = '$cache'
+_IMAGE_CACHE_BLOB_PREFIX = 'cache/'
+_IMAGE_CACHE_HASH_BUFSIZE = 4194304
+_IMAGE_CACHE_CLAIM_TTL = 300
 # mutable global state
 _CBHANDLES = {}
 _BLOB_LEASES = {}
@@ -90,7 +115,14 @@ _STORAGE_CONTAINERS = {
 }
 _DIRECTDL_QUEUE = queue.Queue()
 _DIRECTDL_KEY_FINGERPRINT_DICT = dict()
+_DIRECTDL_PRIORITY = dict()
 _DIRECTDL_DOWNLOADING = set()
+_P2P_ADDRESS = None
+_P2P_TOKEN = None
+_P2P_SERVING = {}
+_P2P_FAILED_PEERS = {}
+_P2P_STOP = threading.Event()
+_IMAGE_CACHE_FAILED = set()
 _GR_LOCK = threading.Lock()
 _GR_DONE = False
 _GR_COUNT = 0
@@ -194,22 +226,18 @@ def _create_credentials() -> tuple:
     return blob_client, table_client
 
 
-async def _record_perf_async(
-        loop: asyncio.BaseEventLoop, event: str, message: str) -> None:
-    """Record timing metric async
-    :param asyncio.BaseEventLoop loop: event loop
-    :param str event: event
-    :param str message: message
+def _setup_perf_recorder(table_client: azuretable.TableService) -> None:
+    """Set up the in-process perf recorder
+    :param azuretable.TableService table_client: table client
     """
+    global _PERF_RECORDER
     if not _RECORD_PERF:
         return
-    proc = await asyncio.create_subprocess_shell(
-        './perf.py cascade {ev} --prefix {pr} --message "{msg}"'.format(
-            ev=event, pr=_PREFIX, msg=message), loop=loop)
-    await proc.wait()
-    if proc.returncode != 0:
-        logger.error(
-            'could not record perf to storage for event: {}'.format(event))
+    # perf.py is only present on the node if timing metrics are enabled
+    import perf
+    _PERF_RECORDER = perf.PerfRecorder(
+        table_client, _PREFIX + 'perf', 'cascade')
+    _PERF_RECORDER.start()
 
 
 def _record_perf(event: str, message: str) -> None:
@@ -217,11 +245,9 @@ def _record_perf(event: str, message: str) -> None:
     :param str event: event
     :param str message: message
     """
-    if not _RECORD_PERF:
+    if _PERF_RECORDER is None:
         return
-    subprocess.check_call(
-        './perf.py cascade {ev} --prefix {pr} --message "{msg}"'.format(
-            ev=event, pr=_PREFIX, msg=message), shell=True)
+    _PERF_RECORDER.record(event, message)
 
 
 def _renew_blob_lease(
@@ -356,22 +382,385 @@ def singularity_image_name_to_key_file_name(name: str) -> str:
     return key_file_name
 
 
+def _setup_peer_to_peer() -> None:
+    """Set up peer-to-peer distribution settings from the environment"""
+    global _P2P_PORT, _P2P_UPLOAD_SEMAPHORE, _P2P_SEED_TIME, _P2P_TOKEN
+    port = os.environ.get('SHIPYARD_P2P_PORT')
+    if port is None or len(port) == 0:
+        logger.info('peer-to-peer distribution disabled')
+        return
+    # singularity mode cascade serves on the next port to avoid
+    # colliding with the docker mode cascade on the same node
+    _P2P_PORT = int(port)
+    if _CONTAINER_MODE == ContainerMode.SINGULARITY:
+        _P2P_PORT += 1
+    _P2P_UPLOAD_SEMAPHORE = threading.BoundedSemaphore(int(os.environ.get(
+        'SHIPYARD_P2P_CONCURRENT_UPLOADS', default='4')))
+    _P2P_SEED_TIME = int(os.environ.get(
+        'SHIPYARD_P2P_SEED_TIME', default='0'))
+    # peers authenticate with a token derived from the pool partition key
+    # keyed by the storage account key shared by all nodes in the pool
+    sakey = os.environ['SHIPYARD_STORAGE_ENV'].split(':')[2]
+    _P2P_TOKEN = hmac.new(
+        sakey.encode('utf8'), _PARTITION_KEY.encode('utf8'),
+        hashlib.sha256).hexdigest()
+    logger.info(
+        'peer-to-peer distribution enabled on port {} seed time {}s'.format(
+            _P2P_PORT, _P2P_SEED_TIME))
+
+
+def _get_node_ip_address() -> str:
+    """Get the internal IP address of this node
+    :rtype: str
+    :return: ip address
+    """
+    # no packets are sent for a connect on a datagram socket, the local
+    # address is the one routable to the azure platform endpoint
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.connect(('168.63.129.16', 80))
+        return sock.getsockname()[0]
+    except OSError:
+        return socket.gethostbyname(socket.gethostname())
+    finally:
+        sock.close()
+
+
+class _ThreadingHTTPServer(
+        socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """Threaded HTTP server (http.server.ThreadingHTTPServer is 3.7+)"""
+    daemon_threads = True
+
+
+class PeerRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serve loaded container images to other nodes in the pool"""
+    def log_message(self, format: str, *args) -> None:
+        """Redirect request logging to logger"""
+        logger.debug('peer request from {}: {}'.format(
+            self.address_string(), format % args))
+
+    def do_GET(self) -> None:
+        """Handle GET request for a resource hash"""
+        if not hmac.compare_digest(
+                self.headers.get(_P2P_TOKEN_HEADER, ''), _P2P_TOKEN):
+            self.send_error(403)
+            return
+        resource = _P2P_SERVING.get(self.path.strip('/'))
+        if resource is None:
+            self.send_error(404)
+            return
+        if not _P2P_UPLOAD_SEMAPHORE.acquire(blocking=False):
+            self.send_error(503)
+            return
+        try:
+            grtype, image = get_container_image_name_from_resource(resource)
+            _record_perf(
+                'peer-upload-start', 'grtype={},img={},peer={}'.format(
+                    grtype, image, self.client_address[0]))
+            if grtype == 'docker':
+                self._serve_docker_image(image)
+            else:
+                self._serve_singularity_image(image)
+            _record_perf(
+                'peer-upload-end', 'grtype={},img={},peer={}'.format(
+                    grtype, image, self.client_address[0]))
+        except (BrokenPipeError, ConnectionResetError) as e:
+            logger.error('peer {} disconnected during transfer of {}: '
+                         '{}'.format(self.client_address[0], resource, e))
+        finally:
+            _P2P_UPLOAD_SEMAPHORE.release()
+
+    def _serve_docker_image(self, image: str) -> None:
+        """Stream a docker image as saved tarball
+        :param str image: image to serve
+        """
+        proc = subprocess.Popen(
+            ['docker', 'save', image], stdout=subprocess.PIPE)
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-tar')
+            self.end_headers()
+            shutil.copyfileobj(proc.stdout, self.wfile, _P2P_COPY_BUFSIZE)
+        finally:
+            proc.stdout.close()
+            if proc.wait() != 0:
+                logger.error('docker save of {} failed with rc={}'.format(
+                    image, proc.returncode))
+
+    def _serve_singularity_image(self, image: str) -> None:
+        """Stream a singularity image file
+        :param str image: image to serve
+        """
+        imgpath = singularity_image_path_on_disk(image)
+        with imgpath.open('rb') as f:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header(
+                'Content-Length', str(os.fstat(f.fileno()).st_size))
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile, _P2P_COPY_BUFSIZE)
+
+
+def _start_peer_server() -> http.server.HTTPServer:
+    """Start the peer server in a background thread
+    :rtype: http.server.HTTPServer
+    :return: peer server or None if unable to start
+    """
+    global _P2P_ADDRESS
+    # only listen on the internal network of the pool
+    ip = _get_node_ip_address()
+    try:
+        server = _ThreadingHTTPServer(
+            (ip, _P2P_PORT), PeerRequestHandler)
+    except OSError as e:
+        # a prior cascade may still be seeding on this port
+        logger.error(
+            'could not start peer server on port {}, images loaded by '
+            'this node will not be served to peers: {}'.format(_P2P_PORT, e))
+        return None
+    _P2P_ADDRESS = '{}:{}'.format(ip, _P2P_PORT)
+    thr = threading.Thread(target=server.serve_forever, daemon=True)
+    thr.start()
+    logger.info('peer server listening on {}'.format(_P2P_ADDRESS))
+    return server
+
+
+def _register_peer(
+        table_client: azuretable.TableService, resource: str) -> None:
+    """Register this node as a peer for a loaded resource
+    :param azuretable.TableService table_client: table client
+    :param str resource: resource
+    """
+    if _P2P_ADDRESS is None:
+        return
+    rhash = compute_resource_hash(resource)
+    _P2P_SERVING[rhash] = resource
+    if _upsert_peer_entity(table_client, rhash, resource):
+        logger.debug('registered as peer for {} at {}'.format(
+            resource, _P2P_ADDRESS))
+
+
+def _upsert_peer_entity(
+        table_client: azuretable.TableService, rhash: str,
+        resource: str) -> bool:
+    """Insert or replace the peer entity of this node for a resource, which
+    also refreshes its timestamp
+    :param azuretable.TableService table_client: table client
+    :param str rhash: resource hash
+    :param str resource: resource
+    :rtype: bool
+    :return: if entity was written
+    """
+    try:
+        table_client.insert_or_replace_entity(
+            _STORAGE_CONTAINERS['table_globalresources'],
+            {
+                'PartitionKey': _PARTITION_KEY + _P2P_PEERS_PK_SUFFIX,
+                'RowKey': '{}${}'.format(rhash, _NODEID),
+                'Resource': resource,
+                'NodeId': _NODEID,
+                'Address': _P2P_ADDRESS,
+            }
+        )
+    except azure.common.AzureException as e:
+        # failure to register only affects other nodes
+        logger.exception(e)
+        return False
+    return True
+
+
+def _peer_heartbeat(table_client: azuretable.TableService) -> None:
+    """Periodically refresh the peer entities of served resources so that
+    entities of nodes which stopped serving without unregistering expire
+    :param azuretable.TableService table_client: table client
+    """
+    while not _P2P_STOP.wait(_P2P_HEARTBEAT_INTERVAL):
+        for rhash, resource in list(_P2P_SERVING.items()):
+            if _P2P_STOP.is_set():
+                break
+            _upsert_peer_entity(table_client, rhash, resource)
+
+
+def _start_peer_heartbeat(table_client: azuretable.TableService) -> None:
+    """Start the peer heartbeat in a background thread
+    :param azuretable.TableService table_client: table client
+    """
+    thr = threading.Thread(
+        target=_peer_heartbeat, args=(table_client,), daemon=True)
+    thr.start()
+
+
+def _unregister_peer(table_client: azuretable.TableService) -> None:
+    """Unregister this node as a peer for all served resources
+    :param azuretable.TableService table_client: table client
+    """
+    _P2P_STOP.set()
+    for rhash in list(_P2P_SERVING.keys()):
+        _P2P_SERVING.pop(rhash)
+        try:
+            table_client.delete_entity(
+                _STORAGE_CONTAINERS['table_globalresources'],
+                _PARTITION_KEY + _P2P_PEERS_PK_SUFFIX,
+                '{}${}'.format(rhash, _NODEID))
+        except azure.common.AzureMissingResourceHttpError:
+            pass
+
+
+def _get_peers(
+        table_client: azuretable.TableService, resource: str) -> List[str]:
+    """Get peers which have a resource loaded, excluding peers which have
+    not refreshed their entity recently and peers which failed to serve
+    the resource to this node
+    :param azuretable.TableService table_client: table client
+    :param str resource: resource
+    :rtype: list
+    :return: shuffled list of peer addresses
+    """
+    rhash = compute_resource_hash(resource)
+    expiry = (
+        datetime.datetime.utcnow() -
+        datetime.timedelta(seconds=_P2P_PEER_EXPIRY)
+    ).strftime('%Y-%m-%dT%H:%M:%SZ')
+    failed = _P2P_FAILED_PEERS.get(resource, set())
+    # '%' sorts immediately after '$' to bound the row key range
+    try:
+        entities = table_client.query_entities(
+            _STORAGE_CONTAINERS['table_globalresources'],
+            filter=(
+                'PartitionKey eq \'{}\' and RowKey ge \'{}$\' and '
+                'RowKey lt \'{}%\' and Timestamp ge datetime\'{}\''
+            ).format(
+                _PARTITION_KEY + _P2P_PEERS_PK_SUFFIX, rhash, rhash, expiry),
+            select='NodeId,Address')
+        peers = [
+            x['Address'] for x in entities
+            if x['NodeId'] != _NODEID and x['Address'] not in failed
+        ]
+    except azure.common.AzureException as e:
+        logger.exception(e)
+        return []
+    random.shuffle(peers)
+    return peers
+
+
+def _update_resource_size(
+        table_client: azuretable.TableService, resource: str, grtype: str,
+        image: str) -> None:
+    """Record the size of a resource in the global resources table for
+    scheduling priority on nodes which load the resource later
+    :param azuretable.TableService table_client: table client
+    :param str resource: resource
+    :param str grtype: global resource type
+    :param str image: image
+    """
+    if _DIRECTDL_PRIORITY.get(resource, {}).get('size', 0) > 0:
+        return
+    try:
+        if grtype == 'docker':
+            size = int(subprocess.check_output(
+                ['docker', 'image', 'inspect', '-f', '{{.Size}}', image]))
+        else:
+            size = singularity_image_path_on_disk(image).stat().st_size
+        table_client.merge_entity(
+            _STORAGE_CONTAINERS['table_globalresources'],
+            {
+                'PartitionKey': _PARTITION_KEY,
+                'RowKey': compute_resource_hash(resource),
+                'Size': size,
+            }
+        )
+    except (subprocess.CalledProcessError, ValueError, OSError,
+            azure.common.AzureException) as e:
+        logger.exception(e)
+
+
+def _compute_file_digest(path: pathlib.Path) -> str:
+    """Compute the content digest of a file
+    :param pathlib.Path path: file path
+    :rtype: str
+    :return: digest in algorithm:hex form
+    """
+    hasher = hashlib.sha256()
+    with path.open('rb') as f:
+        while True:
+            buf = f.read(_IMAGE_CACHE_HASH_BUFSIZE)
+            if not buf:
+                break
+            hasher.update(buf)
+    return 'sha256:{}'.format(hasher.hexdigest())
+
+
+def _get_docker_image_id(image: str) -> str:
+    """Get the content addressable id of a loaded docker image
+    :param str image: image
+    :rtype: str
+    :return: image id in algorithm:hex form
+    """
+    return subprocess.check_output(
+        ['docker', 'image', 'inspect', '-f', '{{.Id}}', image],
+        universal_newlines=True).strip()
+
+
+def _image_cache_blob_name(digest: str) -> str:
+    """Get the image cache blob name for a digest
+    :param str digest: digest
+    :rtype: str
+    :return: blob name
+    """
+    return '{}{}'.format(_IMAGE_CACHE_BLOB_PREFIX, digest.replace(':', '-'))
+
+
+def _get_cached_image(
+        table_client: azuretable.TableService, resource: str) -> dict:
+    """Get the image cache entry for a resource
+    :param azuretable.TableService table_client: table client
+    :param str resource: resource
+    :rtype: dict
+    :return: image cache entity or None if not cached
+    """
+    if _IMAGE_CACHE_CONNECTIONS == 0 or resource in _IMAGE_CACHE_FAILED:
+        return None
+    try:
+        entity = table_client.get_entity(
+            _STORAGE_CONTAINERS['table_globalresources'],
+            _PARTITION_KEY + _IMAGE_CACHE_PK_SUFFIX,
+            compute_resource_hash(resource))
+    except azure.common.AzureMissingResourceHttpError:
+        return None
+    except azure.common.AzureException as e:
+        logger.exception(e)
+        return None
+    # entity exists without being ready while the cache is populated
+    if not entity.get('Ready', False):
+        return None
+    return entity
+
+
 class ContainerImageSaveThread(threading.Thread):
     """Container Image Save Thread"""
     def __init__(
             self, blob_client: azureblob.BlockBlobService,
-            resource: str, blob_name: str, nglobalresources: int):
+            table_client: azuretable.TableService,
+            resource: str, blob_name: str, nglobalresources: int,
+            peers: List[str], cached: dict):
         """ContainerImageSaveThread ctor
         :param azureblob.BlockBlobService blob_client: blob client
+        :param azuretable.TableService table_client: table client
         :param str resource: resource
-        :param str blob_name: resource blob name
+        :param str blob_name: resource blob name, None if loading from peers
+            or the image cache
         :param int nglobalresources: number of global resources
+        :param list peers: peers to load from
+        :param dict cached: image cache entity to load from
         """
         threading.Thread.__init__(self)
         self.blob_client = blob_client
+        self.table_client = table_client
         self.resource = resource
         self.blob_name = blob_name
         self.nglobalresources = nglobalresources
+        self.peers = peers
+        self.cached = cached
         # add to downloading set
         with _DIRECTDL_LOCK:
             _DIRECTDL_DOWNLOADING.add(self.resource)
@@ -384,28 +773,33 @@ class ContainerImageSaveThread(threading.Thread):
             logger.exception(ex)
             _THREAD_EXCEPTIONS.append(ex)
         finally:
-            # cancel callback
-            try:
-                _CBHANDLES[self.resource].cancel()
-            except KeyError as e:
-                logger.exception(e)
-            _CBHANDLES.pop(self.resource)
-            # release blob lease
-            try:
-                self.blob_client.release_blob_lease(
-                    container_name=_STORAGE_CONTAINERS['blob_globalresources'],
-                    blob_name=self.blob_name,
-                    lease_id=_BLOB_LEASES[self.resource],
-                )
-            except azure.common.AzureException as e:
-                logger.exception(e)
-            _BLOB_LEASES.pop(self.resource)
-            logger.debug(
-                'blob lease released for {}'.format(self.resource))
+            if self.blob_name is not None:
+                self._release_blob_lease()
             # remove from downloading set
             with _DIRECTDL_LOCK:
                 _DIRECTDL_DOWNLOADING.remove(self.resource)
 
+    def _release_blob_lease(self) -> None:
+        """Cancel lease renewal and release the blob lease"""
+        # cancel callback
+        try:
+            _CBHANDLES[self.resource].cancel()
+        except KeyError as e:
+            logger.exception(e)
+        _CBHANDLES.pop(self.resource, None)
+        # release blob lease
+        try:
+            self.blob_client.release_blob_lease(
+                container_name=_STORAGE_CONTAINERS['blob_globalresources'],
+                blob_name=self.blob_name,
+                lease_id=_BLOB_LEASES[self.resource],
+            )
+        except (KeyError, azure.common.AzureException) as e:
+            logger.exception(e)
+        _BLOB_LEASES.pop(self.resource, None)
+        logger.debug(
+            'blob lease released for {}'.format(self.resource))
+
     def _check_pull_output_overload(self, stderr: str) -> bool:
         """Check output for registry overload errors
         :param str stderr: stderr
@@ -444,6 +838,32 @@ class ContainerImageSaveThread(threading.Thread):
         username, _, password = auth.partition(':')
         return username, password
 
+    def _get_singularity_key_cmd(self, image: str) -> str:
+        """Get singularity command to import or pull the signing key
+        :param str image: signed image
+        :rtype: str
+        :return: key import and fingerprint check or key pull command
+        """
+        key_file_path = pathlib.Path(
+            singularity_image_name_to_key_file_name(image))
+        key_fingerprint = _DIRECTDL_KEY_FINGERPRINT_DICT[image]
+        if key_file_path.is_file():
+            key_import_cmd = 'singularity key import {}'.format(
+                key_file_path)
+            fingerprint_check_cmd = (
+                'key_fingerprint=$({} | '.format(key_import_cmd) +
+                'grep -o "fingerprint \\(\\S*\\)" | ' +
+                'grep -o "\\S*$" | sed -e "s/\\(.*\\)/\\U\\1/"); ' +
+                'if [ ${key_fingerprint} != ' +
+                '"{}" ]; '.format(key_fingerprint.upper()) +
+                'then (>&2 echo "aborting: fingerprint of ' +
+                'key file $key_fingerprint does not match ' +
+                'fingerprint provided {}")'.format(key_fingerprint) +
+                ' && exit 1; fi')
+            return '{} && {}'.format(key_import_cmd, fingerprint_check_cmd)
+        else:
+            return 'singularity key pull {}'.format(key_fingerprint)
+
     def _get_singularity_pull_cmd(self, image: str) -> str:
         """Get singularity pull command
         :param str image: image to pull
@@ -468,26 +888,11 @@ class ContainerImageSaveThread(threading.Thread):
                 'singularity pull -F ' + credentials_command_argument +
                 '{} {}'.format(image_out_path, image)
             )
-            key_fingerprint = _DIRECTDL_KEY_FINGERPRINT_DICT[image]
+            key_cmd = self._get_singularity_key_cmd(image)
             if key_file_path.is_file():
-                key_import_cmd = 'singularity key import {}'.format(
-                    key_file_path)
-                fingerprint_check_cmd = (
-                    'key_fingerprint=$({} | '.format(key_import_cmd) +
-                    'grep -o "fingerprint \\(\\S*\\)" | ' +
-                    'grep -o "\\S*$" | sed -e "s/\\(.*\\)/\\U\\1/"); ' +
-                    'if [ ${key_fingerprint} != ' +
-                    '"{}" ]; '.format(key_fingerprint.upper()) +
-                    'then (>&2 echo "aborting: fingerprint of ' +
-                    'key file $key_fingerprint does not match ' +
-                    'fingerprint provided {}")'.format(key_fingerprint) +
-                    ' && exit 1; fi')
-                cmd = '{} && {} && {}'.format(
-                    key_import_cmd, fingerprint_check_cmd,
-                    singularity_pull_cmd)
+                cmd = '{} && {}'.format(key_cmd, singularity_pull_cmd)
             else:
-                cmd = '{} && singularity key pull {}'.format(
-                    singularity_pull_cmd, key_fingerprint)
+                cmd = '{} && {}'.format(singularity_pull_cmd, key_cmd)
             # always verify image separately
             cmd = '{} && singularity verify {}'.format(cmd, image_out_path)
         else:
@@ -518,9 +923,377 @@ class ContainerImageSaveThread(threading.Thread):
         stdout, stderr = proc.communicate()
         return proc.returncode, stdout, stderr
 
+    def _docker_load_from_peer(self, response) -> None:
+        """Load a docker image streamed from a peer
+        :param http.client.HTTPResponse response: peer response
+        """
+        proc = subprocess.Popen(
+            ['docker', 'load'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True)
+        try:
+            shutil.copyfileobj(response, proc.stdin, _P2P_COPY_BUFSIZE)
+        except Exception:
+            proc.kill()
+            proc.communicate()
+            raise
+        stdout, stderr = proc.communicate()
+        if proc.returncode != 0:
+            raise RuntimeError(
+                'docker load failed: stdout={} stderr={}'.format(
+                    stdout, stderr))
+        logger.debug(stdout)
+
+    def _singularity_load_from_peer(self, response, image: str) -> None:
+        """Save a singularity image streamed from a peer
+        :param http.client.HTTPResponse response: peer response
+        :param str image: image
+        """
+        imgpath = singularity_image_path_on_disk(image)
+        tmppath = imgpath.with_name('.{}.p2p'.format(imgpath.name))
+        try:
+            with tmppath.open('wb') as f:
+                shutil.copyfileobj(response, f, _P2P_COPY_BUFSIZE)
+            length = response.getheader('Content-Length')
+            if (length is not None and
+                    int(length) != tmppath.stat().st_size):
+                raise RuntimeError(
+                    'incomplete transfer for {}: {} of {} bytes'.format(
+                        image, tmppath.stat().st_size, length))
+            if image in _DIRECTDL_KEY_FINGERPRINT_DICT:
+                subprocess.check_call(
+                    '{} && singularity verify {}'.format(
+                        self._get_singularity_key_cmd(image), tmppath),
+                    shell=True)
+            os.replace(str(tmppath), str(imgpath))
+        finally:
+            if tmppath.exists():
+                tmppath.unlink()
+
+    def _load_from_peers(self, grtype: str, image: str) -> bool:
+        """Load a container image from peers
+        :param str grtype: global resource type
+        :param str image: image to load
+        :rtype: bool
+        :return: if image was loaded from a peer
+        """
+        rhash = compute_resource_hash(self.resource)
+        for peer in self.peers:
+            _record_perf('load-start', 'grtype={},img={},peer={}'.format(
+                grtype, image, peer))
+            start = datetime.datetime.now()
+            logger.info('loading {} image {} from peer {}'.format(
+                grtype, image, peer))
+            request = urllib.request.Request(
+                'http://{}/{}'.format(peer, rhash),
+                headers={_P2P_TOKEN_HEADER: _P2P_TOKEN})
+            try:
+                with urllib.request.urlopen(
+                        request, timeout=_P2P_PEER_TIMEOUT) as response:
+                    if grtype == 'docker':
+                        self._docker_load_from_peer(response)
+                    else:
+                        self._singularity_load_from_peer(response, image)
+            except urllib.error.HTTPError as e:
+                # peer is busy or no longer has the image
+                logger.debug('peer {} unavailable for {}: {}'.format(
+                    peer, image, e.code))
+                _P2P_FAILED_PEERS.setdefault(self.resource, set()).add(peer)
+                continue
+            except (OSError, RuntimeError,
+                    subprocess.CalledProcessError) as e:
+                logger.error('failed to load {} from peer {}: {}'.format(
+                    image, peer, e))
+                _P2P_FAILED_PEERS.setdefault(self.resource, set()).add(peer)
+                continue
+            diff = (datetime.datetime.now() - start).total_seconds()
+            logger.debug('took {} sec to load {} image {} from peer'.format(
+                diff, grtype, image))
+            _record_perf('load-end', 'grtype={},img={},diff={}'.format(
+                grtype, image, diff))
+            return True
+        return False
+
     def _pull_and_save(self) -> None:
         """Thread main logic for pulling and saving a container image"""
         grtype, image = get_container_image_name_from_resource(self.resource)
+        if self.blob_name is not None:
+            self._pull_from_registry(grtype, image)
+            _update_resource_size(
+                self.table_client, self.resource, grtype, image)
+        elif self.cached is not None:
+            if not self._load_from_cache(grtype, image):
+                # do not consult the cache again for this resource
+                _IMAGE_CACHE_FAILED.add(self.resource)
+                _DIRECTDL_QUEUE.put(self.resource)
+                return
+        else:
+            # without a blob lease, the image can only come from peers,
+            # failed peers are not consulted again for this resource so
+            # the next attempt falls back to the image cache or source
+            if not self._load_from_peers(grtype, image):
+                logger.debug(
+                    'could not load {} from any peer, requeuing'.format(
+                        self.resource))
+                _DIRECTDL_QUEUE.put(self.resource)
+                return
+        # global resource accounting
+        _inc_resource_count(self.nglobalresources)
+        # serve image to other nodes
+        if _P2P_PORT is not None:
+            _register_peer(self.table_client, self.resource)
+        # populate image cache after the first pull from the registry
+        if self.blob_name is not None and _IMAGE_CACHE_CONNECTIONS > 0:
+            self._populate_image_cache(grtype, image)
+
+    def _get_image_cache_temp_path(
+            self, grtype: str, image: str) -> pathlib.Path:
+        """Get a temporary path for an image cache transfer
+        :param str grtype: global resource type
+        :param str image: image
+        :rtype: pathlib.Path
+        :return: temporary path
+        """
+        if grtype == 'docker':
+            return pathlib.Path(
+                os.environ['AZ_BATCH_TASK_WORKING_DIR'],
+                '.{}.cache'.format(compute_resource_hash(self.resource)))
+        imgpath = singularity_image_path_on_disk(image)
+        return imgpath.with_name('.{}.cache'.format(imgpath.name))
+
+    def _load_from_cache(self, grtype: str, image: str) -> bool:
+        """Load a container image from the image cache
+        :param str grtype: global resource type
+        :param str image: image to load
+        :rtype: bool
+        :return: if image was loaded from the image cache
+        """
+        digest = self.cached['Digest']
+        blob_name = self.cached['Blob']
+        _record_perf('cache-load-start', 'grtype={},img={},digest={}'.format(
+            grtype, image, digest))
+        start = datetime.datetime.now()
+        logger.info('loading {} image {} from image cache blob {}'.format(
+            grtype, image, blob_name))
+        tmppath = self._get_image_cache_temp_path(grtype, image)
+        try:
+            tmppath.parent.mkdir(parents=True, exist_ok=True)
+            self.blob_client.get_blob_to_path(
+                container_name=_STORAGE_CONTAINERS['blob_globalresources'],
+                blob_name=blob_name,
+                file_path=str(tmppath),
+                max_connections=_IMAGE_CACHE_CONNECTIONS,
+            )
+            if grtype == 'docker':
+                logger.debug(subprocess.check_output(
+                    ['docker', 'load', '-i', str(tmppath)],
+                    universal_newlines=True))
+                loaded = _get_docker_image_id(image)
+            else:
+                loaded = _compute_file_digest(tmppath)
+            if loaded != digest:
+                raise RuntimeError(
+                    'digest mismatch for {}: expected {} got {}'.format(
+                        image, digest, loaded))
+            if grtype == 'singularity':
+                if image in _DIRECTDL_KEY_FINGERPRINT_DICT:
+                    subprocess.check_call(
+                        '{} && singularity verify {}'.format(
+                            self._get_singularity_key_cmd(image), tmppath),
+                        shell=True)
+                os.replace(
+                    str(tmppath), str(singularity_image_path_on_disk(image)))
+        except (OSError, RuntimeError, subprocess.CalledProcessError,
+                azure.common.AzureException) as e:
+            logger.error('failed to load {} from image cache: {}'.format(
+                image, e))
+            return False
+        finally:
+            if tmppath.exists():
+                tmppath.unlink()
+        diff = (datetime.datetime.now() - start).total_seconds()
+        logger.debug('took {} sec to load {} image {} from image cache'.format(
+            diff, grtype, image))
+        _record_perf('cache-load-end', 'grtype={},img={},diff={}'.format(
+            grtype, image, diff))
+        return True
+
+    def _populate_image_cache(self, grtype: str, image: str) -> None:
+        """Export a container image pulled from its registry to the
+        image cache
+        :param str grtype: global resource type
+        :param str image: image to export
+        """
+        # docker save does not retain digest references
+        if grtype == 'docker' and '@' in image:
+            logger.debug(
+                'not caching image {} referenced by digest'.format(image))
+            return
+        table_name = _STORAGE_CONTAINERS['table_globalresources']
+        pk = _PARTITION_KEY + _IMAGE_CACHE_PK_SUFFIX
+        rhash = compute_resource_hash(self.resource)
+        if not self._claim_image_cache(table_name, pk, rhash):
+            return
+        # the event loop renewing the source blob lease stops once all
+        # global resources are loaded, so renew the lease along with the
+        # claim from a thread while the cache is populated
+        stop = threading.Event()
+        keeper = threading.Thread(
+            target=self._keep_image_cache_claim,
+            args=(stop, table_name, pk, rhash), daemon=True)
+        keeper.start()
+        _record_perf('cache-save-start', 'grtype={},img={}'.format(
+            grtype, image))
+        start = datetime.datetime.now()
+        tmppath = None
+        try:
+            if grtype == 'docker':
+                digest = _get_docker_image_id(image)
+            else:
+                path = singularity_image_path_on_disk(image)
+                digest = _compute_file_digest(path)
+            blob_name = _image_cache_blob_name(digest)
+            # images with identical content share a cache blob
+            if not self.blob_client.exists(
+                    _STORAGE_CONTAINERS['blob_globalresources'], blob_name):
+                if grtype == 'docker':
+                    tmppath = self._get_image_cache_temp_path(grtype, image)
+                    subprocess.check_call(
+                        ['docker', 'save', '-o', str(tmppath), image])
+                    path = tmppath
+                logger.info('saving {} image {} to image cache blob {}'.format(
+                    grtype, image, blob_name))
+                self.blob_client.create_blob_from_path(
+                    container_name=_STORAGE_CONTAINERS['blob_globalresources'],
+                    blob_name=blob_name,
+                    file_path=str(path),
+                    max_connections=_IMAGE_CACHE_CONNECTIONS,
+                )
+            self.table_client.merge_entity(
+                table_name,
+                {
+                    'PartitionKey': pk,
+                    'RowKey': rhash,
+                    'Digest': digest,
+                    'Blob': blob_name,
+                    'Ready': True,
+                }
+            )
+        except (OSError, subprocess.CalledProcessError,
+                azure.common.AzureException) as e:
+            logger.exception(e)
+            # release the claim so that another node may populate the cache
+            try:
+                self.table_client.delete_entity(table_name, pk, rhash)
+            except azure.common.AzureException:
+                pass
+            return
+        finally:
+            stop.set()
+            keeper.join()
+            if tmppath is not None and tmppath.exists():
+                tmppath.unlink()
+        diff = (datetime.datetime.now() - start).total_seconds()
+        logger.debug('took {} sec to save {} image {} to image cache'.format(
+            diff, grtype, image))
+        _record_perf('cache-save-end', 'grtype={},img={},diff={}'.format(
+            grtype, image, diff))
+
+    def _claim_image_cache(
+            self, table_name: str, pk: str, rhash: str) -> bool:
+        """Claim population of the image cache entry for this resource.
+        Claims which have not been refreshed within the claim TTL, such as
+        those of nodes which failed while populating the cache, are taken
+        over.
+        :param str table_name: table name
+        :param str pk: partition key
+        :param str rhash: resource hash
+        :rtype: bool
+        :return: if claim was acquired
+        """
+        claim = {
+            'PartitionKey': pk,
+            'RowKey': rhash,
+            'Resource': self.resource,
+            'NodeId': _NODEID,
+            'Ready': False,
+            'ClaimedAt': datetime.datetime.now(datetime.timezone.utc),
+        }
+        try:
+            self.table_client.insert_entity(table_name, claim)
+            return True
+        except azure.common.AzureConflictHttpError:
+            pass
+        except azure.common.AzureException as e:
+            logger.exception(e)
+            return False
+        try:
+            entity = self.table_client.get_entity(table_name, pk, rhash)
+        except azure.common.AzureException as e:
+            logger.exception(e)
+            return False
+        claimed_at = entity.get('ClaimedAt')
+        if (entity.get('Ready', False) or (
+                claimed_at is not None and
+                (claim['ClaimedAt'] - claimed_at).total_seconds() <
+                _IMAGE_CACHE_CLAIM_TTL)):
+            logger.debug('image cache for {} populated by another node'.format(
+                self.resource))
+            return False
+        # only one node may take over an expired claim
+        try:
+            self.table_client.update_entity(
+                table_name, claim, if_match=entity['etag'])
+        except azure.common.AzureException as e:
+            logger.debug(
+                'could not take over image cache claim for {}: {}'.format(
+                    self.resource, e))
+            return False
+        logger.info(
+            'took over expired image cache claim of node {} for {}'.format(
+                entity.get('NodeId'), self.resource))
+        return True
+
+    def _keep_image_cache_claim(
+            self, stop: threading.Event, table_name: str, pk: str,
+            rhash: str) -> None:
+        """Renew the source blob lease and refresh the image cache claim
+        until stopped
+        :param threading.Event stop: stop event
+        :param str table_name: table name
+        :param str pk: partition key
+        :param str rhash: resource hash
+        """
+        while not stop.wait(15):
+            try:
+                lease_id = self.blob_client.renew_blob_lease(
+                    container_name=_STORAGE_CONTAINERS['blob_globalresources'],
+                    blob_name=self.blob_name,
+                    lease_id=_BLOB_LEASES[self.resource],
+                )
+                _BLOB_LEASES[self.resource] = lease_id
+            except (KeyError, azure.common.AzureException) as e:
+                logger.exception(e)
+            try:
+                self.table_client.merge_entity(
+                    table_name,
+                    {
+                        'PartitionKey': pk,
+                        'RowKey': rhash,
+                        'ClaimedAt': datetime.datetime.now(
+                            datetime.timezone.utc),
+                    }
+                )
+            except azure.common.AzureException as e:
+                logger.exception(e)
+
+    def _pull_from_registry(self, grtype: str, image: str) -> None:
+        """Pull a container image from its registry
+        :param str grtype: global resource type
+        :param str image: image to pull
+        """
         _record_perf('pull-start', 'grtype={},img={}'.format(grtype, image))
         start = datetime.datetime.now()
         logger.info('pulling {} image {}'.format(grtype, image))
@@ -551,8 +1324,6 @@ class ContainerImageSaveThread(threading.Thread):
         diff = (datetime.datetime.now() - start).total_seconds()
         logger.debug('took {} sec to pull {} image {}'.format(
             diff, grtype, image))
-        # global resource accounting
-        _inc_resource_count(self.nglobalresources)
         # get image size
         try:
             if grtype == 'docker':
@@ -571,79 +1342,142 @@ class ContainerImageSaveThread(threading.Thread):
                 grtype, image, diff))
 
 
+def _resource_priority(resource: str) -> tuple:
+    """Sort key for scheduling resources: resources referenced by more
+    tasks are scheduled first, then larger resources as they take longer
+    :param str resource: resource
+    :rtype: tuple
+    :return: sort key
+    """
+    prio = _DIRECTDL_PRIORITY.get(resource, {})
+    return (-prio.get('demand', 0), -prio.get('size', 0), resource)
+
+
+def _acquire_source_lease(
+        loop: asyncio.BaseEventLoop,
+        blob_client: azureblob.BlockBlobService, resource: str) -> str:
+    """Acquire one of the source download blob leases for a resource
+    :param asyncio.BaseEventLoop loop: event loop
+    :param azureblob.BlockBlobService blob_client: blob client
+    :param str resource: resource
+    :rtype: str
+    :return: leased blob name or None if no blobs available
+    """
+    lease_id = None
+    blob_name = None
+    for i in range(0, _CONCURRENT_DOWNLOADS_ALLOWED):
+        blob_name = '{}.{}'.format(compute_resource_hash(resource), i)
+        try:
+            lease_id = blob_client.acquire_blob_lease(
+                container_name=_STORAGE_CONTAINERS['blob_globalresources'],
+                blob_name=blob_name,
+                lease_duration=60,
+            )
+            break
+        except azure.common.AzureConflictHttpError:
+            blob_name = None
+            pass
+    if lease_id is None:
+        logger.debug(
+            'no available blobs to lease for resource: {}'.format(
+                resource))
+        return None
+    # create lease renew callback
+    logger.debug('blob lease {} acquired for resource {}'.format(
+        lease_id, resource))
+    _BLOB_LEASES[resource] = lease_id
+    _CBHANDLES[resource] = loop.call_later(
+        15, _renew_blob_lease, loop, blob_client, 'blob_globalresources',
+        resource, blob_name)
+    return blob_name
+
+
+def _start_resource_download(
+        loop: asyncio.BaseEventLoop,
+        blob_client: azureblob.BlockBlobService,
+        table_client: azuretable.TableService,
+        resource: str, nglobalresources: int) -> bool:
+    """Start a download of a resource from peers, the image cache or its
+    source
+    :param asyncio.BaseEventLoop loop: event loop
+    :param azureblob.BlockBlobService blob_client: blob client
+    :param azuretable.TableService table_client: table client
+    :param str resource: resource
+    :param int nglobalresources: number of global resources
+    :rtype: bool
+    :return: if download was started
+    """
+    # prefer loading from peers which already have the resource
+    peers = None
+    blob_name = None
+    if _P2P_PORT is not None:
+        peers = _get_peers(table_client, resource)
+        if len(peers) > 0:
+            logger.debug('{} peers available for resource: {}'.format(
+                len(peers), resource))
+        else:
+            peers = None
+    # then the image cache if it has been populated
+    cached = None
+    if peers is None:
+        cached = _get_cached_image(table_client, resource)
+        if cached is not None:
+            logger.debug('image cache available for resource: {}'.format(
+                resource))
+    # attempt to get a blob lease
+    if peers is None and cached is None:
+        blob_name = _acquire_source_lease(loop, blob_client, resource)
+        if blob_name is None:
+            return False
+    # pull and save container image in thread
+    if is_container_resource(resource):
+        thr = ContainerImageSaveThread(
+            blob_client, table_client, resource, blob_name,
+            nglobalresources, peers, cached)
+        thr.start()
+    else:
+        # TODO download via blob, explode uri to get container/blob
+        # use download to path into /tmp and move to directory
+        raise NotImplementedError()
+    return True
+
+
 async def _direct_download_resources_async(
         loop: asyncio.BaseEventLoop,
         blob_client: azureblob.BlockBlobService,
+        table_client: azuretable.TableService,
         nglobalresources: int) -> None:
     """Direct download resource logic
     :param asyncio.BaseEventLoop loop: event loop
     :param azureblob.BlockBlobService blob_client: blob client
+    :param azuretable.TableService table_client: table client
     :param int nglobalresources: number of global resources
     """
     # ensure we are not downloading too many sources at once
     with _DIRECTDL_LOCK:
-        if len(_DIRECTDL_DOWNLOADING) > _CONCURRENT_DOWNLOADS_ALLOWED:
-            return
-    # retrieve a resource from dl queue
-    _seen = set()
+        slots = _CONCURRENT_PULLS_PER_NODE - len(_DIRECTDL_DOWNLOADING)
+    if slots <= 0:
+        return
+    # drain the dl queue and fill all available slots in priority order
+    pending = []
     while True:
         try:
-            resource = _DIRECTDL_QUEUE.get()
+            resource = _DIRECTDL_QUEUE.get_nowait()
         except queue.Empty:
             break
-        else:
-            if resource in _seen:
-                _DIRECTDL_QUEUE.put(resource)
-                resource = None
-                break
-            _seen.add(resource)
+        if resource not in pending:
+            pending.append(resource)
+    pending.sort(key=_resource_priority)
+    for resource in pending:
         with _DIRECTDL_LOCK:
-            if resource not in _DIRECTDL_DOWNLOADING:
-                break
-            else:
-                _DIRECTDL_QUEUE.put(resource)
-                resource = None
-    del _seen
-    # attempt to get a blob lease
-    if resource is not None:
-        lease_id = None
-        blob_name = None
-        for i in range(0, _CONCURRENT_DOWNLOADS_ALLOWED):
-            blob_name = '{}.{}'.format(compute_resource_hash(resource), i)
-            try:
-                lease_id = blob_client.acquire_blob_lease(
-                    container_name=_STORAGE_CONTAINERS['blob_globalresources'],
-                    blob_name=blob_name,
-                    lease_duration=60,
-                )
-                break
-            except azure.common.AzureConflictHttpError:
-                blob_name = None
-                pass
-        if lease_id is None:
-            logger.debug(
-                'no available blobs to lease for resource: {}'.format(
-                    resource))
+            downloading = resource in _DIRECTDL_DOWNLOADING
+        if (slots > 0 and not downloading and
+                _start_resource_download(
+                    loop, blob_client, table_client, resource,
+                    nglobalresources)):
+            slots -= 1
+        else:
             _DIRECTDL_QUEUE.put(resource)
-            return
-        # create lease renew callback
-        logger.debug('blob lease {} acquired for resource {}'.format(
-            lease_id, resource))
-        _BLOB_LEASES[resource] = lease_id
-        _CBHANDLES[resource] = loop.call_later(
-            15, _renew_blob_lease, loop, blob_client, 'blob_globalresources',
-            resource, blob_name)
-    if resource is None:
-        return
-    # pull and save container image in thread
-    if is_container_resource(resource):
-        thr = ContainerImageSaveThread(
-            blob_client, resource, blob_name, nglobalresources)
-        thr.start()
-    else:
-        # TODO download via blob, explode uri to get container/blob
-        # use download to path into /tmp and move to directory
-        raise NotImplementedError()
 
 
 def _inc_resource_count(nglobalresources: int) -> None:
@@ -669,17 +1503,19 @@ def _inc_resource_count(nglobalresources: int) -> None:
 async def download_monitor_async(
         loop: asyncio.BaseEventLoop,
         blob_client: azureblob.BlockBlobService,
+        table_client: azuretable.TableService,
         nglobalresources: int) -> None:
     """Download monitor
     :param asyncio.BaseEventLoop loop: event loop
     :param azureblob.BlockBlobService blob_client: blob client
+    :param azuretable.TableService table_client: table client
     :param int nglobalresource: number of global resources
     """
     while not _GR_DONE:
         # check if there are any direct downloads
         if _DIRECTDL_QUEUE.qsize() > 0:
             await _direct_download_resources_async(
-                loop, blob_client, nglobalresources)
+                loop, blob_client, table_client, nglobalresources)
         # check for any thread exceptions
         if len(_THREAD_EXCEPTIONS) > 0:
             logger.critical('Thread exceptions encountered, terminating')
@@ -724,11 +1560,13 @@ async def download_monitor_async(
 def distribute_global_resources(
         loop: asyncio.BaseEventLoop,
         blob_client: azureblob.BlockBlobService,
-        table_client: azuretable.TableService) -> None:
+        table_client: azuretable.TableService) -> int:
     """Distribute global services/resources
     :param asyncio.BaseEventLoop loop: event loop
     :param azureblob.BlockBlobService blob_client: blob client
     :param azuretable.TableService table_client: table client
+    :rtype: int
+    :return: number of global resources distributed
     """
     # get globalresources from table
     try:
@@ -743,6 +1581,10 @@ def distribute_global_resources(
         grtype, image = get_container_image_name_from_resource(resource)
         if grtype == _CONTAINER_MODE.name.lower():
             nentities += 1
+            _DIRECTDL_PRIORITY[resource] = {
+                'demand': ent.get('Demand', 0),
+                'size': ent.get('Size', 0),
+            }
             _DIRECTDL_QUEUE.put(resource)
             key_fingerprint = ent.get('KeyFingerprint', None)
             if key_fingerprint is not None:
@@ -753,12 +1595,37 @@ def distribute_global_resources(
                 'mode "{}"'.format(resource, _CONTAINER_MODE.name.lower()))
     if nentities == 0:
         logger.info('no global resources specified')
-        return
+        return nentities
     logger.info('{} global resources matching container mode "{}"'.format(
         nentities, _CONTAINER_MODE.name.lower()))
     # run async func in loop
     loop.run_until_complete(download_monitor_async(
-        loop, blob_client, nentities))
+        loop, blob_client, table_client, nentities))
+    return nentities
+
+
+def seed_global_resources(
+        table_client: azuretable.TableService,
+        server: http.server.HTTPServer) -> None:
+    """Continue serving loaded global resources to peers
+    :param azuretable.TableService table_client: table client
+    :param http.server.HTTPServer server: peer server
+    """
+    # signal that all global resources are loaded as the process continues
+    # to run while seeding
+    pathlib.Path(
+        os.environ['AZ_BATCH_TASK_WORKING_DIR'],
+        '.cascade_{}_loaded'.format(_CONTAINER_MODE.name.lower())
+    ).touch()
+    logger.info('seeding global resources to peers for {} sec'.format(
+        _P2P_SEED_TIME))
+    try:
+        time.sleep(_P2P_SEED_TIME)
+    finally:
+        _unregister_peer(table_client)
+        server.shutdown()
+        server.server_close()
+    logger.info('peer server stopped')
 
 
 def main():
@@ -783,6 +1650,15 @@ def main():
                          .format(args.concurrent))
     logger.info('max concurrent downloads: {}'.format(
         _CONCURRENT_DOWNLOADS_ALLOWED))
+    if _CONCURRENT_PULLS_PER_NODE <= 0:
+        raise ValueError('concurrent pulls per node is invalid: {}'.format(
+            _CONCURRENT_PULLS_PER_NODE))
+    logger.info('max concurrent pulls per node: {}'.format(
+        _CONCURRENT_PULLS_PER_NODE))
+    if _IMAGE_CACHE_CONNECTIONS > 0:
+        logger.info(
+            'image cache enabled with {} concurrent block downloads'.format(
+                _IMAGE_CACHE_CONNECTIONS))
 
     # get event loop
     if _ON_WINDOWS:
@@ -807,11 +1683,35 @@ def main():
     _setup_storage_names(args.prefix)
     del args
 
+    # set up peer-to-peer distribution
+    _setup_peer_to_peer()
+    server = None
+    if _P2P_PORT is not None:
+        server = _start_peer_server()
+
     # create storage credentials
     blob_client, table_client = _create_credentials()
+    if server is not None:
+        _start_peer_heartbeat(table_client)
+
+    # set up perf recording
+    _setup_perf_recorder(table_client)
 
-    # distribute global resources
-    distribute_global_resources(loop, blob_client, table_client)
+    try:
+        # distribute global resources
+        nentities = distribute_global_resources(
+            loop, blob_client, table_client)
+
+        # seed global resources to peers
+        if server is not None:
+            if nentities > 0:
+                seed_global_resources(table_client, server)
+            else:
+                server.shutdown()
+                server.server_close()
+    finally:
+        if _PERF_RECORDER is not None:
+            _PERF_RECORDER.stop()
 
 
 def parseargs():
@@ -22,20 +22,20 @@ if [[ -n ${SHIPYARD_TIMING+x} ]]; then
     if [ "$is_start_task" -eq 1 ]; then
         # backfill node prep start
         # shellcheck disable=SC2086
-        python3 perf.py nodeprep start --prefix "$prefix" --ts "$npstart" --message "offer=$offer,sku=$sku"
+        python3 perf.py nodeprep start --prefix "$prefix" --spool --ts "$npstart" --message "offer=$offer,sku=$sku"
         # backfill docker run pull start
         # shellcheck disable=SC2086
-        python3 perf.py shipyard pull-start --prefix "$prefix" --ts "$drpstart"
+        python3 perf.py shipyard pull-start --prefix "$prefix" --spool --ts "$drpstart"
         # mark docker run pull end
         # shellcheck disable=SC2086
-        python3 perf.py shipyard pull-end --prefix "$prefix" --ts "$drpend"
+        python3 perf.py shipyard pull-end --prefix "$prefix" --spool --ts "$drpend"
         # mark node prep finished
         # shellcheck disable=SC2086
-        python3 perf.py nodeprep end --prefix "$prefix" --ts "$npend"
+        python3 perf.py nodeprep end --prefix "$prefix" --spool --ts "$npend"
     fi
     # mark cascade start time
     # shellcheck disable=SC2086
-    python3 perf.py cascade start --prefix "$prefix" --message "mode=$cascade_mode"
+    python3 perf.py cascade start --prefix "$prefix" --spool --message "mode=$cascade_mode"
 fi
 
 # execute cascade
@@ -26,8 +26,18 @@
 
 # stdlib imports
 import argparse
+import contextlib
 import datetime
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+import glob
+import json
+import logging
 import os
+import threading
+import uuid
 # non-stdlib imports
 import azure.common
 import azure.cosmosdb.table as azuretable
@@ -37,6 +47,11 @@ _BATCHACCOUNT = os.environ['AZ_BATCH_ACCOUNT_NAME']
 _POOLID = os.environ['AZ_BATCH_POOL_ID']
 _NODEID = os.environ['AZ_BATCH_NODE_ID']
 _PARTITION_KEY = '{}${}'.format(_BATCHACCOUNT, _POOLID)
+_SPOOL_FILE = os.path.join(
+    os.environ.get('AZ_BATCH_TASK_WORKING_DIR', default='.'), '.perf_spool')
+_MAX_BATCH_ENTITIES = 100
+_DEFAULT_FLUSH_INTERVAL = 5
+logger = logging.getLogger(__name__)
 
 
 def _create_credentials() -> azuretable.TableService:
@@ -64,13 +79,7 @@ def process_event(
     :param float ts: time stamp
     :param str message: message
     """
-    entity = {
-        'PartitionKey': _PARTITION_KEY,
-        'RowKey': str(ts),
-        'Event': '{}:{}'.format(source, event),
-        'NodeId': _NODEID,
-        'Message': message,
-    }
+    entity = _create_entity(source, event, ts, message)
     while True:
         try:
             table_client.insert_entity(table_name, entity)
@@ -82,6 +91,196 @@ def process_event(
             entity['RowKey'] = str(ts)
 
 
+def _create_entity(
+        source: str, event: str, ts: float, message: str) -> dict:
+    """Create a perf event entity
+    :param str source: source
+    :param str event: event
+    :param float ts: time stamp
+    :param str message: message
+    :rtype: dict
+    :return: entity
+    """
+    return {
+        'PartitionKey': _PARTITION_KEY,
+        'RowKey': str(ts),
+        'Event': '{}:{}'.format(source, event),
+        'NodeId': _NODEID,
+        'Message': message,
+    }
+
+
+@contextlib.contextmanager
+def _spool_lock(spool: str):
+    """Hold an exclusive lock on a spool so that events are never appended
+    to a spool after it has been claimed by a recorder
+    :param str spool: spool file
+    """
+    if fcntl is None:
+        yield
+        return
+    fd = os.open(spool + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def spool_event(
+        spool: str, source: str, event: str, ts: float,
+        message: str) -> None:
+    """Append an event to a local spool file to be flushed by a recorder
+    :param str spool: spool file
+    :param str source: source
+    :param str event: event
+    :param float ts: time stamp
+    :param str message: message
+    """
+    line = json.dumps({
+        'source': source,
+        'event': event,
+        'ts': float(ts),
+        'message': message,
+    })
+    with _spool_lock(spool):
+        fd = os.open(spool, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (line + '\n').encode('utf8'))
+        finally:
+            os.close(fd)
+
+
+class PerfRecorder:
+    """Buffers perf events in-process and flushes them to the perf table
+    in batch transactions on an interval and on stop"""
+    def __init__(
+            self, table_client: azuretable.TableService, table_name: str,
+            source: str, spool: str = _SPOOL_FILE,
+            flush_interval: float = _DEFAULT_FLUSH_INTERVAL):
+        """PerfRecorder ctor
+        :param azure.cosmosdb.table.TableService table_client: table client
+        :param str table_name: table name
+        :param str source: default event source
+        :param str spool: spool file to ingest events from
+        :param float flush_interval: seconds between flushes
+        """
+        self.table_client = table_client
+        self.table_name = table_name
+        self.source = source.lower()
+        self.spool = spool
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._entities = []
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def record(
+            self, event: str, message: str = None, ts: float = None,
+            source: str = None) -> None:
+        """Buffer an event
+        :param str event: event
+        :param str message: message
+        :param float ts: time stamp
+        :param str source: source, defaults to recorder source
+        """
+        if ts is None:
+            ts = datetime.datetime.utcnow().timestamp()
+        entity = _create_entity(
+            (source or self.source).lower(), event.lower(), ts, message)
+        with self._lock:
+            self._entities.append(entity)
+
+    def _ingest_spool(self) -> None:
+        """Move events from the spool file into the buffer"""
+        if self.spool is None:
+            return
+        # multiple recorders may share a spool, claims are made under the
+        # spool lock which also excludes writers, and claims left behind
+        # by a recorder which exited before ingesting are picked up
+        with _spool_lock(self.spool):
+            if os.path.exists(self.spool):
+                try:
+                    os.replace(self.spool, '{}.{}.claimed'.format(
+                        self.spool, uuid.uuid4().hex))
+                except OSError as e:
+                    logger.error('could not claim perf spool {}: {}'.format(
+                        self.spool, e))
+            for claimed in glob.glob(glob.escape(self.spool) + '.*.claimed'):
+                with open(claimed) as f:
+                    for line in f:
+                        try:
+                            ev = json.loads(line)
+                            self.record(
+                                ev['event'], ev['message'], ev['ts'],
+                                ev['source'])
+                        except (ValueError, KeyError) as e:
+                            logger.error(
+                                'invalid perf spool entry {}: {}'.format(
+                                    line, e))
+                os.remove(claimed)
+
+    def flush(self) -> None:
+        """Flush buffered and spooled events to the perf table"""
+        with self._flush_lock:
+            self._ingest_spool()
+            with self._lock:
+                entities = self._entities
+                self._entities = []
+            # ensure unique row keys within the flush
+            rowkeys = set()
+            for entity in entities:
+                ts = float(entity['RowKey'])
+                while entity['RowKey'] in rowkeys:
+                    ts += 0.000001
+                    entity['RowKey'] = str(ts)
+                rowkeys.add(entity['RowKey'])
+            for i in range(0, len(entities), _MAX_BATCH_ENTITIES):
+                self._commit(entities[i:i + _MAX_BATCH_ENTITIES])
+
+    def _commit(self, entities: list) -> None:
+        """Commit entities as a batch, falling back to single inserts
+        :param list entities: entities with the same partition key
+        """
+        bet = azuretable.TableBatch()
+        for entity in entities:
+            bet.insert_entity(entity)
+        try:
+            self.table_client.commit_batch(self.table_name, bet)
+            return
+        except (azure.common.AzureConflictHttpError,
+                azuretable.AzureBatchOperationError) as e:
+            logger.debug('perf batch commit failed, retrying singly: '
+                         '{}'.format(e))
+        for entity in entities:
+            source, event = entity['Event'].split(':', 1)
+            process_event(
+                self.table_client, self.table_name, source, event,
+                entity['RowKey'], entity['Message'])
+
+    def _run(self) -> None:
+        """Periodic flush thread"""
+        while not self._stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception(e)
+
+    def start(self) -> None:
+        """Start periodic flushing"""
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop periodic flushing and flush remaining events"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+
 def main():
     """Main function"""
     # get command-line args
@@ -91,6 +290,12 @@ def main():
     args.source = args.source.lower()
     args.event = args.event.lower()
 
+    # defer to an in-process recorder if spooling
+    if args.spool:
+        spool_event(
+            _SPOOL_FILE, args.source, args.event, args.ts, args.message)
+        return
+
     # set up container name
     table_name = args.prefix + 'perf'
     # create storage credentials
@@ -113,6 +318,9 @@ def parseargs():
     parser.add_argument('--ts', help='timestamp (posix)')
     parser.add_argument('--message', help='message')
     parser.add_argument('--prefix', help='storage container prefix')
+    parser.add_argument(
+        '--spool', action='store_true',
+        help='append event to local spool for an in-process recorder')
     return parser.parse_args()
 
 
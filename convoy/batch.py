@@ -5981,10 +5981,10 @@ def generate_info_metadata_for_federation_message(
         info['task_map'] = task_map
     if has_merge_task:
         info[kind]['constraints']['task']['merge_task_id'] = merge_task_id
-    # pickle json and upload
+    # encode and upload
     loc = 'messages/{}.pickle'.format(unique_id)
-    sas_url = storage.pickle_and_upload(
-        blob_client, info, loc, federation_id=federation_id)
+    sas_url = storage.encode_and_upload_federation_payload(
+        blob_client, info, loc, federation_id)
     # construct queue message
     info = {
         'version': '1',
@@ -83,9 +83,10 @@ def _create_virtual_machine_extension(
     ssel = settings.other_storage_account_settings(config, 'federation')
     rg = settings.credentials_storage(config, ssel).resource_group
     # construct bootstrap command
-    cmd = './{bsf}{a}{log}{p}{r}{s}{v}'.format(
+    cmd = './{bsf}{a}{c}{log}{p}{r}{s}{v}{x}'.format(
         bsf=bootstrap_file[0],
         a=' -a {}'.format(settings.determine_cloud_type_from_aad(config)),
+        c=' -c {}'.format(fpo.concurrency_max_actions),
         log=' -l {}:{}:{}'.format(
             fpo.log_persistence, fpo.log_level, fpo.log_filename),
         p=' -p {}:{}'.format(
@@ -99,6 +100,12 @@ def _create_virtual_machine_extension(
             bs.storage_entity_prefix
         ),
         v=' -v {}'.format(__version__),
+        x=' -x {}:{}:{}'.format(
+            fpo.scheduling_placement_policy,
+            ':'.join(
+                str(x) for x in fpo.scheduling_placement_weights.values()),
+            ','.join('{}={}'.format(k, v) for k, v in
+                     fpo.scheduling_placement_vm_prices.items())),
     )
     if verbose:
         logger.debug('bootstrap command: {}'.format(cmd))
@@ -30,6 +30,7 @@ from builtins import (  # noqa
     bytes, dict, int, list, object, range, str, ascii, chr, hex, input,
     next, oct, open, pow, round, super, filter, map, zip)
 # stdlib imports
+import collections
 import concurrent.futures
 import logging
 import os
@@ -40,6 +41,7 @@ except ImportError:
 import requests
 import sys
 import tempfile
+import threading
 import time
 import uuid
 # non-stdlib imports
@@ -349,6 +351,8 @@ _CONFIGURABLE_SLURM_FILES = {
     'slurmdbd': _SLURMDBDCONF_FILE,
     'slurmdbsql': _SLURMDBSQL_FILE,
 }
+_MAX_SSH_FANOUT_SESSIONS = 40
+_SSH_FANOUT_QUERY_TIMEOUT = 300
 
 
 def initialize_globals(verbose):
@@ -1226,6 +1230,26 @@ def _construct_pool_object(
             block_for_gr_docker, block_for_gr_singularity)
     # data replication settings
     dr = settings.data_replication_settings(config)
+    if dr.peer_to_peer.enabled:
+        if is_windows or (native and not delay_image_preload):
+            logger.warning(
+                'peer_to_peer data replication is not applicable for this '
+                'pool configuration, ignoring')
+            dr = dr._replace(
+                peer_to_peer=dr.peer_to_peer._replace(enabled=False))
+        elif not pool_settings.inter_node_communication_enabled:
+            logger.warning(
+                'peer_to_peer data replication is enabled but '
+                'inter_node_communication_enabled is false: nodes may not '
+                'be able to reach each other on port {} unless the pool is '
+                'placed in a virtual network which allows it'.format(
+                    dr.peer_to_peer.port))
+    if dr.image_cache.enabled and (
+            is_windows or (native and not delay_image_preload)):
+        logger.warning(
+            'image_cache data replication is not applicable for this pool '
+            'configuration, ignoring')
+        dr = dr._replace(image_cache=dr.image_cache._replace(enabled=False))
     # create resource files list
     if is_windows:
         _rflist = [_REGISTRY_LOGIN_WINDOWS_FILE, _BLOBXFER_WINDOWS_FILE]
@@ -1658,6 +1682,30 @@ def _construct_pool_object(
         pool.start_task.environment_settings.append(
             batchmodels.EnvironmentSetting(name='SHIPYARD_TIMING', value='1')
         )
+    if not native or delay_image_preload:
+        pool.start_task.environment_settings.append(
+            batchmodels.EnvironmentSetting(
+                name='SHIPYARD_CONCURRENT_PULLS_PER_NODE',
+                value=str(dr.concurrent_pulls_per_node))
+        )
+    if dr.image_cache.enabled:
+        pool.start_task.environment_settings.append(
+            batchmodels.EnvironmentSetting(
+                name='SHIPYARD_IMAGE_CACHE_CONNECTIONS',
+                value=str(dr.image_cache.concurrent_block_downloads))
+        )
+    if dr.peer_to_peer.enabled:
+        pool.start_task.environment_settings.extend([
+            batchmodels.EnvironmentSetting(
+                name='SHIPYARD_P2P_PORT',
+                value=str(dr.peer_to_peer.port)),
+            batchmodels.EnvironmentSetting(
+                name='SHIPYARD_P2P_CONCURRENT_UPLOADS',
+                value=str(dr.peer_to_peer.concurrent_uploads)),
+            batchmodels.EnvironmentSetting(
+                name='SHIPYARD_P2P_SEED_TIME',
+                value=str(dr.peer_to_peer.seed_time)),
+        ])
     # add docker login settings
     pool.start_task.environment_settings.extend(
         batch.generate_docker_login_settings(config)[0])
@@ -2042,10 +2090,122 @@ def _setup_glusterfs(
             batchtask.id, job_id))
 
 
+def _get_ssh_endpoint_of_node(node):
+    # type: (batchmodels.ComputeNode) -> tuple
+    """Get the public SSH endpoint of a node from its endpoint configuration
+    :param batchmodels.ComputeNode node: compute node
+    :rtype: tuple
+    :return: (ip address, port) or None if no SSH endpoint is present
+    """
+    if (node.endpoint_configuration is None or
+            node.endpoint_configuration.inbound_endpoints is None):
+        return None
+    for ep in node.endpoint_configuration.inbound_endpoints:
+        if (ep.backend_port == 22 and
+                ep.protocol == batchmodels.InboundEndpointProtocol.tcp and
+                util.is_not_empty(ep.public_ip_address)):
+            return ep.public_ip_address, ep.frontend_port
+    return None
+
+
+def _execute_ssh_command_on_node(
+        batch_client, pool_id, node_id, endpoint, ssh_private_key, username,
+        command, timeout):
+    # type: (batchsc.BatchServiceClient, str, str, tuple, pathlib.Path, str,
+    #        list, int) -> tuple
+    """Execute a command on a node over ssh
+    :param batch_client: The batch client to use.
+    :type batch_client: `azure.batch.batch_service_client.BatchServiceClient`
+    :param str pool_id: pool id
+    :param str node_id: node id
+    :param tuple endpoint: (ip address, port) of the SSH endpoint, or None
+        to retrieve the remote login settings of the node
+    :param pathlib.Path ssh_private_key: SSH private key
+    :param str username: username
+    :param list command: command
+    :param int timeout: timeout in seconds for the command on the node
+    :rtype: tuple
+    :return: (node id, return code, stdout, stderr, timed out, elapsed),
+        return code is None if the session could not be started
+    """
+    start = time.time()
+    # failures on one node, such as a node removed during the fan out,
+    # must not abort the sessions of other nodes
+    try:
+        if endpoint is None:
+            rls = batch_client.compute_node.get_remote_login_settings(
+                pool_id, node_id)
+            endpoint = (rls.remote_login_ip_address, rls.remote_login_port)
+        proc = crypto.connect_or_exec_ssh_command(
+            endpoint[0], endpoint[1], ssh_private_key, username, sync=False,
+            tty=False, command=command)
+    except Exception as e:
+        return node_id, None, '', str(e), False, time.time() - start
+    timed_out = threading.Event()
+    timer = None
+    if timeout is not None:
+        remaining = max((timeout - (time.time() - start), 0))
+
+        def _kill():
+            if proc.poll() is None:
+                timed_out.set()
+                try:
+                    proc.kill()
+                except OSError:
+                    pass
+
+        timer = threading.Timer(remaining, _kill)
+        timer.daemon = True
+        timer.start()
+    try:
+        stdout, stderr = proc.communicate()
+    finally:
+        if timer is not None:
+            timer.cancel()
+    return (
+        node_id, proc.returncode, stdout, stderr, timed_out.is_set(),
+        time.time() - start
+    )
+
+
+def _fan_out_command_on_pool_over_ssh(
+        batch_client, pool_id, endpoints, ssh_private_key, username, command,
+        timeout=None, max_sessions=_MAX_SSH_FANOUT_SESSIONS):
+    # type: (batchsc.BatchServiceClient, str, dict, pathlib.Path, str, list,
+    #        int, int) -> Generator[tuple, None, None]
+    """Execute a command on nodes over ssh with a sliding window of
+    concurrent sessions, yielding results as each node completes
+    :param batch_client: The batch client to use.
+    :type batch_client: `azure.batch.batch_service_client.BatchServiceClient`
+    :param str pool_id: pool id
+    :param dict endpoints: node id -> (ip address, port) SSH endpoint or
+        None if the node has no endpoint
+    :param pathlib.Path ssh_private_key: SSH private key
+    :param str username: username
+    :param list command: command
+    :param int timeout: timeout in seconds for the command on each node
+    :param int max_sessions: maximum number of concurrent sessions
+    :rtype: Generator
+    :return: (node id, return code, stdout, stderr, timed out, elapsed)
+    """
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max((min((len(endpoints), max_sessions)), 1))
+    ) as executor:
+        futures = [
+            executor.submit(
+                _execute_ssh_command_on_node, batch_client, pool_id, node_id,
+                endpoints[node_id], ssh_private_key, username, command,
+                timeout)
+            for node_id in endpoints
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
+
+
 def _execute_command_on_pool_over_ssh_with_keyed_output(
-        batch_client, config, pool, desc, cmd):
+        batch_client, config, pool, desc, cmd, timeout=None):
     # type: (batchsc.BatchServiceClient, dict, batchmodels.CloudPool, str,
-    #        list) -> dict
+    #        list, int) -> dict
     """Execute a command on all nodes in pool over ssh
     :param batch_client: The batch client to use.
     :type batch_client: `azure.batch.batch_service_client.BatchServiceClient`
@@ -2053,6 +2213,7 @@ def _execute_command_on_pool_over_ssh_with_keyed_output(
     :param batchmodels.CloudPool pool: cloud pool
     :param str desc: description of action
     :param list cmd: command
+    :param int timeout: timeout in seconds for the command on each node
     :rtype: dict
     :return: keyed stdout by node id
     """
@@ -2083,52 +2244,73 @@ def _execute_command_on_pool_over_ssh_with_keyed_output(
     command = ['sudo', '/bin/bash -c \'{}\''.format(' && '.join(cmd))]
     if settings.verbose(config):
         logger.debug('executing command: {}'.format(command))
-    # iterate through all nodes
-    nodes = batch_client.compute_node.list(pool.id)
-    procs = {}
+    # retrieve the ssh endpoints of all nodes with the node list, remote
+    # login settings are only retrieved for nodes without an endpoint
+    endpoints = collections.OrderedDict(
+        (node.id, _get_ssh_endpoint_of_node(node))
+        for node in batch_client.compute_node.list(
+            pool.id,
+            compute_node_list_options=batchmodels.ComputeNodeListOptions(
+                select='id,endpointConfiguration'))
+    )
+    node_ids = list(endpoints.keys())
+    # execute over a sliding window of ssh sessions
     stdout = {}
     stderr = {}
-    failures = False
-    for node in nodes:
-        rls = batch_client.compute_node.get_remote_login_settings(
-            pool.id, node.id)
-        procs[node.id] = crypto.connect_or_exec_ssh_command(
-            rls.remote_login_ip_address, rls.remote_login_port,
-            ssh_private_key, username, sync=False, tty=False,
-            command=command)
-        if len(procs) >= 40:
-            logger.debug('waiting for {} processes to complete'.format(
-                len(procs)))
-            for key in procs:
-                stdout[key], stderr[key] = procs[key].communicate()
-            rcs, _, _ = util.subprocess_wait_all(
-                list(procs.values()), poll=True)
-            if any([x != 0 for x in rcs]):
-                if settings.verbose(config):
-                    logger.warning('return codes: {}'.format(rcs))
-                    logger.warning('stdout: {}'.format(stdout))
-                    logger.warning('stderr: {}'.format(stderr))
-                failures = True
-            procs = []
-            del rcs
-    if len(procs) > 0:
-        logger.debug('waiting for {} processes to complete'.format(
-            len(procs)))
-        for key in procs:
-            stdout[key], stderr[key] = procs[key].communicate()
-        rcs, _, _ = util.subprocess_wait_all(list(procs.values()), poll=True)
-        if any([x != 0 for x in rcs]):
-            if settings.verbose(config):
-                logger.warning('return codes: {}'.format(rcs))
-                logger.warning('stdout: {}'.format(stdout))
-                logger.warning('stderr: {}'.format(stderr))
-            failures = True
-        del procs
-        del rcs
-    if failures:
+    rcs = {}
+    elapsed = {}
+    failures = []
+    for node_id, rc, out, err, timed_out, secs in \
+            _fan_out_command_on_pool_over_ssh(
+                batch_client, pool.id, endpoints, ssh_private_key, username,
+                command, timeout=timeout):
+        stdout[node_id] = out
+        stderr[node_id] = err
+        rcs[node_id] = rc
+        elapsed[node_id] = secs
+        if rc is None:
+            logger.error('node {} could not start {}: {}'.format(
+                node_id, desc, err))
+            failures.append(node_id)
+        elif timed_out:
+            logger.error(
+                'node {} timed out after {:.2f}s performing {}'.format(
+                    node_id, secs, desc))
+            failures.append(node_id)
+        elif rc != 0:
+            logger.error(
+                'node {} returned {} performing {} in {:.2f}s'.format(
+                    node_id, rc, desc, secs))
+            failures.append(node_id)
+        else:
+            logger.debug('node {} completed {} in {:.2f}s ({}/{})'.format(
+                node_id, desc, secs, len(rcs), len(node_ids)))
+    if len(elapsed) > 0:
+        latencies = sorted(elapsed.values())
+        slowest = max(elapsed, key=elapsed.get)
+        logger.info(
+            ('{} latency over {} nodes: min={:.2f}s median={:.2f}s '
+             'p95={:.2f}s max={:.2f}s (node {})').format(
+                 desc, len(latencies), latencies[0],
+                 latencies[len(latencies) // 2],
+                 latencies[min((int(len(latencies) * 0.95),
+                                len(latencies) - 1))],
+                 latencies[-1], slowest))
+    # key output in node list order
+    stdout = collections.OrderedDict(
+        (node_id, stdout[node_id]) for node_id in node_ids)
+    if len(failures) > 0:
+        if settings.verbose(config):
+            for node_id in failures:
+                logger.warning('node {} return code: {}'.format(
+                    node_id, rcs[node_id]))
+                logger.warning('node {} stdout: {}'.format(
+                    node_id, stdout[node_id]))
+                logger.warning('node {} stderr: {}'.format(
+                    node_id, stderr[node_id]))
         raise RuntimeError(
-            'failures detected performing {} on pool: {}'.format(
-                desc, pool.id))
+            'failures detected performing {} on {} of {} nodes in '
+            'pool: {}'.format(desc, len(failures), len(node_ids), pool.id))
     else:
         logger.info('{} completed for pool: {}'.format(desc, pool.id))
     return stdout
@@ -2239,12 +2421,14 @@ def _get_singularity_pull_cmd_for_update(config, image):
 
 
 def _update_container_images(
-        batch_client, config, docker_image=None, docker_image_digest=None,
-        singularity_image=None, force_ssh=False):
-    # type: (batchsc.BatchServiceClient, dict, str, str, str, bool) -> None
+        batch_client, table_client, config, docker_image=None,
+        docker_image_digest=None, singularity_image=None, force_ssh=False):
+    # type: (batchsc.BatchServiceClient, azure.cosmosdb.table.TableService,
+    #        dict, str, str, str, bool) -> None
     """Update container images in pool
     :param batch_client: The batch client to use.
     :type batch_client: `azure.batch.batch_service_client.BatchServiceClient`
+    :param azure.cosmosdb.table.TableService table_client: table client
     :param dict config: configuration dict
     :param str docker_image: docker image to update
     :param str docker_image_digest: digest to update to
@@ -2328,6 +2512,8 @@ def _update_container_images(
     if (util.is_none_or_empty(docker_image) and
             util.is_none_or_empty(singularity_image)):
         logger.debug('no image provided: re-running cascade')
+        # images loaded prior to the update must not be distributed
+        storage.clear_global_resource_image_distribution(table_client, config)
         start_mnt = '/'.join((
             settings.temp_disk_mountpoint(config),
             'batch', 'tasks', 'startup',
@@ -2361,6 +2547,14 @@ def _update_container_images(
             'popd'
         ])
     else:
+        # images loaded prior to the update must not be distributed
+        resources = []
+        if util.is_not_empty(docker_image):
+            resources.append('docker:{}'.format(docker_image))
+        if util.is_not_empty(singularity_image):
+            resources.append('singularity:{}'.format(singularity_image))
+        storage.clear_global_resource_image_distribution(
+            table_client, config, resources=resources)
         if util.is_not_empty(docker_images):
             coordcmd.extend(
                 ['docker pull {}'.format(x) for x in docker_images])
@@ -2477,7 +2671,8 @@ def _docker_ps_over_ssh(batch_client, config):
     desc = 'docker ps'
     cmd = ['docker ps -a']
     stdout = _execute_command_on_pool_over_ssh_with_keyed_output(
-        batch_client, config, pool, desc, cmd)
+        batch_client, config, pool, desc, cmd,
+        timeout=_SSH_FANOUT_QUERY_TIMEOUT)
     _log_stdout_by_nodeid(config, pool_id, desc, stdout)
 
 
@@ -2492,7 +2687,8 @@ def _list_docker_images(batch_client, config):
     pool = batch_client.pool.get(pool_id)
     cmd = ['docker images --format "{{.ID}} {{.Repository}}:{{.Tag}}"']
     stdout = _execute_command_on_pool_over_ssh_with_keyed_output(
-        batch_client, config, pool, 'list docker images', cmd)
+        batch_client, config, pool, 'list docker images', cmd,
+        timeout=_SSH_FANOUT_QUERY_TIMEOUT)
     # process stdout
     node_images = {}
     all_images = {}
@@ -2569,7 +2765,8 @@ def _list_singularity_images(batch_client, config):
             'find {0} -name "*.sif"; '
             'fi'.format(directory))
     stdout = _execute_command_on_pool_over_ssh_with_keyed_output(
-        batch_client, config, pool, 'singularity list', cmds)
+        batch_client, config, pool, 'singularity list', cmds,
+        timeout=_SSH_FANOUT_QUERY_TIMEOUT)
     # process stdout
     node_images = {}
     all_images = {}
@@ -3908,12 +4105,14 @@ def action_diag_logs_upload(
 
 
 def action_pool_images_update(
-        batch_client, config, docker_image, docker_image_digest,
-        singularity_image, ssh):
-    # type: (batchsc.BatchServiceClient, dict, str, str, str, bool) -> None
+        batch_client, table_client, config, docker_image,
+        docker_image_digest, singularity_image, ssh):
+    # type: (batchsc.BatchServiceClient, azure.cosmosdb.table.TableService,
+    #        dict, str, str, str, bool) -> None
     """Action: Pool Images Update
     :param azure.batch.batch_service_client.BatchServiceClient batch_client:
         batch client
+    :param azure.cosmosdb.table.TableService table_client: table client
     :param dict config: configuration dict
     :param str docker_image: docker image to update
     :param str docker_image_digest: docker image digest to update to
@@ -3925,8 +4124,8 @@ def action_pool_images_update(
         raise ValueError(
             'cannot specify a digest to update to without the image')
     _update_container_images(
-        batch_client, config, docker_image, docker_image_digest,
-        singularity_image, force_ssh=ssh)
+        batch_client, table_client, config, docker_image,
+        docker_image_digest, singularity_image, force_ssh=ssh)
 
 
 def action_pool_images_list(batch_client, config):
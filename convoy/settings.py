@@ -292,7 +292,8 @@ BatchShipyardSettings = collections.namedtuple(
 )
 DataReplicationSettings = collections.namedtuple(
     'DataReplicationSettings', [
-        'concurrent_source_downloads',
+        'concurrent_source_downloads', 'concurrent_pulls_per_node',
+        'peer_to_peer', 'image_cache',
     ]
 )
 SourceSettings = collections.namedtuple(
@@ -306,6 +307,16 @@ DestinationSettings = collections.namedtuple(
         'relative_destination_path', 'data_transfer'
     ]
 )
+ImageCacheSettings = collections.namedtuple(
+    'ImageCacheSettings', [
+        'enabled', 'concurrent_block_downloads',
+    ]
+)
+PeerToPeerSettings = collections.namedtuple(
+    'PeerToPeerSettings', [
+        'enabled', 'port', 'concurrent_uploads', 'seed_time',
+    ]
+)
 DataTransferSettings = collections.namedtuple(
     'DataTransferSettings', [
         'method', 'ssh_private_key', 'scp_ssh_extra_options',
@@ -483,6 +494,8 @@ FederationProxyOptionsSettings = collections.namedtuple(
         'log_persistence', 'log_level', 'log_filename',
         'scheduling_after_success_blackout_interval',
         'scheduling_after_success_evaluate_autoscale',
+        'scheduling_placement_policy', 'scheduling_placement_weights',
+        'scheduling_placement_vm_prices', 'concurrency_max_actions',
     ]
 )
 SlurmBatchPoolSettings = collections.namedtuple(
@@ -491,10 +504,16 @@ SlurmBatchPoolSettings = collections.namedtuple(
         'weight', 'features', 'reclaim_exclude_num_nodes',
     ]
 )
+SlurmWarmBufferSettings = collections.namedtuple(
+    'SlurmWarmBufferSettings', [
+        'min_idle_nodes', 'max_idle_nodes', 'lookback_interval',
+    ]
+)
 SlurmPartitionSettings = collections.namedtuple(
     'SlurmPartitionSettings', [
         'batch_pools', 'max_runtime_limit', 'default', 'preempt_type',
         'preempt_mode', 'over_subscribe', 'priority_tier', 'other_options',
+        'warm_buffer',
     ]
 )
 SlurmUnmanagedPartitionSettings = collections.namedtuple(
@@ -2386,8 +2405,47 @@ def data_replication_settings(config):
             raise KeyError()
     except KeyError:
         concurrent_source_downloads = 10
+    concurrent_pulls_per_node = _kv_read(
+        conf, 'concurrent_pulls_per_node', default=4)
+    if concurrent_pulls_per_node < 1:
+        raise ValueError(
+            'invalid concurrent_pulls_per_node {}'.format(
+                concurrent_pulls_per_node))
+    p2pconf = _kv_read_checked(conf, 'peer_to_peer', default={})
+    p2p = PeerToPeerSettings(
+        enabled=_kv_read(p2pconf, 'enabled', default=False),
+        port=_kv_read(p2pconf, 'port', default=6881),
+        concurrent_uploads=_kv_read(
+            p2pconf, 'concurrent_uploads', default=4),
+        seed_time=_kv_read(p2pconf, 'seed_time', default=1800),
+    )
+    if p2p.enabled:
+        if p2p.port < 1 or p2p.port > 65534:
+            raise ValueError(
+                'invalid peer_to_peer:port {}, must be between 1 and '
+                '65534'.format(p2p.port))
+        if p2p.concurrent_uploads < 1:
+            raise ValueError(
+                'invalid peer_to_peer:concurrent_uploads {}'.format(
+                    p2p.concurrent_uploads))
+        if p2p.seed_time < 0:
+            raise ValueError(
+                'invalid peer_to_peer:seed_time {}'.format(p2p.seed_time))
+    icconf = _kv_read_checked(conf, 'image_cache', default={})
+    image_cache = ImageCacheSettings(
+        enabled=_kv_read(icconf, 'enabled', default=False),
+        concurrent_block_downloads=_kv_read(
+            icconf, 'concurrent_block_downloads', default=8),
+    )
+    if image_cache.enabled and image_cache.concurrent_block_downloads < 1:
+        raise ValueError(
+            'invalid image_cache:concurrent_block_downloads {}'.format(
+                image_cache.concurrent_block_downloads))
     return DataReplicationSettings(
         concurrent_source_downloads=concurrent_source_downloads,
+        concurrent_pulls_per_node=concurrent_pulls_per_node,
+        peer_to_peer=p2p,
+        image_cache=image_cache,
     )
 
 
@@ -2437,6 +2495,26 @@ def global_resources_singularity_images(config):
     return images
 
 
+def global_resources_image_demand(config):
+    # type: (dict) -> dict
+    """Get number of tasks referencing each image in the jobs
+    configuration, if present
+    :param dict config: configuration object
+    :rtype: dict
+    :return: image to number of referencing tasks
+    """
+    demand = collections.Counter()
+    for jobspec in _kv_read_checked(config, 'job_specifications', default=[]):
+        tasks = list(_kv_read_checked(jobspec, 'tasks', default=[]))
+        tasks.append(_kv_read_checked(jobspec, 'merge_task', default={}))
+        for conf in tasks:
+            for key in ('docker_image', 'singularity_image'):
+                image = _kv_read_checked(conf, key)
+                if image is not None:
+                    demand[image] += 1
+    return demand
+
+
 def global_resources_singularity_images_settings(config, signed):
     # type: (dict, bool) -> list
     """Get list of singularity images settings
@@ -5166,6 +5244,30 @@ def federation_proxy_options_settings(config):
         raise ValueError(
             'the scheduling:after_success:blackout_interval value can not '
             'be less than 2')
+    pl_conf = _kv_read_checked(sched_conf, 'placement', default={})
+    plp = _kv_read_checked(pl_conf, 'policy', 'greedy').lower()
+    if plp not in ('greedy', 'scored'):
+        raise ValueError(
+            'invalid scheduling:placement:policy value: {}'.format(plp))
+    w_conf = _kv_read_checked(pl_conf, 'weights', default={})
+    plw = collections.OrderedDict()
+    for key, default in (
+            ('fit', 1.0), ('backlog', 1.0), ('locality', 1.0),
+            ('price', 0.0)):
+        plw[key] = float(_kv_read(w_conf, key, default))
+        if plw[key] < 0:
+            raise ValueError(
+                'the scheduling:placement:weights:{} value can not be '
+                'negative'.format(key))
+    plvp = {
+        k.lower(): float(v) for k, v in _kv_read_checked(
+            pl_conf, 'vm_prices', default={}).items()
+    }
+    conc_conf = _kv_read_checked(conf, 'concurrency', default={})
+    cma = _kv_read(conc_conf, 'max_actions', 16)
+    if cma < 1:
+        raise ValueError(
+            'the concurrency:max_actions value can not be less than 1')
     return FederationProxyOptionsSettings(
         federations_polling_interval=str(fpi),
         actions_polling_interval=str(api),
@@ -5175,6 +5277,10 @@ def federation_proxy_options_settings(config):
         scheduling_after_success_blackout_interval=sasbi,
         scheduling_after_success_evaluate_autoscale=_kv_read(
             as_conf, 'evaluate_autoscale', True),
+        scheduling_placement_policy=plp,
+        scheduling_placement_weights=plw,
+        scheduling_placement_vm_prices=plvp,
+        concurrency_max_actions=cma,
     )
 
 
@@ -5342,6 +5448,28 @@ def slurm_options_settings(config):
             max_runtime_limit = max_runtime_limit.replace('.', '-')
         else:
             max_runtime_limit = 'UNLIMITED'
+        wb_conf = _kv_read_checked(part, 'warm_buffer', default={})
+        min_idle_nodes = _kv_read(wb_conf, 'min_idle_nodes', default=0)
+        max_idle_nodes = _kv_read(
+            wb_conf, 'max_idle_nodes', default=min_idle_nodes)
+        if min_idle_nodes > max_idle_nodes:
+            raise ValueError(
+                'warm_buffer min_idle_nodes {} > max_idle_nodes {} for '
+                'partition {}'.format(min_idle_nodes, max_idle_nodes, key))
+        part_max_nodes = sum(
+            bpool.max_compute_nodes for bpool in batch_pools.values())
+        if max_idle_nodes > part_max_nodes:
+            raise ValueError(
+                'warm_buffer max_idle_nodes {} > total max_compute_nodes {} '
+                'for partition {}'.format(
+                    max_idle_nodes, part_max_nodes, key))
+        lookback_interval = util.convert_string_to_timedelta(
+            _kv_read_checked(
+                wb_conf, 'lookback_interval', default='00:30:00'))
+        if lookback_interval.total_seconds() <= 0:
+            raise ValueError(
+                'warm_buffer lookback_interval must be positive for '
+                'partition {}'.format(key))
         partition = SlurmPartitionSettings(
             batch_pools=batch_pools,
             max_runtime_limit=max_runtime_limit,
@@ -5351,6 +5479,11 @@ def slurm_options_settings(config):
             over_subscribe=_kv_read_checked(part, 'over_subscribe'),
             priority_tier=_kv_read(part, 'priority_tier'),
             other_options=_kv_read_checked(part, 'other_options', default=[]),
+            warm_buffer=SlurmWarmBufferSettings(
+                min_idle_nodes=min_idle_nodes,
+                max_idle_nodes=max_idle_nodes,
+                lookback_interval=lookback_interval,
+            ),
         )
         partitions[key] = partition
     unmanaged_partitions = []
@@ -539,7 +539,7 @@ def create_slurm_controller(
             storage.create_slurm_partition(
                 table_client, queue_client, config, cluster_id, partname,
                 bpool.batch_service_url, pool_id, bpool.compute_node_type,
-                bpool.max_compute_nodes, nodes)
+                bpool.max_compute_nodes, nodes, part.warm_buffer)
         if util.is_not_empty(part.preempt_type):
             preempt_type = ' PreemptType={}'.format(part.preempt_type)
         else:
@@ -30,20 +30,24 @@ from builtins import (  # noqa
     bytes, dict, int, list, object, range, str, ascii, chr, hex, input,
     next, oct, open, pow, round, super, filter, map, zip)
 # stdlib imports
+import concurrent.futures
 import datetime
 import json
 import logging
+import multiprocessing
 import os
 import pickle
 import re
 import tempfile
 import time
 import uuid
+import zlib
 # non-stdlib imports
 import azure.common
 import azure.cosmosdb.table as azuretable
 import azure.storage.blob as azureblob
 import azure.storage.file as azurefile
+import msrest.serialization
 # local imports
 from . import settings
 from . import util
@@ -59,8 +63,17 @@ _MONITOR_REMOTEFS_PK = 'RemoteFS'
 _ALL_FEDERATIONS_PK = '!!FEDERATIONS'
 _FEDERATION_ACTIONS_PREFIX_PK = '!!ACTIONS'
 _BLOCKED_FEDERATION_ACTIONS_PREFIX_PK = '!!ACTIONS.BLOCKED'
+_GLOBAL_RESOURCES_PEERS_PK_SUFFIX = '$p2p'
+_GLOBAL_RESOURCES_CACHE_PK_SUFFIX = '$cache'
+_FEDERATION_PAYLOAD_MAGIC = b'BSFP'
+_FEDERATION_PAYLOAD_SCHEMA_VERSION = 1
+_PRIMITIVE_MODEL_TYPES = {
+    'bool': bool,
+    'int': int,
+    'str': str,
+}
 _MAX_SEQUENCE_ID_PROPERTIES = 15
-_MAX_SEQUENCE_IDS_PER_PROPERTY = 975
+_MAX_EXECUTOR_WORKERS = min((multiprocessing.cpu_count() * 4, 32))
 _DEFAULT_SAS_EXPIRY_DAYS = 365 * 30
 _STORAGEACCOUNT = None
 _STORAGEACCOUNTKEY = None
@@ -446,6 +459,7 @@ def _add_global_resource(
         else:
             raise NotImplementedError(
                 'global resource type: {}'.format(grtype))
+        demand = settings.global_resources_image_demand(config)
         for gr in resources:
             resource = '{}:{}'.format(prefix, gr)
             resource_sha1 = util.hash_string(resource)
@@ -461,6 +475,7 @@ def _add_global_resource(
                     'RowKey': resource_sha1,
                     'Resource': resource,
                     'KeyFingerprint': key_fingerprint,
+                    'Demand': demand.get(gr, 0),
                 }
             )
             for i in range(0, dr.concurrent_source_downloads):
@@ -884,7 +899,7 @@ def collate_all_location_entities_for_job(table_client, fedhash, entity):
     return loc_pk, rks
 
 
-def get_all_federation_jobs(table_client, fedhash):
+def get_all_federation_jobs(table_client, fedhash, sequence_entries=False):
     pk = '{}${}'.format(_FEDERATION_ACTIONS_PREFIX_PK, fedhash)
     try:
         entities = table_client.query_entities(
@@ -892,20 +907,26 @@ def get_all_federation_jobs(table_client, fedhash):
             filter='PartitionKey eq \'{}\''.format(pk))
     except azure.common.AzureMissingResourceHttpError:
         entities = []
+    if not sequence_entries:
+        entities = (x for x in entities if 'Kind' in x)
     return pk, entities
 
 
 def gc_federation_jobs(table_client, config, federation_id, fedhash):
     # retrieve all job sequence rows for federation
-    pk, entities = get_all_federation_jobs(table_client, fedhash)
+    pk, entities = get_all_federation_jobs(
+        table_client, fedhash, sequence_entries=True)
     gc_dict = {
         pk: []
     }
     # process all jobs
     for entity in entities:
+        # sequence entries are removed along with their target
+        if 'Kind' not in entity:
+            gc_dict[pk].append(entity['RowKey'])
+            continue
         # if sequence exists, ask for confirmation
-        if ('Sequence0' in entity and
-                util.is_not_empty(entity['Sequence0']) and
+        if (not _sequence_is_empty(entity) and
                 not util.confirm_action(
                     config,
                     msg=('destroying pending actions for job {} in '
@@ -1177,70 +1198,158 @@ def remove_pool_from_federation(
         print(json.dumps(rawout, sort_keys=True, indent=4))
 
 
-def _pack_sequences(ent, unique_id):
+def _sequence_entry_row_key(rk, index):
+    # type: (str, int) -> str
+    """Get the row key of a sequence entry, entries of a target share the
+    target row key as prefix and sort in sequence order
+    :param str rk: target row key
+    :param int index: sequence index
+    :rtype: str
+    :return: sequence entry row key
+    """
+    return '{}${:020d}'.format(rk, index)
+
+
+def _sequence_is_empty(ent):
+    # type: (dict) -> bool
+    """Check if the action sequence of a target entity is empty
+    :param dict ent: target entity
+    :rtype: bool
+    :return: if sequence is empty
+    """
+    if 'SequenceTail' not in ent:
+        return util.is_none_or_empty(ent.get('Sequence0'))
+    return ent['SequenceHead'] >= ent['SequenceTail']
+
+
+def _get_first_sequence_ids(table_client, ent, num_results):
+    # type: (azuretable.TableService, dict, int) -> List[str]
+    """Get the first unique ids of the action sequence of a target
+    :param azure.cosmosdb.table.TableService table_client: table client
+    :param dict ent: target entity
+    :param int num_results: maximum number of unique ids
+    :rtype: list
+    :return: unique ids
+    """
+    if _sequence_is_empty(ent):
+        return []
+    if 'SequenceTail' not in ent:
+        return ent['Sequence0'].split(',')[:num_results]
+    rk = ent['RowKey']
+    entries = table_client.query_entities(
+        _STORAGE_CONTAINERS['table_federation_jobs'],
+        filter=(
+            'PartitionKey eq \'{}\' and RowKey gt \'{}$\' and '
+            'RowKey lt \'{}%\''
+        ).format(ent['PartitionKey'], rk, rk),
+        select='UniqueId', num_results=num_results)
+    return [entry['UniqueId'] for entry in entries]
+
+
+def _migrate_legacy_sequence(table_client, ent):
+    # type: (azuretable.TableService, dict) -> None
+    """Convert an action sequence stored as comma-joined unique ids
+    across sequence properties to sequence entries
+    :param azure.cosmosdb.table.TableService table_client: table client
+    :param dict ent: target entity
+    """
+    table_name = _STORAGE_CONTAINERS['table_federation_jobs']
+    pk = ent['PartitionKey']
+    rk = ent['RowKey']
     seq = []
     for i in range(0, _MAX_SEQUENCE_ID_PROPERTIES):
         prop = 'Sequence{}'.format(i)
         if prop in ent and util.is_not_empty(ent[prop]):
             seq.extend(ent[prop].split(','))
-    seq.append(str(unique_id))
-    if len(seq) > _MAX_SEQUENCE_IDS_PER_PROPERTY * _MAX_SEQUENCE_ID_PROPERTIES:
-        raise RuntimeError(
-            'maximum number of enqueued sequence ids reached, please allow '
-            'job actions to drain')
-    for i in range(0, _MAX_SEQUENCE_ID_PROPERTIES):
-        prop = 'Sequence{}'.format(i)
-        start = i * _MAX_SEQUENCE_IDS_PER_PROPERTY
-        end = start + _MAX_SEQUENCE_IDS_PER_PROPERTY
-        if end > len(seq):
-            end = len(seq)
-        if start < end:
-            ent[prop] = ','.join(seq[start:end])
-        else:
-            ent[prop] = None
+    # entries are written idempotently prior to the target such that
+    # a concurrent migration yields the same entries
+    tb = azuretable.TableBatch()
+    for index, uid in enumerate(seq):
+        tb.insert_or_replace_entity({
+            'PartitionKey': pk,
+            'RowKey': _sequence_entry_row_key(rk, index),
+            'UniqueId': uid,
+        })
+        if (index + 1) % 100 == 0:
+            table_client.commit_batch(table_name, tb)
+            tb = azuretable.TableBatch()
+    if len(seq) % 100 != 0:
+        table_client.commit_batch(table_name, tb)
+    try:
+        table_client.update_entity(
+            table_name, entity={
+                'PartitionKey': pk,
+                'RowKey': rk,
+                'Kind': ent['Kind'],
+                'Id': ent['Id'],
+                'SequenceHead': 0,
+                'SequenceTail': len(seq),
+            }, if_match=ent['etag'])
+    except azure.common.AzureHttpError as ex:
+        if ex.status_code not in (404, 412):
+            raise
 
 
-def _retrieve_and_merge_sequence(
+def _enqueue_sequence_id(
         table_client, pk, unique_id, kind, target, entity_must_not_exist):
+    # type: (azuretable.TableService, str, uuid.UUID, str, str,
+    #        bool) -> bool
+    """Append a unique id to the action sequence of a target. The target
+    tail is advanced and the sequence entry is inserted in one entity
+    group transaction.
+    :param azure.cosmosdb.table.TableService table_client: table client
+    :param str pk: partition key
+    :param uuid.UUID unique_id: unique id
+    :param str kind: kind
+    :param str target: target
+    :param bool entity_must_not_exist: target entity must not exist
+    :rtype: bool
+    :return: if the unique id was appended
+    """
+    table_name = _STORAGE_CONTAINERS['table_federation_jobs']
     rk = util.hash_string(target)
     try:
-        ent = table_client.get_entity(
-            _STORAGE_CONTAINERS['table_federation_jobs'], pk, rk)
+        ent = table_client.get_entity(table_name, pk, rk)
         if entity_must_not_exist:
             raise RuntimeError(
                 '{} {} action entity already exists: rolling back action '
                 'due to unique job id requirement for federation.'.format(
                     kind, target))
     except azure.common.AzureMissingResourceHttpError:
-        ent = {
+        ent = None
+    if ent is not None and 'SequenceTail' not in ent:
+        _migrate_legacy_sequence(table_client, ent)
+        return False
+    tb = azuretable.TableBatch()
+    if ent is None:
+        tail = 0
+        tb.insert_entity({
             'PartitionKey': pk,
             'RowKey': rk,
             'Kind': kind,
             'Id': target,
-        }
-    _pack_sequences(ent, unique_id)
-    return ent
-
-
-def _insert_or_merge_entity_with_etag(table_client, table_name, entity):
-    if 'etag' not in entity:
-        try:
-            table_client.insert_entity(table_name, entity=entity)
-            return True
-        except azure.common.AzureConflictHttpError:
-            pass
+            'SequenceHead': 0,
+            'SequenceTail': 1,
+        })
     else:
-        etag = entity['etag']
-        entity.pop('etag')
-        try:
-            table_client.merge_entity(table_name, entity=entity, if_match=etag)
-            return True
-        except azure.common.AzureConflictHttpError:
-            pass
-        except azure.common.AzureHttpError as ex:
-            if ex.status_code != 412:
-                raise
-    return False
+        tail = ent['SequenceTail']
+        tb.merge_entity({
+            'PartitionKey': pk,
+            'RowKey': rk,
+            'SequenceTail': tail + 1,
+        }, if_match=ent['etag'])
+    tb.insert_entity({
+        'PartitionKey': pk,
+        'RowKey': _sequence_entry_row_key(rk, tail),
+        'UniqueId': str(unique_id),
+    })
+    try:
+        table_client.commit_batch(table_name, tb)
+    except azure.common.AzureHttpError as ex:
+        if ex.status_code not in (404, 409, 412):
+            raise
+        return False
+    return True
 
 
 def check_if_job_exists_in_federation(
@@ -1308,11 +1417,9 @@ def add_job_to_federation(
                     kind, target, federation_id))
     # upsert unique id to sequence
     while True:
-        entity = _retrieve_and_merge_sequence(
-            table_client, pk, unique_id, kind, target, requires_unique_job_ids)
-        if _insert_or_merge_entity_with_etag(
-                table_client, _STORAGE_CONTAINERS['table_federation_jobs'],
-                entity):
+        if _enqueue_sequence_id(
+                table_client, pk, unique_id, kind, target,
+                requires_unique_job_ids):
             logger.debug(
                 'upserted {} {} sequence uid {} to federation {}'.format(
                     kind, target, unique_id, federation_id))
@@ -1431,11 +1538,12 @@ def list_queued_actions_in_federation(
                 federation_id)
         ]
     for entity in entities:
-        if ('Sequence0' not in entity or
-                util.is_none_or_empty(entity['Sequence0'])):
+        if 'Kind' not in entity:
+            continue
+        uids = _get_first_sequence_ids(table_client, entity, 10)
+        if len(uids) == 0:
             continue
         id = entity['Id']
-        uids = entity['Sequence0'].split(',')[:10]
         if settings.raw(config):
             log[id] = {
                 'kind': entity['Kind'],
@@ -1566,21 +1674,21 @@ def list_active_jobs_in_federation(
                 'id {}'.format(federation_id))
 
 
-def pickle_and_upload(blob_client, data, rpath, federation_id=None):
-    # type: (azureblob.BlockBlobService, dict, str, str) -> str
-    """Pickle and upload data to a given remote path
+def _upload_data(blob_client, data, rpath, federation_id):
+    # type: (azureblob.BlockBlobService, bytes, str, str) -> str
+    """Upload data to a given remote path
     :param azure.storage.blob.BlockBlobService blob_client: blob client
-    :param dict data: data to pickle
+    :param bytes data: data to upload
     :param str rpath: remote path
     :param str federation_id: federation id
     :rtype: str
-    :return: sas url of uploaded pickle
+    :return: sas url of uploaded data
     """
     f = tempfile.NamedTemporaryFile(mode='wb', delete=False)
     fname = f.name
     try:
         with open(fname, 'wb') as f:
-            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.write(data)
         f.close()
         if util.is_none_or_empty(federation_id):
             sas_urls = upload_resource_files(blob_client, [(rpath, fname)])
@@ -1588,8 +1696,7 @@ def pickle_and_upload(blob_client, data, rpath, federation_id=None):
             sas_urls = upload_job_for_federation(
                 blob_client, federation_id, [(rpath, fname)])
         if len(sas_urls) != 1:
-            raise RuntimeError(
-                'unexpected number of sas urls for pickled upload')
+            raise RuntimeError('unexpected number of sas urls for upload')
         return next(iter(sas_urls.values()))
     finally:
         try:
@@ -1600,6 +1707,147 @@ def pickle_and_upload(blob_client, data, rpath, federation_id=None):
         del fname
 
 
+def pickle_and_upload(blob_client, data, rpath, federation_id=None):
+    # type: (azureblob.BlockBlobService, dict, str, str) -> str
+    """Pickle and upload data to a given remote path
+    :param azure.storage.blob.BlockBlobService blob_client: blob client
+    :param dict data: data to pickle
+    :param str rpath: remote path
+    :param str federation_id: federation id
+    :rtype: str
+    :return: sas url of uploaded pickle
+    """
+    return _upload_data(
+        blob_client, pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL),
+        rpath, federation_id)
+
+
+def _encode_model_map(model_map):
+    # type: (dict) -> dict
+    """Encode a map of models of the same type such that attributes with
+    the same value for a majority of models are stored once
+    :param dict model_map: map of models
+    :rtype: dict
+    :return: encoded model map
+    """
+    keys = list(model_map.keys())
+    models = [model_map[x] for x in keys]
+    cls = models[0].__class__
+    serializer = msrest.serialization.Serializer(cls._infer_class_models())
+    attrs = [
+        (attr, spec['key'], spec['type'])
+        for attr, spec in cls._attribute_map.items()
+    ]
+    # find majority attribute values by vote as models are unhashable
+    shared_attrs = {}
+    for attr, _, _ in attrs:
+        candidate = None
+        count = 0
+        for model in models:
+            value = getattr(model, attr)
+            if count == 0:
+                candidate = value
+                count = 1
+            elif value == candidate:
+                count += 1
+            else:
+                count -= 1
+        if candidate is None:
+            continue
+        count = sum(1 for x in models if getattr(x, attr) == candidate)
+        if count > len(models) // 2:
+            shared_attrs[attr] = candidate
+    # store only attributes differing from the shared values, wire format
+    # values are never null so null marks a shared attribute to remove
+    shared = {}
+    deltas = []
+    for attr, key, type_ in attrs:
+        if attr in shared_attrs:
+            shared[key] = serializer.serialize_data(shared_attrs[attr], type_)
+    for model in models:
+        delta = {}
+        for attr, key, type_ in attrs:
+            value = getattr(model, attr)
+            if attr in shared_attrs:
+                if value is None:
+                    delta[key] = None
+                    continue
+                elif value == shared_attrs[attr]:
+                    continue
+            if value is None:
+                continue
+            if type(value) is _PRIMITIVE_MODEL_TYPES.get(type_):
+                delta[key] = value
+            else:
+                delta[key] = serializer.serialize_data(value, type_)
+        deltas.append(delta)
+    return {
+        '$models': cls.__name__,
+        '$shared': shared,
+        '$keys': keys,
+        '$values': deltas,
+    }
+
+
+def _encode_federation_payload_object(obj):
+    # type: (object) -> object
+    """Encode an object in a federation payload to JSON serializable form
+    :param object obj: object to encode
+    :rtype: object
+    :return: encoded object
+    """
+    if isinstance(obj, msrest.serialization.Model):
+        return {
+            '$model': obj.__class__.__name__,
+            '$value': obj.serialize(),
+        }
+    elif isinstance(obj, dict):
+        values = list(obj.values())
+        if (len(values) > 1 and
+                isinstance(values[0], msrest.serialization.Model) and
+                all(type(x) is type(values[0]) for x in values)):
+            return _encode_model_map(obj)
+        return {
+            key: _encode_federation_payload_object(obj[key]) for key in obj
+        }
+    elif isinstance(obj, (list, tuple)):
+        return [_encode_federation_payload_object(x) for x in obj]
+    return obj
+
+
+def encode_federation_payload(data):
+    # type: (dict) -> bytes
+    """Encode federation action data as compressed JSON of the Batch REST
+    wire format prefixed by a magic and schema version
+    :param dict data: data to encode
+    :rtype: bytes
+    :return: encoded data
+    """
+    payload = json.dumps(
+        _encode_federation_payload_object(data), ensure_ascii=False,
+        separators=(',', ':')).encode('utf8')
+    return b''.join((
+        _FEDERATION_PAYLOAD_MAGIC,
+        bytes((_FEDERATION_PAYLOAD_SCHEMA_VERSION,)),
+        zlib.compress(payload),
+    ))
+
+
+def encode_and_upload_federation_payload(
+        blob_client, data, rpath, federation_id):
+    # type: (azureblob.BlockBlobService, dict, str, str) -> str
+    """Encode and upload federation action data to a given remote path
+    :param azure.storage.blob.BlockBlobService blob_client: blob client
+    :param dict data: data to encode
+    :param str rpath: remote path
+    :param str federation_id: federation id
+    :rtype: str
+    :return: sas url of uploaded data
+    """
+    return _upload_data(
+        blob_client, encode_federation_payload(data), rpath, federation_id)
+
+
 def delete_or_terminate_job_from_federation(
         blob_client, table_client, queue_client, config, delete, federation_id,
         job_id, job_schedule_id, all_jobs, all_jobschedules, force):
@@ -1641,7 +1889,8 @@ def delete_or_terminate_job_from_federation(
             'no {}s to {} in federation id {}'.format(
                 kind, method, federation_id))
         return
-    raw_output = {}
+    # confirm all actions prior to enqueuing any
+    confirmed = []
     for target in targets:
         # if terminate, check if job exists
         if not force and method == 'terminate':
@@ -1656,51 +1905,31 @@ def delete_or_terminate_job_from_federation(
                 msg='{} {} id {} in federation {}'.format(
                     method, kind, target, federation_id)):
             return
-        unique_id = uuid.uuid4()
-        rpath = 'messages/{}.pickle'.format(unique_id)
-        # upload message data to blob
-        info = {
-            'version': '1',
-            'action': {
-                'method': method,
-                'kind': kind,
-            },
-            kind: {
-                'id': target,
-            },
-        }
-        sas_url = pickle_and_upload(
-            blob_client, info, rpath, federation_id=federation_id)
-        # upsert unique id to sequence
-        while True:
-            entity = _retrieve_and_merge_sequence(
-                table_client, pk, unique_id, kind, target, False)
-            if _insert_or_merge_entity_with_etag(
-                    table_client, _STORAGE_CONTAINERS['table_federation_jobs'],
-                    entity):
-                logger.debug(
-                    'upserted {} {} sequence uid {} to federation {}'.format(
-                        kind, target, unique_id, federation_id))
-                break
-            else:
-                logger.debug(
-                    'conflict upserting {} {} sequence uid {} to '
-                    'federation {}'.format(
-                        kind, target, unique_id, federation_id))
-        # add queue message
-        msg = {
-            'version': '1',
-            'federation_id': federation_id,
-            'target': target,
-            'blob_data': sas_url,
-            'uuid': str(unique_id),
-        }
-        msg_data = json.dumps(msg, ensure_ascii=True, sort_keys=True)
-        contname = '{}-{}'.format(
-            _STORAGE_CONTAINERS['queue_federation'], fedhash)
-        queue_client.put_message(contname, msg_data, time_to_live=-1)
-        logger.debug('enqueued {} of {} {} for federation {}'.format(
-            method, kind, target, federation_id))
+        confirmed.append(target)
+    if len(confirmed) == 0:
+        return
+    # enqueue actions for targets concurrently, each target has a single
+    # action such that sequence order is not affected
+    futures = {}
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min((len(confirmed), _MAX_EXECUTOR_WORKERS))
+    ) as executor:
+        for target in confirmed:
+            futures[target] = executor.submit(
+                _enqueue_federation_action, blob_client, table_client,
+                queue_client, federation_id, fedhash, pk, kind, method,
+                target)
+    raw_output = {}
+    failed = 0
+    for target in confirmed:
+        try:
+            unique_id = futures[target].result()
+        except Exception as exc:
+            failed += 1
+            logger.error('could not enqueue {} of {} {} for federation '
+                         '{}: {}'.format(
+                             method, kind, target, federation_id, exc))
+            continue
         if settings.raw(config):
             raw_output[target] = {
                 'federation': {
@@ -1716,6 +1945,74 @@ def delete_or_terminate_job_from_federation(
             }
     if util.is_not_empty(raw_output):
         print(json.dumps(raw_output, indent=4, sort_keys=True))
+    if failed > 0:
+        raise RuntimeError(
+            'could not enqueue {} of {} {} actions for federation {}'.format(
+                failed, len(confirmed), method, federation_id))
+
+
+def _enqueue_federation_action(
+        blob_client, table_client, queue_client, federation_id, fedhash, pk,
+        kind, method, target):
+    # type: (azure.storage.blob.BlockBlobService,
+    #        azure.cosmosdb.TableService, azure.queue.QueueService, str, str,
+    #        str, str, str, str) -> uuid.UUID
+    """Enqueue a delete or terminate action for a target in a federation
+    :param azure.storage.blob.BlockBlobService blob_client: blob client
+    :param azure.cosmosdb.table.TableService table_client: table client
+    :param azure.storage.queue.QueueService queue_service: queue client
+    :param str federation_id: federation id
+    :param str fedhash: federation hash
+    :param str pk: partition key
+    :param str kind: kind
+    :param str method: action method
+    :param str target: target
+    :rtype: uuid.UUID
+    :return: unique id of action
+    """
+    unique_id = uuid.uuid4()
+    rpath = 'messages/{}.pickle'.format(unique_id)
+    # upload message data to blob
+    info = {
+        'version': '1',
+        'action': {
+            'method': method,
+            'kind': kind,
+        },
+        kind: {
+            'id': target,
+        },
+    }
+    sas_url = encode_and_upload_federation_payload(
+        blob_client, info, rpath, federation_id)
+    # upsert unique id to sequence
+    while True:
+        if _enqueue_sequence_id(
+                table_client, pk, unique_id, kind, target, False):
+            logger.debug(
+                'upserted {} {} sequence uid {} to federation {}'.format(
+                    kind, target, unique_id, federation_id))
+            break
+        else:
+            logger.debug(
+                'conflict upserting {} {} sequence uid {} to '
+                'federation {}'.format(
+                    kind, target, unique_id, federation_id))
+    # add queue message
+    msg = {
+        'version': '1',
+        'federation_id': federation_id,
+        'target': target,
+        'blob_data': sas_url,
+        'uuid': str(unique_id),
+    }
+    msg_data = json.dumps(msg, ensure_ascii=True, sort_keys=True)
+    contname = '{}-{}'.format(
+        _STORAGE_CONTAINERS['queue_federation'], fedhash)
+    queue_client.put_message(contname, msg_data, time_to_live=-1)
+    logger.debug('enqueued {} of {} {} for federation {}'.format(
+        method, kind, target, federation_id))
+    return unique_id
 
 
 def zap_unique_id_from_federation(
@@ -1747,7 +2044,7 @@ def zap_unique_id_from_federation(
 def create_slurm_partition(
         table_client, queue_client, config, cluster_id, partition_name,
         batch_service_url, pool_id, compute_node_type, max_compute_nodes,
-        hostlist):
+        hostlist, warm_buffer):
     partpool_hash = util.hash_string('{}-{}'.format(
         partition_name, batch_service_url, pool_id))
     # insert partition entity
@@ -1758,6 +2055,10 @@ def create_slurm_partition(
         'BatchPoolId': pool_id,
         'ComputeNodeType': compute_node_type,
         'HostList': hostlist,
+        'WarmBufferMinIdleNodes': warm_buffer.min_idle_nodes,
+        'WarmBufferMaxIdleNodes': warm_buffer.max_idle_nodes,
+        'WarmBufferLookbackInterval': int(
+            warm_buffer.lookback_interval.total_seconds()),
         'BatchShipyardSlurmVersion': 1,
     }
     logger.debug(
@@ -2121,6 +2422,54 @@ def clear_storage_containers(
             except azure.common.AzureMissingResourceHttpError:
                 if key != 'table_perf' or bs.store_timing_metrics:
                     raise
+            # clear peer registrations and image cache index for global
+            # resources
+            if key == 'table_globalresources':
+                clear_global_resource_image_distribution(
+                    table_client, config, pool_id=pool_id)
+
+
+def clear_global_resource_image_distribution(
+        table_client, config, pool_id=None, resources=None):
+    # type: (azuretable.TableService, dict, str, List[str]) -> None
+    """Clear peer registrations and image cache index for global resources
+    :param azure.cosmosdb.table.TableService table_client: table client
+    :param dict config: configuration dict
+    :param str pool_id: use specified pool id instead
+    :param list resources: only clear entries of these resources
+    """
+    pk = _construct_partition_key_from_config(config, pool_id=pool_id)
+    table_name = _STORAGE_CONTAINERS['table_globalresources']
+    for suffix in (
+            _GLOBAL_RESOURCES_PEERS_PK_SUFFIX,
+            _GLOBAL_RESOURCES_CACHE_PK_SUFFIX):
+        if resources is None:
+            _clear_table(
+                table_client, table_name, config,
+                pk='{}{}'.format(pk, suffix))
+            continue
+        for resource in resources:
+            # image cache row keys are the resource hash and peer row keys
+            # are suffixed with $nodeid, '%' sorts immediately after '$'
+            rhash = util.hash_string(resource)
+            logger.debug('clearing image distribution entries for {}'.format(
+                resource))
+            ents = table_client.query_entities(
+                table_name, filter=(
+                    'PartitionKey eq \'{}{}\' and RowKey ge \'{}\' and '
+                    'RowKey lt \'{}%\''
+                ).format(pk, suffix, rhash, rhash))
+            i = 0
+            bet = azuretable.TableBatch()
+            for ent in ents:
+                bet.delete_entity(ent['PartitionKey'], ent['RowKey'])
+                i += 1
+                if i == 100:
+                    table_client.commit_batch(table_name, bet)
+                    bet = azuretable.TableBatch()
+                    i = 0
+            if i > 0:
+                table_client.commit_batch(table_name, bet)
 
 
 def delete_or_clear_diagnostics_logs(blob_client, config, delete):
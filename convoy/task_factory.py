@@ -45,10 +45,15 @@ except ImportError:  # pramga: no cover
 # non-stdlib imports
 import azure.storage.blob as azureblob
 import azure.storage.file as azurefile
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
 # local imports
 
 # global defines
 _DEFAULT_SAS_EXPIRY_DAYS = 365 * 30
+_DEFAULT_VECTORIZED_BLOCK_SIZE = 65536
 # named tuples
 FileInfo = collections.namedtuple(
     'FileInfo', [
@@ -144,6 +149,127 @@ def _prepare_random_task_factory(task_factory):
     return rfunc
 
 
+def _prepare_vectorized_random_task_factory(task_factory):
+    # type: (dict) -> func
+    """Prepare the vectorized (numpy) random task factory
+    :param dict task_factory: task factory object
+    :rtype: func
+    :return: function accepting a numpy Generator and a block size which
+        returns a block of samples
+    """
+    if 'integer' in task_factory['random']:
+        start = task_factory['random']['integer']['start']
+        step = task_factory['random']['integer']['step']
+        count = len(range(
+            start, task_factory['random']['integer']['stop'], step))
+        if count == 0:
+            raise ValueError(
+                'empty range for random integer task factory: {}'.format(
+                    task_factory['random']['integer']))
+
+        def rfunc(rng, size):
+            return start + step * rng.integers(0, count, size=size)
+        return rfunc
+    dist = task_factory['random']['distribution']
+    if 'uniform' in dist:
+        return lambda rng, size: rng.uniform(
+            dist['uniform']['a'], dist['uniform']['b'], size=size)
+    elif 'triangular' in dist:
+        low = dist['triangular']['low']
+        high = dist['triangular']['high']
+        mode = dist['triangular'].get('mode')
+        if mode is None:
+            mode = (low + high) / 2.0
+        return lambda rng, size: rng.triangular(low, mode, high, size=size)
+    elif 'beta' in dist:
+        return lambda rng, size: rng.beta(
+            dist['beta']['alpha'], dist['beta']['beta'], size=size)
+    elif 'exponential' in dist:
+        # numpy is parameterized by scale rather than rate
+        return lambda rng, size: rng.exponential(
+            1.0 / dist['exponential']['lambda'], size=size)
+    elif 'gamma' in dist:
+        return lambda rng, size: rng.gamma(
+            dist['gamma']['alpha'], dist['gamma']['beta'], size=size)
+    elif 'gauss' in dist:
+        return lambda rng, size: rng.normal(
+            dist['gauss']['mu'], dist['gauss']['sigma'], size=size)
+    elif 'lognormal' in dist:
+        return lambda rng, size: rng.lognormal(
+            dist['lognormal']['mu'], dist['lognormal']['sigma'], size=size)
+    elif 'pareto' in dist:
+        # numpy draws from the Lomax distribution, shift to match the
+        # classical Pareto distribution with a minimum of 1
+        return lambda rng, size: rng.pareto(
+            dist['pareto']['alpha'], size=size) + 1.0
+    elif 'weibull' in dist:
+        # numpy only accepts the shape parameter, alpha is the scale
+        return lambda rng, size: dist['weibull']['alpha'] * rng.weibull(
+            dist['weibull']['beta'], size=size)
+    raise ValueError(
+        'unknown random distribution: {}'.format(dist))
+
+
+def _get_vectorized_random_substreams(task_factory, numgen):
+    # type: (dict, int) -> list
+    """Create deterministic random substreams for vectorized generation.
+    Each substream generates a contiguous range of tasks from an
+    independent child of the seed sequence, thus the values for any
+    substream can be regenerated in isolation (e.g., in parallel).
+    :param dict task_factory: task factory object
+    :param int numgen: total number of values to generate
+    :rtype: list
+    :return: list of (numpy.random.Generator, count) tuples
+    """
+    # vectorized may be specified without options
+    vec = task_factory['random']['vectorized'] or {}
+    nsub = vec.get('substreams')
+    if nsub is None:
+        nsub = 1
+    if nsub < 1:
+        raise ValueError(
+            'vectorized random substreams must be positive: {}'.format(nsub))
+    ss = numpy.random.SeedSequence(task_factory['random'].get('seed'))
+    counts = [numgen // nsub] * nsub
+    for i in range(numgen % nsub):
+        counts[i] += 1
+    return [
+        (numpy.random.default_rng(child), count)
+        for child, count in zip(ss.spawn(nsub), counts)
+    ]
+
+
+def _generate_vectorized_random_values(task_factory, numgen):
+    # type: (dict, int) -> object
+    """Generate random values in vectorized blocks
+    :param dict task_factory: task factory object
+    :param int numgen: number of values to generate
+    :rtype: object
+    :return: random value
+    """
+    if numpy is None:
+        raise RuntimeError(
+            'numpy is required for a vectorized random task_factory, please '
+            'install numpy (e.g., pip install numpy)')
+    block_size = (task_factory['random']['vectorized'] or {}).get(
+        'block_size')
+    if block_size is None:
+        block_size = _DEFAULT_VECTORIZED_BLOCK_SIZE
+    if block_size < 1:
+        raise ValueError(
+            'vectorized random block_size must be positive: {}'.format(
+                block_size))
+    rfunc = _prepare_vectorized_random_task_factory(task_factory)
+    for rng, count in _get_vectorized_random_substreams(
+            task_factory, numgen):
+        while count > 0:
+            size = min(count, block_size)
+            count -= size
+            # convert to native python types for command formatting
+            for val in rfunc(rng, size).tolist():
+                yield val
+
+
 def _inclusion_check(path, include, exclude):
     # type: (str, list, list) -> bool
     """Check file for inclusion against filters
@@ -400,12 +526,19 @@ def generate_task(task, storage_settings):
         except KeyError:
             raise ValueError(
                 'must specify a "generate" property for a random task_factory')
-        rfunc = _prepare_random_task_factory(task_factory)
-        # generate tasks using rfunc
-        for _ in range(0, numgen):
-            taskcopy = copy.copy(base_task_copy)
-            taskcopy['command'] = taskcopy['command'].format(rfunc())
-            yield taskcopy
+        if 'vectorized' in task_factory['random']:
+            for val in _generate_vectorized_random_values(
+                    task_factory, numgen):
+                taskcopy = copy.copy(base_task_copy)
+                taskcopy['command'] = taskcopy['command'].format(val)
+                yield taskcopy
+        else:
+            rfunc = _prepare_random_task_factory(task_factory)
+            # generate tasks using rfunc
+            for _ in range(0, numgen):
+                taskcopy = copy.copy(base_task_copy)
+                taskcopy['command'] = taskcopy['command'].format(rfunc())
+                yield taskcopy
     elif 'parametric_sweep' in task_factory:
         sweep = task['task_factory']['parametric_sweep']
         if 'product' in sweep:
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+# Copyright (c) Microsoft Corporation
+#
+# All rights reserved.
+#
+# MIT License
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""Benchmark federation payload size and encode/decode time against pickle.
+Run from the repository root: python3 federation/bench_federation_payload.py
+"""
+
+# stdlib imports
+import argparse
+import pathlib
+import pickle
+import sys
+import time
+from typing import Any, Callable, Dict, Tuple
+# non-stdlib imports
+import azure.batch.models as batchmodels
+# local imports
+import federation
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+from convoy import storage  # noqa
+
+
+def _create_task_map(ntasks: int) -> Dict[str, batchmodels.TaskAddParameter]:
+    """Create a task map with settings shared by all tasks, as generated by
+    a task factory
+    :param ntasks: number of tasks
+    :return: task map
+    """
+    task_map = {}
+    for i in range(ntasks):
+        task_id = 'task-{:06d}'.format(i)
+        task_map[task_id] = batchmodels.TaskAddParameter(
+            id=task_id,
+            command_line='/bin/bash -c "python3 train.py --shard {}"'.format(
+                i),
+            container_settings=batchmodels.TaskContainerSettings(
+                image_name='myregistry.azurecr.io/train:latest',
+                container_run_options='--rm --init --ipc=host',
+            ),
+            environment_settings=[
+                batchmodels.EnvironmentSetting(
+                    name='SHIPYARD_ENV_{}'.format(j), value=str(j))
+                for j in range(8)
+            ],
+            resource_files=[
+                batchmodels.ResourceFile(
+                    http_url='https://sa.blob.core.windows.net/data/'
+                    'input{}.bin'.format(j),
+                    file_path='input{}.bin'.format(j))
+                for j in range(4)
+            ],
+            constraints=batchmodels.TaskConstraints(
+                max_wall_clock_time='PT2H', max_task_retry_count=3),
+            user_identity=batchmodels.UserIdentity(
+                auto_user=batchmodels.AutoUserSpecification(
+                    scope=batchmodels.AutoUserScope.pool,
+                    elevation_level=batchmodels.ElevationLevel.admin)),
+        )
+    return task_map
+
+
+def _time(func: Callable, *args: Any) -> Tuple[Any, float]:
+    """Time a function call
+    :param func: function
+    :return: tuple of result and elapsed seconds
+    """
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main() -> None:
+    """Main function"""
+    args = parseargs()
+    info = {
+        'version': '1',
+        'action': {
+            'method': 'add',
+            'kind': 'job',
+        },
+        'task_map': _create_task_map(args.tasks),
+    }
+    print('{} tasks'.format(args.tasks))
+    print('{:<8} {:>12} {:>10} {:>10}'.format(
+        'format', 'bytes', 'encode', 'decode'))
+    for name, encode, decode in (
+            ('pickle',
+             lambda x: pickle.dumps(x, protocol=pickle.HIGHEST_PROTOCOL),
+             pickle.loads),
+            ('payload', storage.encode_federation_payload,
+             federation.decode_federation_payload),
+    ):
+        data, enc = _time(encode, info)
+        decoded, dec = _time(decode, data)
+        if len(decoded['task_map']) != args.tasks:
+            raise RuntimeError('{} round trip failed'.format(name))
+        print('{:<8} {:>12} {:>9.2f}s {:>9.2f}s'.format(
+            name, len(data), enc, dec))
+
+
+def parseargs() -> argparse.Namespace:
+    """Parse program arguments
+    :return: parsed arguments
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark federation payloads against pickle')
+    parser.add_argument(
+        '--tasks', type=int, default=100000, help='number of tasks')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
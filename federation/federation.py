@@ -27,7 +27,9 @@
 # stdlib imports
 import argparse
 import asyncio
+import collections
 import concurrent.futures
+import copy
 import datetime
 import hashlib
 import json
@@ -39,8 +41,12 @@ import pickle
 import random
 import subprocess
 import threading
+import time
+import urllib.parse
+import zlib
 from typing import (
     Any,
+    Callable,
     Dict,
     Generator,
     List,
@@ -58,6 +64,7 @@ import azure.mgmt.storage
 import azure.storage.blob
 import azure.storage.queue
 import dateutil.tz
+import msrest.serialization
 import msrestazure.azure_active_directory
 import msrestazure.azure_cloud
 
@@ -75,11 +82,21 @@ _GPU_INSTANCE_PREFIXES = frozenset((
     'standard_nc', 'standard_nd', 'standard_nv',
 ))
 _POOL_NATIVE_METADATA_NAME = 'BATCH_SHIPYARD_NATIVE_CONTAINER_POOL'
+_FEDERATION_PAYLOAD_MAGIC = b'BSFP'
+_FEDERATION_PAYLOAD_SCHEMA_VERSION = 1
+_PRIMITIVE_MODEL_TYPES = frozenset((
+    'bool', 'int', 'str',
+))
 # TODO allow these maximums to be configurable
 _MAX_EXECUTOR_WORKERS = min((multiprocessing.cpu_count() * 4, 32))
 _MAX_TIMESPAN_POOL_UPDATE = datetime.timedelta(seconds=60)
 _MAX_TIMESPAN_NODE_COUNTS_UPDATE = datetime.timedelta(seconds=10)
 _MAX_TIMESPAN_ACTIVE_TASKS_COUNT_UPDATE = datetime.timedelta(seconds=20)
+_MAX_TIMESPAN_STORAGE_ACCOUNTS_UPDATE = datetime.timedelta(minutes=10)
+_MAX_TIMESPAN_POOL_CAPACITY_ACCOUNT_IDLE = datetime.timedelta(minutes=5)
+_MIN_MESSAGE_VISIBILITY_TIMEOUT = 15
+_MAX_MESSAGE_VISIBILITY_TIMEOUT = 300
+_MAX_TASK_ID_CACHED_JOBS = 1024
 
 
 def _setup_logger(log) -> None:
@@ -146,6 +163,97 @@ def hash_federation_id(federation_id: str) -> str:
     return hash_string(federation_id)
 
 
+def _copy_model_value(value: Any) -> Any:
+    """Copy a model attribute value such that no models, lists or dicts
+    are shared with the original, which is significantly faster than a
+    deepcopy for Batch models
+    :param value: value to copy
+    :return: copied value
+    """
+    if isinstance(value, msrest.serialization.Model):
+        model = value.__class__.__new__(value.__class__)
+        model.__dict__ = {
+            key: (
+                _copy_model_value(x)
+                if isinstance(x, (msrest.serialization.Model, list, dict))
+                else x
+            ) for key, x in value.__dict__.items()
+        }
+        return model
+    elif isinstance(value, list):
+        return [_copy_model_value(x) for x in value]
+    elif isinstance(value, dict):
+        return {key: _copy_model_value(value[key]) for key in value}
+    return value
+
+
+def _decode_federation_payload_object(obj: Any) -> Any:
+    """Decode an object in a federation payload
+    :param obj: object to decode
+    :return: decoded object
+    """
+    if isinstance(obj, dict):
+        if '$model' in obj:
+            return getattr(batchmodels, obj['$model']).deserialize(
+                obj['$value'])
+        elif '$models' in obj:
+            cls = getattr(batchmodels, obj['$models'])
+            deserializer = msrest.serialization.Deserializer(
+                cls._infer_class_models())
+            attrs = {
+                spec['key']: (attr, spec['type'])
+                for attr, spec in cls._attribute_map.items()
+            }
+            shared = cls.deserialize(obj['$shared'])
+            # shared values which are models or collections are copied per
+            # model so that models never share mutable state
+            mutable = [
+                (attr, spec['key'])
+                for attr, spec in cls._attribute_map.items()
+                if (getattr(shared, attr) is not None and
+                    spec['type'] not in _PRIMITIVE_MODEL_TYPES)
+            ]
+            models = {}
+            for key, delta in zip(obj['$keys'], obj['$values']):
+                model = copy.copy(shared)
+                for attr, wire_key in mutable:
+                    if wire_key not in delta:
+                        setattr(model, attr, _copy_model_value(
+                            getattr(shared, attr)))
+                for wire_key in delta:
+                    attr, type_ = attrs[wire_key]
+                    value = delta[wire_key]
+                    if (value is not None and
+                            type_ not in _PRIMITIVE_MODEL_TYPES):
+                        value = deserializer.deserialize_data(value, type_)
+                    setattr(model, attr, value)
+                models[key] = model
+            return models
+        return {
+            key: _decode_federation_payload_object(obj[key]) for key in obj
+        }
+    elif isinstance(obj, list):
+        return [_decode_federation_payload_object(x) for x in obj]
+    return obj
+
+
+def decode_federation_payload(data: bytes) -> Dict[str, Any]:
+    """Decode federation action data
+    :param data: encoded data
+    :return: decoded data
+    """
+    magic_len = len(_FEDERATION_PAYLOAD_MAGIC)
+    if data[:magic_len] != _FEDERATION_PAYLOAD_MAGIC:
+        # messages enqueued by older clients are pickled
+        return pickle.loads(data, fix_imports=True)
+    version = data[magic_len]
+    if version != _FEDERATION_PAYLOAD_SCHEMA_VERSION:
+        raise ValueError(
+            'unknown federation payload schema version: {}'.format(version))
+    return _decode_federation_payload_object(
+        json.loads(zlib.decompress(data[magic_len + 1:]).decode('utf8')))
+
+
 def is_rdma_pool(vm_size: str) -> bool:
     """Check if pool is IB/RDMA capable
     :param vm_size: vm size
@@ -257,6 +365,20 @@ class TaskNaming():
         self.padding = naming.get('padding')
 
 
+class PlacementOptions():
+    def __init__(self, options: Dict[str, Any]) -> None:
+        self.policy = options.get('policy', 'greedy')
+        weights = options.get('weights', {})
+        self.fit_weight = float(weights.get('fit', 1.0))
+        self.backlog_weight = float(weights.get('backlog', 1.0))
+        self.locality_weight = float(weights.get('locality', 1.0))
+        self.price_weight = float(weights.get('price', 0.0))
+        self.vm_prices = {
+            k.lower(): float(v)
+            for k, v in options.get('vm_prices', {}).items()
+        }
+
+
 class Credentials():
     def __init__(self, config: Dict[str, Any]) -> None:
         """Ctor for Credentials
@@ -372,10 +494,25 @@ class ServiceProxy():
         self.file_share_logging = '{}fedlogs'.format(prefix)
         self._batch_client_lock = threading.Lock()
         self.batch_clients = {}
+        try:
+            self.max_concurrent_actions = int(config['concurrency'].get(
+                'max_actions', 16))
+        except KeyError:
+            self.max_concurrent_actions = 16
+        # bounded executor for blocking service calls issued from
+        # coroutines, sized to allow each concurrent action an outstanding
+        # call in addition to fan-out within actions
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max((
+                self.max_concurrent_actions, _MAX_EXECUTOR_WORKERS)))
         # create credentials
         self.creds = Credentials(config)
         # create clients
         self.compute_client = self._create_compute_client()
+        self.storage_mgmt_client = self._create_storage_mgmt_client()
+        self._storage_account_locations_lock = threading.Lock()
+        self._storage_account_locations = {}
+        self._storage_account_locations_last_update = None
         self.blob_client = self._create_blob_client()
         self.table_client = self._create_table_client()
         self.queue_client = self._create_queue_client()
@@ -410,6 +547,16 @@ class ServiceProxy():
         logger.debug('configuration: {}'.format(
             json.dumps(self._config, sort_keys=True, indent=4)))
 
+    async def run_blocking(self, func, *args) -> Any:
+        """Run a blocking service call on the executor such that the
+        event loop is not blocked
+        :param func: function to call
+        :param args: function arguments
+        :return: function result
+        """
+        return await asyncio.get_event_loop().run_in_executor(
+            self.executor, func, *args)
+
     def _modify_client_for_retry_and_user_agent(self, client: Any) -> None:
         """Extend retry policy of clients and add user agent string
         :param client: a client object
@@ -464,6 +611,38 @@ class ServiceProxy():
             base_url=self.creds.cloud.endpoints.resource_manager)
         return client
 
+    def _create_storage_mgmt_client(
+            self
+    ) -> azure.mgmt.storage.StorageManagementClient:
+        """Create a storage mgmt client
+        :return: storage mgmt client
+        """
+        client = azure.mgmt.storage.StorageManagementClient(
+            self.creds.arm_creds, self.creds.sub_id,
+            base_url=self.creds.cloud.endpoints.resource_manager)
+        return client
+
+    def get_storage_account_locations(self) -> Dict[str, str]:
+        """Get locations of storage accounts in the subscription
+        :return: map of storage account name to location
+        """
+        with self._storage_account_locations_lock:
+            if (self._storage_account_locations_last_update is not None and
+                    (datetime_utcnow() -
+                     self._storage_account_locations_last_update) <
+                    _MAX_TIMESPAN_STORAGE_ACCOUNTS_UPDATE):
+                return self._storage_account_locations
+            client = self.storage_mgmt_client
+            try:
+                self._storage_account_locations = {
+                    acct.name: acct.location.lower()
+                    for acct in client.storage_accounts.list()
+                }
+            except Exception as exc:
+                logger.exception(str(exc))
+            self._storage_account_locations_last_update = datetime_utcnow()
+            return self._storage_account_locations
+
     def batch_client(
             self,
             batch_account: str,
@@ -534,6 +713,11 @@ class BatchServiceHandler():
         :param service_proxy: ServiceProxy
         """
         self.service_proxy = service_proxy
+        self._task_id_lock = threading.Lock()
+        # bounded lru of (batch account, job id) -> prefix -> next task num
+        # as jobs which complete normally are never invalidated
+        self._next_task_nums = collections.OrderedDict()
+        self.capacity_cache = PoolCapacityCache(self)
 
     def get_pool_full_update(
             self,
@@ -548,31 +732,22 @@ class BatchServiceHandler():
             pass
         return None
 
-    def get_node_state_counts(
+    def list_pool_node_counts(
             self,
             batch_account: str,
             service_url: str,
-            pool_id: str,
-    ) -> batchmodels.PoolNodeCounts:
+    ) -> Optional[Dict[str, batchmodels.PoolNodeCounts]]:
         client = self.service_proxy.batch_client(batch_account, service_url)
         try:
-            node_counts = client.account.list_pool_node_counts(
-                account_list_pool_node_counts_options=batchmodels.
-                AccountListPoolNodeCountsOptions(
-                    filter='poolId eq \'{}\''.format(pool_id)
-                )
-            )
-            nc = list(node_counts)
-            if len(nc) == 0:
-                logger.error(
-                    'no node counts for pool {} (account={} '
-                    'service_url={})'.format(
-                        pool_id, batch_account, service_url))
-            return nc[0]
+            return {
+                nc.pool_id: nc
+                for nc in client.account.list_pool_node_counts()
+            }
         except batchmodels.BatchErrorException:
             logger.error(
-                'could not retrieve pool {} node counts (account={} '
-                'service_url={})'.format(pool_id, batch_account, service_url))
+                'could not retrieve pool node counts (account={} '
+                'service_url={})'.format(batch_account, service_url))
+        return None
 
     def immediately_evaluate_autoscale(
             self,
@@ -632,6 +807,7 @@ class BatchServiceHandler():
     ) -> None:
         client = self.service_proxy.batch_client(batch_account, service_url)
         client.job.add(job)
+        self.invalidate_generic_task_ids(batch_account, job.id)
 
     async def delete_or_terminate_job(
             self,
@@ -649,14 +825,17 @@ class BatchServiceHandler():
         )
         client = self.service_proxy.batch_client(batch_account, service_url)
         iface = client.job_schedule if is_job_schedule else client.job
+        if not is_job_schedule:
+            self.invalidate_generic_task_ids(batch_account, job_id)
         logger.debug('{} {} {} (account={} service_url={})'.format(
             action, 'job schedule' if is_job_schedule else 'job',
             job_id, batch_account, service_url))
         try:
             if delete:
-                iface.delete(job_id)
+                await self.service_proxy.run_blocking(iface.delete, job_id)
             else:
-                iface.terminate(job_id)
+                await self.service_proxy.run_blocking(
+                    iface.terminate, job_id)
         except batchmodels.BatchErrorException as exc:
             if delete:
                 if ('does not exist' in exc.message.value or
@@ -671,7 +850,8 @@ class BatchServiceHandler():
         if wait:
             while True:
                 try:
-                    _job = iface.get(job_id)
+                    _job = await self.service_proxy.run_blocking(
+                        iface.get, job_id)
                     if _job.state == cstate:
                         break
                 except batchmodels.BatchErrorException as exc:
@@ -691,6 +871,50 @@ class BatchServiceHandler():
         """
         return '{}{}'.format(prefix, str(tasknum).zfill(padding))
 
+    def invalidate_generic_task_ids(
+            self,
+            batch_account: str,
+            job_id: str
+    ) -> None:
+        """Invalidate cached next generic task numbers for a job
+        :param batch_account: batch account
+        :param job_id: job id
+        """
+        with self._task_id_lock:
+            self._next_task_nums.pop((batch_account, job_id), None)
+
+    def _get_next_generic_task_num(
+            self,
+            client: azure.batch.BatchServiceClient,
+            job_id: str,
+            prefix: str,
+    ) -> int:
+        """Get the next generic task number from the tasks in a job
+        :param client: batch client
+        :param job_id: job id
+        :param prefix: task id prefix
+        :return: next generic task number
+        """
+        delimiter = prefix if is_not_empty(prefix) else ' '
+        try:
+            tasks = client.task.list(
+                job_id,
+                task_list_options=batchmodels.TaskListOptions(
+                    filter='startswith(id, \'{}\')'.format(prefix)
+                    if is_not_empty(prefix) else None,
+                    select='id'))
+            tasknum = -1
+            for task in tasks:
+                try:
+                    num = int(task.id.split(delimiter)[-1])
+                except ValueError:
+                    continue
+                if num > tasknum:
+                    tasknum = num
+            return tasknum + 1
+        except batchmodels.BatchErrorException:
+            return 0
+
     def regenerate_next_generic_task_id(
             self,
             batch_account: str,
@@ -698,58 +922,45 @@ class BatchServiceHandler():
             job_id: str,
             naming: TaskNaming,
             current_task_id: str,
-            last_task_id: Optional[str] = None,
-            tasklist: Optional[List[str]] = None,
             is_merge_task: Optional[bool] = False
-    ) -> Tuple[List[str], str]:
-        """Regenerate the next generic task id
+    ) -> str:
+        """Regenerate the next generic task id. Next task numbers are
+        retrieved from the job once and then allocated from memory.
         :param batch_account: batch account
         :param service_url: service url
         :param job_id: job id
         :param naming: naming convention
         :param current_task_id: current task id
-        :param tasklist: list of committed and uncommitted tasks in job
         :param is_merge_task: is merge task
-        :return: (list of task ids for job, next generic docker task id)
+        :return: next generic docker task id
         """
         # get prefix and padding settings
         prefix = naming.prefix
         if is_merge_task:
             prefix = 'merge-{}'.format(prefix)
         if not current_task_id.startswith(prefix):
-            return tasklist, current_task_id
-        delimiter = prefix if is_not_empty(prefix) else ' '
-        client = self.service_proxy.batch_client(batch_account, service_url)
-        # get filtered, sorted list of generic docker task ids
-        try:
-            if tasklist is None:
-                tasklist = client.task.list(
-                    job_id,
-                    task_list_options=batchmodels.TaskListOptions(
-                        filter='startswith(id, \'{}\')'.format(prefix)
-                        if is_not_empty(prefix) else None,
-                        select='id'))
-                tasklist = [x.id for x in tasklist]
-            tasknum = sorted(
-                [int(x.split(delimiter)[-1]) for x in tasklist])[-1] + 1
-        except (batchmodels.BatchErrorException, IndexError, TypeError):
-            tasknum = 0
-        id = self._format_generic_task_id(prefix, naming.padding, tasknum)
-        while id in tasklist:
-            try:
-                if (last_task_id is not None and
-                        last_task_id.startswith(prefix)):
-                    tasknum = int(last_task_id.split(delimiter)[-1])
-                    last_task_id = None
-            except Exception:
-                last_task_id = None
-            tasknum += 1
-            id = self._format_generic_task_id(prefix, naming.padding, tasknum)
-        return tasklist, id
+            return current_task_id
+        key = (batch_account, job_id)
+        with self._task_id_lock:
+            tasknum = self._next_task_nums.get(key, {}).get(prefix)
+        if tasknum is None:
+            client = self.service_proxy.batch_client(
+                batch_account, service_url)
+            tasknum = self._get_next_generic_task_num(client, job_id, prefix)
+        with self._task_id_lock:
+            nums = self._next_task_nums.setdefault(key, {})
+            self._next_task_nums.move_to_end(key)
+            tasknum = max((tasknum, nums.get(prefix, 0)))
+            nums[prefix] = tasknum + 1
+            # evicted jobs are re-read from the job on next use
+            while len(self._next_task_nums) > _MAX_TASK_ID_CACHED_JOBS:
+                self._next_task_nums.popitem(last=False)
+        return self._format_generic_task_id(prefix, naming.padding, tasknum)
 
     def _submit_task_sub_collection(
             self,
             client: azure.batch.BatchServiceClient,
+            batch_account: str,
             job_id: str,
             start: int,
             end: int,
@@ -759,6 +970,7 @@ class BatchServiceHandler():
     ) -> bool:
         """Submits a sub-collection of tasks, do not call directly
         :param client: batch client
+        :param batch_account: batch account
         :param job_id: job to add to
         :param start: start offset, includsive
         :param end: end offset, exclusive
@@ -811,6 +1023,11 @@ class BatchServiceHandler():
                                      ' '.join(de) if de is not None else '',
                                      job_id))
                             ret = False
+                            if result.error.code == 'TaskExists':
+                                # task ids were allocated from a stale view
+                                # of the job, refresh on next submission
+                                self.invalidate_generic_task_ids(
+                                    batch_account, job_id)
                         elif (result.status ==
                               batchmodels.TaskAddStatus.server_error):
                             retry.append(task_map[result.task_id])
@@ -858,8 +1075,8 @@ class BatchServiceHandler():
                 if end > num_tasks:
                     end = num_tasks
                 task_futures.append(executor.submit(
-                    self._submit_task_sub_collection, client, job_id, start,
-                    end, end - start, all_tasks, task_map))
+                    self._submit_task_sub_collection, client, batch_account,
+                    job_id, start, end, end - start, all_tasks, task_map))
         # throw exceptions from any failure
         try:
             errors = any(not x.result() for x in task_futures)
@@ -893,48 +1110,251 @@ class BatchServiceHandler():
         )
         logger.debug('set auto-completion for job {}'.format(job_id))
 
-    def aggregate_active_task_count_on_pool(
+    def aggregate_active_task_counts_by_pool(
             self,
             batch_account: str,
             service_url: str,
-            pool_id: str,
-    ) -> int:
-        total_active = 0
+    ) -> Optional[Dict[str, int]]:
         client = self.service_proxy.batch_client(batch_account, service_url)
         try:
-            jobs = list(client.job.list(
-                job_list_options=batchmodels.JobListOptions(
-                    filter='(state eq \'active\') and (executionInfo/poolId '
-                    'eq \'{}\')'.format(pool_id),
-                    select='id',
-                ),
-            ))
+            jobs = [
+                job for job in client.job.list(
+                    job_list_options=batchmodels.JobListOptions(
+                        filter='state eq \'active\'',
+                        select='id,executionInfo',
+                    ),
+                )
+                if job.execution_info is not None and
+                is_not_empty(job.execution_info.pool_id)
+            ]
         except batchmodels.BatchErrorException as exc:
             logger.exception(str(exc))
-        else:
-            if len(jobs) == 0:
-                return total_active
-            tc_futures = []
-            with concurrent.futures.ThreadPoolExecutor(
-                    max_workers=max_workers_for_executor(jobs)) as executor:
-                for job in jobs:
-                    tc_futures.append(executor.submit(
-                        client.job.get_task_counts, job.id))
-            for tc in tc_futures:
-                try:
-                    total_active += tc.result().active
-                except Exception as exc:
-                    logger.exception(str(exc))
+            return None
+        total_active = {}
+        if len(jobs) == 0:
+            return total_active
+        tc_futures = []
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_workers_for_executor(jobs)) as executor:
+            for job in jobs:
+                tc_futures.append(executor.submit(
+                    client.job.get_task_counts, job.id))
+        for job, tc in zip(jobs, tc_futures):
+            pool_id = job.execution_info.pool_id
+            try:
+                total_active[pool_id] = (
+                    total_active.get(pool_id, 0) + tc.result().active
+                )
+            except Exception as exc:
+                logger.exception(str(exc))
         return total_active
 
 
+class PoolCapacityCache():
+    def __init__(self, bsh: BatchServiceHandler) -> None:
+        """Ctor for PoolCapacityCache, a cache of node state and active
+        task counts for all pools in a Batch account, refreshed with
+        account-level calls such that reads for placement are served
+        from memory
+        :param bsh: batch service handler
+        """
+        self._bsh = bsh
+        self._lock = threading.Lock()
+        self._account_locks = {}  # type: Dict[str, threading.Lock]
+        self._service_urls = {}  # type: Dict[str, str]
+        self._last_access = {}  # type: Dict[str, datetime.datetime]
+        self._next_refresh = {}  # type: Dict[str, datetime.datetime]
+        self._node_counts = {}  # type: Dict[str, Dict[str, batchmodels.PoolNodeCounts]]  # noqa
+        self._node_counts_last_update = {}  # type: Dict[str, datetime.datetime]  # noqa
+        self._active_tasks = {}  # type: Dict[str, Dict[str, int]]
+        self._active_tasks_last_update = {}  # type: Dict[str, datetime.datetime]  # noqa
+
+    def _account_lock(
+            self,
+            batch_account: str,
+            service_url: str,
+            access: bool = True,
+    ) -> threading.Lock:
+        """Get the lock serializing refreshes of an account
+        :param batch_account: batch account
+        :param service_url: service url
+        :param access: record the account as read from
+        :return: account lock
+        """
+        with self._lock:
+            if access:
+                self._service_urls[batch_account] = service_url
+                self._last_access[batch_account] = datetime_utcnow()
+            try:
+                return self._account_locks[batch_account]
+            except KeyError:
+                lock = threading.Lock()
+                self._account_locks[batch_account] = lock
+                return lock
+
+    @staticmethod
+    def _requires_update(
+            last_update: Optional[datetime.datetime],
+            max_timespan: datetime.timedelta,
+    ) -> bool:
+        return (
+            last_update is None or
+            (datetime_utcnow() - last_update) > max_timespan
+        )
+
+    def _refresh_node_counts(
+            self,
+            batch_account: str,
+            service_url: str,
+    ) -> None:
+        """Refresh node counts of all pools in an account. This function
+        should be called with the account lock held!
+        :param batch_account: batch account
+        :param service_url: service url
+        """
+        node_counts = self._bsh.list_pool_node_counts(
+            batch_account, service_url)
+        if node_counts is None:
+            return
+        with self._lock:
+            self._node_counts[batch_account] = node_counts
+            self._node_counts_last_update[batch_account] = datetime_utcnow()
+
+    def _refresh_active_tasks(
+            self,
+            batch_account: str,
+            service_url: str,
+    ) -> None:
+        """Refresh active task counts of all pools in an account. This
+        function should be called with the account lock held!
+        :param batch_account: batch account
+        :param service_url: service url
+        """
+        active_tasks = self._bsh.aggregate_active_task_counts_by_pool(
+            batch_account, service_url)
+        if active_tasks is None:
+            return
+        with self._lock:
+            self._active_tasks[batch_account] = active_tasks
+            self._active_tasks_last_update[batch_account] = datetime_utcnow()
+
+    def get_node_counts(
+            self,
+            batch_account: str,
+            service_url: str,
+            pool_id: str,
+    ) -> Optional[batchmodels.PoolNodeCounts]:
+        """Get node counts of a pool, refreshing the account if the
+        background refresh has fallen behind
+        :param batch_account: batch account
+        :param service_url: service url
+        :param pool_id: pool id
+        :return: pool node counts
+        """
+        with self._account_lock(batch_account, service_url):
+            if self._requires_update(
+                    self._node_counts_last_update.get(batch_account),
+                    _MAX_TIMESPAN_NODE_COUNTS_UPDATE):
+                self._refresh_node_counts(batch_account, service_url)
+        with self._lock:
+            node_counts = self._node_counts.get(batch_account, {}).get(
+                pool_id)
+        if node_counts is None:
+            logger.error(
+                'no node counts for pool {} (account={} '
+                'service_url={})'.format(pool_id, batch_account, service_url))
+        return node_counts
+
+    def get_active_tasks_count(
+            self,
+            batch_account: str,
+            service_url: str,
+            pool_id: str,
+    ) -> int:
+        """Get the number of active tasks on a pool, refreshing the account
+        if the background refresh has fallen behind. Accounts are only
+        refreshed for active task counts once requested.
+        :param batch_account: batch account
+        :param service_url: service url
+        :param pool_id: pool id
+        :return: active tasks count
+        """
+        with self._account_lock(batch_account, service_url):
+            if self._requires_update(
+                    self._active_tasks_last_update.get(batch_account),
+                    _MAX_TIMESPAN_ACTIVE_TASKS_COUNT_UPDATE):
+                self._refresh_active_tasks(batch_account, service_url)
+        with self._lock:
+            return self._active_tasks.get(batch_account, {}).get(pool_id, 0)
+
+    def record_tasks_scheduled(
+            self,
+            batch_account: str,
+            pool_id: str,
+            num_tasks: int,
+    ) -> None:
+        """Account for tasks added to a pool by the proxy until the next
+        refresh and expedite the next refresh of the account
+        :param batch_account: batch account
+        :param pool_id: pool id
+        :param num_tasks: number of tasks added
+        """
+        with self._lock:
+            active_tasks = self._active_tasks.get(batch_account)
+            if active_tasks is not None and num_tasks > 0:
+                active_tasks[pool_id] = (
+                    active_tasks.get(pool_id, 0) + num_tasks
+                )
+            if batch_account in self._next_refresh:
+                self._next_refresh[batch_account] = datetime_utcnow()
+
+    def accounts_due_for_refresh(self) -> List[Tuple[str, str]]:
+        """Get accounts due for a background refresh, forgetting accounts
+        which have not been read from recently
+        :return: list of batch account and service url tuples
+        """
+        now = datetime_utcnow()
+        due = []
+        with self._lock:
+            for batch_account in list(self._service_urls.keys()):
+                if (now - self._last_access[batch_account] >
+                        _MAX_TIMESPAN_POOL_CAPACITY_ACCOUNT_IDLE):
+                    self._service_urls.pop(batch_account)
+                    self._next_refresh.pop(batch_account, None)
+                    continue
+                next_refresh = self._next_refresh.get(batch_account)
+                if next_refresh is None or now >= next_refresh:
+                    due.append(
+                        (batch_account, self._service_urls[batch_account]))
+        return due
+
+    def refresh(self, batch_account: str, service_url: str) -> None:
+        """Refresh an account ahead of reads. The next refresh is
+        scheduled at a random point in the first half of the cache
+        lifetime such that accounts are refreshed staggered in time.
+        :param batch_account: batch account
+        :param service_url: service url
+        """
+        with self._account_lock(batch_account, service_url, access=False):
+            self._refresh_node_counts(batch_account, service_url)
+            if (batch_account in self._active_tasks and
+                    self._requires_update(
+                        self._active_tasks_last_update.get(batch_account),
+                        _MAX_TIMESPAN_ACTIVE_TASKS_COUNT_UPDATE / 2)):
+                self._refresh_active_tasks(batch_account, service_url)
+        with self._lock:
+            self._next_refresh[batch_account] = (
+                datetime_utcnow() + _MAX_TIMESPAN_NODE_COUNTS_UPDATE *
+                random.uniform(0.25, 0.5)
+            )
+
+
 class FederationDataHandler():
     _GLOBAL_LOCK_BLOB = 'global.lock'
     _ALL_FEDERATIONS_PK = '!!FEDERATIONS'
     _FEDERATION_ACTIONS_PREFIX_PK = '!!ACTIONS'
     _BLOCKED_FEDERATION_ACTIONS_PREFIX_PK = '!!ACTIONS.BLOCKED'
     _MAX_SEQUENCE_ID_PROPERTIES = 15
-    _MAX_SEQUENCE_IDS_PER_PROPERTY = 975
     _MAX_STR_ENTITY_PROPERTY_LENGTH = 32174
 
     def __init__(self, service_proxy: ServiceProxy) -> None:
@@ -954,6 +1374,13 @@ class FederationDataHandler():
                 'scheduling']['after_success']['evaluate_autoscale']
         except KeyError:
             self.scheduling_evaluate_autoscale = True
+        try:
+            self.placement_options = PlacementOptions(
+                self.service_proxy._config['scheduling']['placement'])
+        except KeyError:
+            self.placement_options = PlacementOptions({})
+        self.placement_engine = create_placement_engine(
+            self.placement_options)
 
     @property
     def has_global_lock(self) -> bool:
@@ -963,6 +1390,13 @@ class FederationDataHandler():
         self,
         loop: asyncio.BaseEventLoop,
     ) -> None:
+        # acquire or renew on the default executor rather than the service
+        # executor so that renewal is not queued behind action processing
+        future = loop.run_in_executor(None, self._acquire_or_renew_lease)
+        future.add_done_callback(
+            lambda _: loop.call_later(5, self.lease_global_lock, loop))
+
+    def _acquire_or_renew_lease(self) -> None:
         try:
             if self.lease_id is None:
                 logger.debug('acquiring blob lease on {}'.format(
@@ -983,7 +1417,6 @@ class FederationDataHandler():
         if self.lease_id is None:
             logger.error('could not acquire/renew lease on {}'.format(
                 self._GLOBAL_LOCK_BLOB))
-        loop.call_later(5, self.lease_global_lock, loop)
 
     def release_global_lock(self) -> None:
         if self.lease_id is not None:
@@ -1205,6 +1638,74 @@ class FederationDataHandler():
         except azure.common.AzureMissingResourceHttpError:
             pass
 
+    def _commit_location_entity_batches(
+            self,
+            entities: List[Dict[str, Any]],
+            add_op: Callable[[Any, Dict[str, Any]], None],
+            fallback: Callable[[Dict[str, Any]], None],
+    ) -> None:
+        """Apply an operation to location entities of a job, which share a
+        partition, in entity group transactions
+        :param entities: location entities
+        :param add_op: add the operation for an entity to a batch
+        :param fallback: apply the operation to a single entity
+        """
+        for i in range(0, len(entities), 100):
+            chunk = entities[i:i + 100]
+            tb = azure.cosmosdb.table.TableBatch()
+            for entity in chunk:
+                add_op(tb, entity)
+            try:
+                self.service_proxy.table_client.commit_batch(
+                    self.service_proxy.table_name_jobs, tb)
+            except azure.common.AzureHttpError as ex:
+                if ex.status_code != 404:
+                    raise
+                # an entity was removed concurrently, the transaction is
+                # rolled back in its entirety
+                for entity in chunk:
+                    fallback(entity)
+
+    def delete_location_entities_for_job(
+            self,
+            entities: List[Dict[str, Any]],
+    ) -> None:
+        self._commit_location_entity_batches(
+            entities,
+            lambda tb, entity: tb.delete_entity(
+                entity['PartitionKey'], entity['RowKey']),
+            self.delete_location_entity_for_job)
+
+    def _set_terminate_timestamp_for_location_entity(
+            self,
+            entity: Dict[str, Any],
+    ) -> None:
+        try:
+            self.service_proxy.table_client.merge_entity(
+                self.service_proxy.table_name_jobs, {
+                    'PartitionKey': entity['PartitionKey'],
+                    'RowKey': entity['RowKey'],
+                    'TerminateTimestamp': entity['TerminateTimestamp'],
+                })
+        except azure.common.AzureMissingResourceHttpError:
+            pass
+
+    def set_terminate_timestamp_for_location_entities(
+            self,
+            entities: List[Dict[str, Any]],
+    ) -> None:
+        now = datetime_utcnow(as_string=False)
+        for entity in entities:
+            entity['TerminateTimestamp'] = now
+        self._commit_location_entity_batches(
+            entities,
+            lambda tb, entity: tb.merge_entity({
+                'PartitionKey': entity['PartitionKey'],
+                'RowKey': entity['RowKey'],
+                'TerminateTimestamp': entity['TerminateTimestamp'],
+            }),
+            self._set_terminate_timestamp_for_location_entity)
+
     def get_all_location_entities_for_job(
             self,
             fedhash: str,
@@ -1219,115 +1720,181 @@ class FederationDataHandler():
         except azure.common.AzureMissingResourceHttpError:
             return None
 
-    def delete_action_entity_for_job(
-            self,
-            entity: Dict[str, Any],
-    ) -> None:
-        try:
-            self.service_proxy.table_client.delete_entity(
-                self.service_proxy.table_name_jobs, entity['PartitionKey'],
-                entity['RowKey'], if_match=entity['etag'])
-        except azure.common.AzureMissingResourceHttpError:
-            pass
-
     def get_messages_from_federation_queue(
             self,
-            fedhash: str
+            fedhash: str,
+            visibility_timeout: int,
     ) -> List[azure.storage.queue.models.QueueMessage]:
         queue_name = '{}-{}'.format(
             self.service_proxy.queue_prefix, fedhash)
         return self.service_proxy.queue_client.get_messages(
-            queue_name, num_messages=32, visibility_timeout=1)
+            queue_name, num_messages=32,
+            visibility_timeout=visibility_timeout)
+
+    def update_message_visibility_in_federation_queue(
+            self,
+            fedhash: str,
+            msg_id: str,
+            pop_receipt: str,
+            visibility_timeout: int,
+    ) -> str:
+        queue_name = '{}-{}'.format(
+            self.service_proxy.queue_prefix, fedhash)
+        msg = self.service_proxy.queue_client.update_message(
+            queue_name, msg_id, pop_receipt, visibility_timeout)
+        return msg.pop_receipt
+
+    def delete_message_from_federation_queue(
+            self,
+            fedhash: str,
+            msg_id: str,
+            pop_receipt: str,
+    ) -> None:
+        queue_name = '{}-{}'.format(
+            self.service_proxy.queue_prefix, fedhash)
+        self.service_proxy.queue_client.delete_message(
+            queue_name, msg_id, pop_receipt)
+
+    @staticmethod
+    def _sequence_entry_row_key(rk: str, index: int) -> str:
+        return '{}${:020d}'.format(rk, index)
+
+    def _migrate_legacy_sequence(
+            self,
+            entity: azure.cosmosdb.table.Entity,
+    ) -> None:
+        """Convert an action sequence stored as comma-joined unique ids
+        across sequence properties to sequence entries
+        :param entity: target entity
+        """
+        table_name = self.service_proxy.table_name_jobs
+        pk = entity['PartitionKey']
+        rk = entity['RowKey']
+        seq = []
+        for i in range(0, self._MAX_SEQUENCE_ID_PROPERTIES):
+            prop = 'Sequence{}'.format(i)
+            if prop in entity and is_not_empty(entity[prop]):
+                seq.extend(entity[prop].split(','))
+        # entries are written idempotently prior to the target such that
+        # a concurrent migration yields the same entries
+        tb = azure.cosmosdb.table.TableBatch()
+        for index, uid in enumerate(seq):
+            tb.insert_or_replace_entity({
+                'PartitionKey': pk,
+                'RowKey': self._sequence_entry_row_key(rk, index),
+                'UniqueId': uid,
+            })
+            if (index + 1) % 100 == 0:
+                self.service_proxy.table_client.commit_batch(table_name, tb)
+                tb = azure.cosmosdb.table.TableBatch()
+        if len(seq) % 100 != 0:
+            self.service_proxy.table_client.commit_batch(table_name, tb)
+        try:
+            self.service_proxy.table_client.update_entity(
+                table_name, entity={
+                    'PartitionKey': pk,
+                    'RowKey': rk,
+                    'Kind': entity['Kind'],
+                    'Id': entity['Id'],
+                    'SequenceHead': 0,
+                    'SequenceTail': len(seq),
+                }, if_match=entity['etag'])
+        except azure.common.AzureHttpError as ex:
+            if ex.status_code not in (404, 412):
+                raise
+        logger.debug('migrated sequence of {} uids for target {}'.format(
+            len(seq), entity['Id']))
 
     def _get_sequence_entity_for_job(
             self,
             fedhash: str,
             job_id: str
     ) -> azure.cosmosdb.table.Entity:
-        return self.service_proxy.table_client.get_entity(
-            self.service_proxy.table_name_jobs,
-            '{}${}'.format(self._FEDERATION_ACTIONS_PREFIX_PK, fedhash),
-            hash_string(job_id))
+        while True:
+            entity = self.service_proxy.table_client.get_entity(
+                self.service_proxy.table_name_jobs,
+                '{}${}'.format(self._FEDERATION_ACTIONS_PREFIX_PK, fedhash),
+                hash_string(job_id))
+            if 'SequenceTail' in entity:
+                return entity
+            self._migrate_legacy_sequence(entity)
 
     def get_first_sequence_id_for_job(
             self,
             fedhash: str,
-            job_id: str
+            job_id: str,
+            offset: int = 0,
     ) -> str:
         try:
             entity = self._get_sequence_entity_for_job(fedhash, job_id)
+            index = entity['SequenceHead'] + offset
+            if index >= entity['SequenceTail']:
+                return None
+            return self.service_proxy.table_client.get_entity(
+                self.service_proxy.table_name_jobs, entity['PartitionKey'],
+                self._sequence_entry_row_key(entity['RowKey'], index),
+                select='UniqueId')['UniqueId']
         except azure.common.AzureMissingResourceHttpError:
             return None
-        else:
-            try:
-                return entity['Sequence0'].split(',')[0]
-            except Exception:
-                return None
-
-    def pop_and_pack_sequence_ids_for_job(
-            self,
-            fedhash: str,
-            job_id: str,
-    ) -> azure.cosmosdb.table.Entity:
-        entity = self._get_sequence_entity_for_job(fedhash, job_id)
-        seq = []
-        for i in range(0, self._MAX_SEQUENCE_ID_PROPERTIES):
-            prop = 'Sequence{}'.format(i)
-            if prop in entity and is_not_empty(entity[prop]):
-                seq.extend(entity[prop].split(','))
-        seq.pop(0)
-        for i in range(0, self._MAX_SEQUENCE_ID_PROPERTIES):
-            prop = 'Sequence{}'.format(i)
-            start = i * self._MAX_SEQUENCE_IDS_PER_PROPERTY
-            end = start + self._MAX_SEQUENCE_IDS_PER_PROPERTY
-            if end > len(seq):
-                end = len(seq)
-            if start < end:
-                entity[prop] = ','.join(seq[start:end])
-            else:
-                entity[prop] = None
-        return entity, len(seq) == 0
 
-    def dequeue_sequence_id_from_federation_sequence(
+    def dequeue_sequence_ids_from_federation_sequence(
             self,
-            delete_message: bool,
             fedhash: str,
-            msg_id: str,
-            pop_receipt: str,
             target: str,
+            count: int,
     ) -> None:
-        # pop first item off table sequence
-        if is_not_empty(target):
-            while True:
-                entity, empty_seq = self.pop_and_pack_sequence_ids_for_job(
-                    fedhash, target)
-                # see if there are no job location entities
-                if (empty_seq and not self.location_entities_exist_for_job(
-                        fedhash, target)):
-                    # delete entity
-                    self.delete_action_entity_for_job(entity)
-                    logger.debug(
-                        'deleted target {} action entity from '
-                        'federation {}'.format(target, fedhash))
-                    break
-                else:
-                    # merge update
-                    if self.insert_or_update_entity_with_etag_for_job(
-                            entity):
-                        logger.debug(
-                            'upserted target {} sequence to '
-                            'federation {}'.format(target, fedhash))
-                        break
-                    else:
-                        logger.debug(
-                            'conflict upserting target {} sequence to '
-                            'federation {}'.format(target, fedhash))
-        # dequeue message
-        if delete_message:
-            queue_name = '{}-{}'.format(
-                self.service_proxy.queue_prefix, fedhash)
-            self.service_proxy.queue_client.delete_message(
-                queue_name, msg_id, pop_receipt)
+        # pop processed items off table sequence: the head is advanced
+        # and the entries are deleted in one entity group transaction
+        if is_none_or_empty(target) or count <= 0:
+            return
+        while count > 0:
+            try:
+                entity = self._get_sequence_entity_for_job(fedhash, target)
+            except azure.common.AzureMissingResourceHttpError:
+                return
+            pk = entity['PartitionKey']
+            rk = entity['RowKey']
+            head = entity['SequenceHead']
+            # an entity group transaction is limited to 100 operations
+            new_head = min((head + count, entity['SequenceTail'], head + 99))
+            tb = azure.cosmosdb.table.TableBatch()
+            for index in range(head, new_head):
+                tb.delete_entity(
+                    pk, self._sequence_entry_row_key(rk, index))
+            # see if there are no job location entities
+            deleted = (
+                new_head == entity['SequenceTail'] and
+                not self.location_entities_exist_for_job(fedhash, target)
+            )
+            if deleted:
+                tb.delete_entity(pk, rk, if_match=entity['etag'])
+            else:
+                tb.merge_entity({
+                    'PartitionKey': pk,
+                    'RowKey': rk,
+                    'SequenceHead': new_head,
+                }, if_match=entity['etag'])
+            try:
+                self.service_proxy.table_client.commit_batch(
+                    self.service_proxy.table_name_jobs, tb)
+            except azure.common.AzureHttpError as ex:
+                if ex.status_code not in (404, 409, 412):
+                    raise
+                logger.debug(
+                    'conflict updating target {} sequence in '
+                    'federation {}'.format(target, fedhash))
+                continue
+            if deleted:
+                logger.debug(
+                    'deleted target {} action entity from '
+                    'federation {}'.format(target, fedhash))
+                return
+            logger.debug(
+                'popped {} uids off of target {} sequence in '
+                'federation {}'.format(new_head - head, target, fedhash))
+            if new_head == entity['SequenceTail']:
+                return
+            count -= new_head - head
 
     def add_blocked_action_for_job(
             self,
@@ -1424,6 +1991,414 @@ class FederationDataHandler():
         blob_client.delete_blob(container, blob_name)
 
 
+def get_data_locations_for_tasks(
+        task_map: Dict[str, batchmodels.TaskAddParameter],
+        account_locations: Dict[str, str],
+) -> Dict[str, int]:
+    """Get the locations of input data referenced by tasks
+    :param task_map: task map
+    :param account_locations: map of storage account name to location
+    :return: map of location to number of references
+    """
+    locations = collections.Counter()
+    for task in task_map.values():
+        if task.resource_files is None:
+            continue
+        for rf in task.resource_files:
+            url = rf.http_url or rf.storage_container_url
+            if is_none_or_empty(url):
+                continue
+            account = urllib.parse.urlparse(url).netloc.split('.')[0]
+            location = account_locations.get(account)
+            if location is not None:
+                locations[location] += 1
+    return dict(locations)
+
+
+class PoolCapacity():
+    def __init__(
+            self,
+            location: str,
+            vm_size: str,
+            slots_per_node: int,
+            dedicated_idle: int,
+            dedicated_available: int,
+            low_priority_idle: int,
+            low_priority_available: int,
+            active_tasks: Optional[int],
+            autoscale: bool,
+            autoscale_steady: bool,
+    ) -> None:
+        """Ctor for PoolCapacity, a point-in-time snapshot of pool capacity
+        used for placement
+        :param location: location
+        :param vm_size: vm size
+        :param slots_per_node: task slots per node
+        :param dedicated_idle: idle dedicated nodes
+        :param dedicated_available: schedulable dedicated nodes
+        :param low_priority_idle: idle low priority nodes
+        :param low_priority_available: schedulable low priority nodes
+        :param active_tasks: active tasks on pool
+        :param autoscale: autoscale enabled
+        :param autoscale_steady: autoscale enabled and allocation is steady
+        """
+        self.location = location
+        self.vm_size = vm_size
+        self.slots_per_node = slots_per_node
+        self.dedicated_idle = dedicated_idle
+        self.dedicated_available = dedicated_available
+        self.low_priority_idle = low_priority_idle
+        self.low_priority_available = low_priority_available
+        self.active_tasks = active_tasks
+        self.autoscale = autoscale
+        self.autoscale_steady = autoscale_steady
+
+    @classmethod
+    def from_pool(cls, pool: 'FederationPool') -> 'PoolCapacity':
+        """Create a capacity snapshot from a federation pool
+        :param pool: federation pool
+        :return: pool capacity
+        """
+        cp = pool.cloud_pool
+        return cls(
+            location=pool.location,
+            vm_size=pool.vm_size,
+            slots_per_node=cp.max_tasks_per_node,
+            dedicated_idle=pool.node_counts.dedicated.idle,
+            dedicated_available=pool.schedulable_dedicated_nodes,
+            low_priority_idle=pool.node_counts.low_priority.idle,
+            low_priority_available=pool.schedulable_low_priority_nodes,
+            active_tasks=pool.active_tasks_count,
+            autoscale=cp.enable_auto_scale,
+            autoscale_steady=(
+                cp.enable_auto_scale and
+                cp.allocation_state == batchmodels.AllocationState.steady
+            ),
+        )
+
+    @property
+    def has_available(self) -> bool:
+        return (
+            self.available(False, False) is not None or
+            self.available(True, False) is not None
+        )
+
+    @property
+    def total_slots(self) -> int:
+        return (
+            (self.dedicated_available + self.low_priority_available) *
+            self.slots_per_node
+        )
+
+    def idle(self, low_priority: bool, using_slots: bool) -> Optional[int]:
+        """Idle capacity, None if the pool has no idle nodes
+        :param low_priority: low priority nodes
+        :param using_slots: capacity in slots rather than nodes
+        :return: idle capacity
+        """
+        nodes = self.low_priority_idle if low_priority else self.dedicated_idle
+        if nodes <= 0:
+            return None
+        return nodes * self.slots_per_node if using_slots else nodes
+
+    def available(
+            self, low_priority: bool, using_slots: bool) -> Optional[int]:
+        """Available capacity, None if the pool has no schedulable nodes
+        and cannot autoscale
+        :param low_priority: low priority nodes
+        :param using_slots: capacity in slots rather than nodes
+        :return: available capacity
+        """
+        nodes = (
+            self.low_priority_available if low_priority else
+            self.dedicated_available
+        )
+        if nodes <= 0 and not self.autoscale:
+            return None
+        return nodes * self.slots_per_node if using_slots else nodes
+
+    def consume(
+            self,
+            engine: 'PlacementEngine',
+            constraints: Constraints,
+            num_tasks: int,
+    ) -> int:
+        """Account for a job placed on the pool by consuming idle nodes of
+        the first node tier with capacity and adding its tasks as active
+        :param engine: placement engine which placed the job
+        :param constraints: job constraints
+        :param num_tasks: number of tasks in job
+        :return: number of nodes consumed by the job
+        """
+        using_slots, _ = engine.required_capacity(constraints)
+        nodes = constraints.task.instance_counts_total or 0
+        if using_slots:
+            nodes = -(-nodes // self.slots_per_node)
+        for low_priority in engine.node_tiers(constraints):
+            if self.available(low_priority, False) is None:
+                continue
+            if low_priority:
+                self.low_priority_idle = max(self.low_priority_idle - nodes, 0)
+            else:
+                self.dedicated_idle = max(self.dedicated_idle - nodes, 0)
+            break
+        self.active_tasks = (self.active_tasks or 0) + num_tasks
+        return nodes
+
+
+class PlacementEngine():
+    def __init__(self, options: PlacementOptions) -> None:
+        """Ctor for PlacementEngine
+        :param options: placement options
+        """
+        self.options = options
+
+    @property
+    def requires_active_tasks_count(self) -> bool:
+        return False
+
+    @property
+    def requires_data_locations(self) -> bool:
+        return False
+
+    @staticmethod
+    def node_tiers(constraints: Constraints) -> Tuple[bool, ...]:
+        """Node tiers to attempt placement on in order
+        :param constraints: job constraints
+        :return: tuple of low priority flags
+        """
+        if (constraints.pool.low_priority_nodes_allow is not None and
+                not constraints.pool.low_priority_nodes_allow):
+            return (False, )
+        elif constraints.pool.low_priority_nodes_exclusive:
+            return (True, )
+        # no constraints, try scheduling on dedicated first, then low pri
+        return (False, True)
+
+    @staticmethod
+    def required_capacity(constraints: Constraints) -> Tuple[bool, int]:
+        """Required capacity for a job, scheduling is done by slots
+        (regular tasks) or vms (multi-instance)
+        :param constraints: job constraints
+        :return: tuple of using slots, capacity required
+        """
+        if constraints.task.has_multi_instance:
+            return False, constraints.task.instance_counts_max
+        return True, constraints.task.instance_counts_total
+
+    def select_pool(
+            self,
+            unique_id: str,
+            constraints: Constraints,
+            capacities: Dict[str, PoolCapacity],
+            data_locations: Optional[Dict[str, int]],
+    ) -> Optional[str]:
+        """Select a pool for a job
+        :param unique_id: unique id
+        :param constraints: job constraints
+        :param capacities: capacities of pools passing constraint filtering
+        :param data_locations: map of input data location to references
+        :return: pool key or None if no pool can be selected
+        """
+        raise NotImplementedError()
+
+
+class GreedyPlacementEngine(PlacementEngine):
+    @staticmethod
+    def _largest(capacity: Dict[str, int]) -> Optional[str]:
+        if len(capacity) == 0:
+            return None
+        return max(capacity, key=capacity.get)
+
+    def _select_pool_in_tier(
+            self,
+            unique_id: str,
+            capacities: Dict[str, PoolCapacity],
+            low_priority: bool,
+            using_slots: bool,
+            target_required: int,
+            allow_autoscale: bool,
+    ) -> Optional[str]:
+        idle = {}
+        avail = {}
+        for rk, cap in capacities.items():
+            val = cap.idle(low_priority, using_slots)
+            if val is not None:
+                idle[rk] = val
+            val = cap.available(low_priority, using_slots)
+            if val is not None:
+                avail[rk] = val
+        logger.debug(
+            'pool selection attempt for uid={} low_priority={} '
+            'using_slots={} target_required={} allow_autoscale={} '
+            'idle={} avail={}'.format(
+                unique_id, low_priority, using_slots, target_required,
+                allow_autoscale, idle, avail))
+        # try to match against largest idle pool, then largest avail pool,
+        # with sufficient capacity
+        for pool_map in (idle, avail):
+            rk = self._largest(pool_map)
+            if rk is not None and pool_map[rk] >= target_required:
+                return rk
+        # try to match against any autoscale-enabled pool that is steady
+        if allow_autoscale:
+            for pool_map in (idle, avail):
+                rk = self._largest({
+                    rk: val for rk, val in pool_map.items()
+                    if capacities[rk].autoscale_steady
+                })
+                if rk is not None:
+                    return rk
+        # if using slot scheduling, then attempt to schedule with backlog
+        if using_slots:
+            for pool_map in (idle, avail):
+                rk = self._largest(pool_map)
+                if rk is not None and pool_map[rk] >= 1:
+                    return rk
+        return None
+
+    def select_pool(
+            self,
+            unique_id: str,
+            constraints: Constraints,
+            capacities: Dict[str, PoolCapacity],
+            data_locations: Optional[Dict[str, int]],
+    ) -> Optional[str]:
+        using_slots, target_required = self.required_capacity(constraints)
+        for low_priority in self.node_tiers(constraints):
+            selected = self._select_pool_in_tier(
+                unique_id, capacities, low_priority, using_slots,
+                target_required, constraints.pool.autoscale_allow)
+            if selected is not None:
+                return selected
+        return None
+
+
+class ScoredPlacementEngine(PlacementEngine):
+    @property
+    def requires_active_tasks_count(self) -> bool:
+        return self.options.backlog_weight > 0
+
+    @property
+    def requires_data_locations(self) -> bool:
+        return self.options.locality_weight > 0
+
+    def _fit_score(
+            self,
+            cap: PoolCapacity,
+            low_priority: bool,
+            using_slots: bool,
+            target_required: int,
+            allow_autoscale: bool,
+    ) -> Optional[float]:
+        """Score how well the required capacity fits a pool, preferring
+        the tightest fit on idle nodes, then on schedulable nodes, then
+        partial fits via autoscale or task backlog
+        :return: fit score in [0, 1] or None if the pool is not eligible
+        """
+        idle = cap.idle(low_priority, using_slots)
+        avail = cap.available(low_priority, using_slots)
+        if idle is None and avail is None:
+            return None
+        if idle is not None and idle >= target_required:
+            return 0.5 + 0.5 * target_required / idle
+        if avail is not None and avail >= target_required:
+            return 0.25 + 0.25 * target_required / avail
+        largest = max(idle or 0, avail or 0)
+        if ((allow_autoscale and cap.autoscale_steady) or
+                (using_slots and largest >= 1)):
+            return 0.25 * largest / target_required
+        return None
+
+    @staticmethod
+    def _backlog_score(cap: PoolCapacity) -> float:
+        if cap.active_tasks is None:
+            return 1.0
+        return 1.0 / (1.0 + cap.active_tasks / max(cap.total_slots, 1))
+
+    @staticmethod
+    def locality_score(
+            cap: PoolCapacity,
+            data_locations: Optional[Dict[str, int]],
+    ) -> float:
+        if is_none_or_empty(data_locations):
+            return 0.0
+        return data_locations.get(cap.location, 0) / sum(
+            data_locations.values())
+
+    def _price_per_slot(self, cap: PoolCapacity) -> Optional[float]:
+        price = self.options.vm_prices.get(cap.vm_size)
+        if price is None:
+            return None
+        return price / cap.slots_per_node
+
+    def select_pool(
+            self,
+            unique_id: str,
+            constraints: Constraints,
+            capacities: Dict[str, PoolCapacity],
+            data_locations: Optional[Dict[str, int]],
+    ) -> Optional[str]:
+        opts = self.options
+        using_slots, target_required = self.required_capacity(constraints)
+        for low_priority in self.node_tiers(constraints):
+            fits = {}
+            for rk, cap in capacities.items():
+                fit = self._fit_score(
+                    cap, low_priority, using_slots, target_required,
+                    constraints.pool.autoscale_allow)
+                if fit is not None:
+                    fits[rk] = fit
+            if len(fits) == 0:
+                continue
+            # price is scored relative to the cheapest eligible pool,
+            # pools without a price receive no price score
+            prices = {
+                rk: self._price_per_slot(capacities[rk]) for rk in fits
+            }
+            known = [x for x in prices.values() if x is not None and x > 0]
+            min_price = min(known) if len(known) > 0 else None
+            scores = {}
+            for rk in fits:
+                cap = capacities[rk]
+                score = (
+                    opts.fit_weight * fits[rk] +
+                    opts.backlog_weight * self._backlog_score(cap) +
+                    opts.locality_weight * self.locality_score(
+                        cap, data_locations)
+                )
+                if (min_price is not None and prices[rk] is not None and
+                        prices[rk] > 0):
+                    score += opts.price_weight * min_price / prices[rk]
+                scores[rk] = score
+            selected = max(scores, key=scores.get)
+            logger.debug(
+                'pool selection for uid={} low_priority={} using_slots={} '
+                'target_required={} scores={} selected={}'.format(
+                    unique_id, low_priority, using_slots, target_required,
+                    scores, selected))
+            return selected
+        return None
+
+
+_PLACEMENT_ENGINES = {
+    'greedy': GreedyPlacementEngine,
+    'scored': ScoredPlacementEngine,
+}
+
+
+def create_placement_engine(options: PlacementOptions) -> PlacementEngine:
+    """Create a placement engine
+    :param options: placement options
+    :return: placement engine
+    """
+    try:
+        return _PLACEMENT_ENGINES[options.policy](options)
+    except KeyError:
+        raise ValueError(
+            'unknown placement policy: {}'.format(options.policy))
+
+
 class FederationPool():
     def __init__(
             self,
@@ -1439,10 +2414,9 @@ class FederationPool():
         self._cloud_pool = None  # type: batchmodels.CloudPool
         self._pool_last_update = None  # type: datetime.datetime
         self._node_counts = None  # type: batchmodels.PoolNodeCounts
-        self._node_counts_last_update = None  # type: datetime.datetime
         self._blackout_end_time = datetime_utcnow(as_string=False)
         self._active_tasks_count = None  # type: int
-        self._active_tasks_count_last_update = None  # type: datetime.datetime
+        self._capacity = None  # type: PoolCapacity
         self.batch_account = batch_account
         self.service_url = service_url
         self.location = location.lower()
@@ -1459,12 +2433,13 @@ class FederationPool():
     @cloud_pool.setter
     def cloud_pool(self, value: batchmodels.CloudPool) -> None:
         self._cloud_pool = value
+        self._capacity = None
         if (self._cloud_pool is not None and
                 is_not_empty(self._cloud_pool.metadata)):
             for md in self._cloud_pool.metadata:
                 if md.name == _POOL_NATIVE_METADATA_NAME:
                     self.native = md.value == '1'
-        self._last_update = datetime_utcnow(as_string=False)
+        self._pool_last_update = datetime_utcnow(as_string=False)
 
     @property
     def native(self) -> bool:
@@ -1481,7 +2456,7 @@ class FederationPool():
     @node_counts.setter
     def node_counts(self, value: batchmodels.PoolNodeCounts) -> None:
         self._node_counts = value
-        self._node_counts_last_update = datetime_utcnow(as_string=False)
+        self._capacity = None
 
     @property
     def active_tasks_count(self) -> int:
@@ -1490,41 +2465,38 @@ class FederationPool():
     @active_tasks_count.setter
     def active_tasks_count(self, value: int) -> None:
         self._active_tasks_count = value
-        self._active_tasks_count_last_update = datetime_utcnow(as_string=False)
+        self._capacity = None
 
     @property
-    def is_valid(self) -> bool:
-        if (self.cloud_pool is not None and self.vm_props is not None and
-                datetime_utcnow(as_string=False) > self._blackout_end_time):
-            return self.cloud_pool.state == batchmodels.PoolState.active
-        return False
+    def capacity(self) -> PoolCapacity:
+        """Capacity snapshot of the pool, rebuilt only after the pool,
+        node counts or active task count are updated
+        :return: pool capacity
+        """
+        if self._capacity is None:
+            self._capacity = PoolCapacity.from_pool(self)
+        return self._capacity
 
     @property
-    def pool_requires_update(self) -> bool:
+    def is_active(self) -> bool:
         return (
-            not self.is_valid or self._pool_last_update is None or
-            (datetime_utcnow() - self._pool_last_update) >
-            _MAX_TIMESPAN_POOL_UPDATE
+            self.cloud_pool is not None and self.vm_props is not None and
+            self.cloud_pool.state == batchmodels.PoolState.active
         )
 
     @property
-    def node_counts_requires_update(self) -> bool:
-        if not self.is_valid:
-            return False
+    def is_valid(self) -> bool:
         return (
-            self._node_counts_last_update is None or
-            (datetime_utcnow() - self._node_counts_last_update) >
-            _MAX_TIMESPAN_NODE_COUNTS_UPDATE
+            datetime_utcnow(as_string=False) > self._blackout_end_time and
+            self.is_active
         )
 
     @property
-    def active_tasks_count_requires_update(self) -> bool:
-        if not self.is_valid:
-            return False
+    def pool_requires_update(self) -> bool:
         return (
-            self._active_tasks_count_last_update is None or
-            (datetime_utcnow() - self._active_tasks_count_last_update) >
-            _MAX_TIMESPAN_ACTIVE_TASKS_COUNT_UPDATE
+            not self.is_valid or self._pool_last_update is None or
+            (datetime_utcnow() - self._pool_last_update) >
+            _MAX_TIMESPAN_POOL_UPDATE
         )
 
     @property
@@ -1587,11 +2559,12 @@ class FederationPool():
             self,
             bsh: BatchServiceHandler,
             blackout: int,
-            evaluate_as: bool
+            evaluate_as: bool,
+            num_tasks: int = 0,
     ) -> None:
-        # invalidate count caches
-        self._node_counts_last_update = None
-        self._active_tasks_count_last_update = None
+        # update count caches
+        bsh.capacity_cache.record_tasks_scheduled(
+            self.batch_account, self.pool_id, num_tasks)
         # set scheduling blackout time
         if blackout > 0:
             self._blackout_end_time = datetime_utcnow(
@@ -1608,12 +2581,184 @@ class FederationPool():
                 self.batch_account, self.service_url, self.pool_id)
 
 
+class ActionLatencyMetrics():
+    def __init__(self) -> None:
+        """Ctor for ActionLatencyMetrics"""
+        self.count = 0
+        self.processing_total = 0.0
+        self.processing_max = 0.0
+        self.queue_wait_count = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+
+    def record(
+            self,
+            processing: float,
+            queue_wait: Optional[float],
+    ) -> None:
+        """Record latencies of a processed action
+        :param processing: processing time in seconds
+        :param queue_wait: time in queue in seconds, if known
+        """
+        self.count += 1
+        self.processing_total += processing
+        self.processing_max = max((self.processing_max, processing))
+        if queue_wait is not None:
+            self.queue_wait_count += 1
+            self.queue_wait_total += queue_wait
+            self.queue_wait_max = max((self.queue_wait_max, queue_wait))
+
+    def merge(self, other: 'ActionLatencyMetrics') -> None:
+        """Merge metrics into this instance
+        :param other: metrics to merge
+        """
+        self.count += other.count
+        self.processing_total += other.processing_total
+        self.processing_max = max((self.processing_max, other.processing_max))
+        self.queue_wait_count += other.queue_wait_count
+        self.queue_wait_total += other.queue_wait_total
+        self.queue_wait_max = max((self.queue_wait_max, other.queue_wait_max))
+
+    def __str__(self) -> str:
+        return (
+            'actions={} processing avg={:.3f}s max={:.3f}s queue wait '
+            'avg={:.3f}s max={:.3f}s'.format(
+                self.count,
+                self.processing_total / self.count if self.count > 0 else 0,
+                self.processing_max,
+                self.queue_wait_total / self.queue_wait_count
+                if self.queue_wait_count > 0 else 0,
+                self.queue_wait_max)
+        )
+
+
+class FederationMessageLease():
+    def __init__(self, msg: azure.storage.queue.models.QueueMessage) -> None:
+        """Ctor for FederationMessageLease
+        :param msg: queue message
+        """
+        self.lock = threading.Lock()
+        self.msg_id = msg.id
+        self.pop_receipt = msg.pop_receipt
+        self.held = True
+
+
+class FederationMessageLeases():
+    def __init__(
+            self,
+            fdh: FederationDataHandler,
+            fedhash: str,
+            msgs: List[azure.storage.queue.models.QueueMessage],
+            visibility_timeout: int,
+    ) -> None:
+        """Ctor for FederationMessageLeases, the messages dequeued from a
+        federation queue which are kept invisible while processed until
+        completed or released
+        :param fdh: federation data handler
+        :param fedhash: federation hash
+        :param msgs: dequeued messages
+        :param visibility_timeout: visibility timeout in seconds
+        """
+        self._fdh = fdh
+        self._fedhash = fedhash
+        self.visibility_timeout = visibility_timeout
+        self._leases = collections.OrderedDict(
+            (msg.id, FederationMessageLease(msg)) for msg in msgs
+        )
+
+    def _update(self, lease: FederationMessageLease, timeout: int) -> None:
+        """Update visibility of a held message. This function should be
+        called with the lease lock held!
+        :param lease: message lease
+        :param timeout: visibility timeout in seconds
+        """
+        try:
+            lease.pop_receipt = \
+                self._fdh.update_message_visibility_in_federation_queue(
+                    self._fedhash, lease.msg_id, lease.pop_receipt, timeout)
+        except azure.common.AzureHttpError as exc:
+            # the message is visible again and may have been dequeued
+            # elsewhere, the lease is lost
+            logger.error(
+                'lost lease on message {} for fed {}: {}'.format(
+                    lease.msg_id, self._fedhash, exc))
+            lease.held = False
+
+    def renew(self) -> None:
+        """Extend the visibility of messages still being processed"""
+        for lease in self._leases.values():
+            with lease.lock:
+                if lease.held:
+                    self._update(lease, self.visibility_timeout)
+
+    def complete(self, msg_ids: List[str]) -> None:
+        """Delete processed messages
+        :param msg_ids: message ids
+        """
+        for msg_id in msg_ids:
+            lease = self._leases[msg_id]
+            with lease.lock:
+                if not lease.held:
+                    continue
+                try:
+                    self._fdh.delete_message_from_federation_queue(
+                        self._fedhash, lease.msg_id, lease.pop_receipt)
+                except azure.common.AzureMissingResourceHttpError:
+                    pass
+                except azure.common.AzureHttpError as exc:
+                    logger.error(
+                        'could not delete message {} for fed {}: {}'.format(
+                            lease.msg_id, self._fedhash, exc))
+                lease.held = False
+
+    def release(self) -> None:
+        """Make messages which were not completed visible again so that
+        they are retried on the next dequeue"""
+        for lease in self._leases.values():
+            with lease.lock:
+                if lease.held:
+                    self._update(lease, 0)
+                    lease.held = False
+
+
+class SchedulingRound():
+    def __init__(self) -> None:
+        """Ctor for SchedulingRound, the state shared by actions dequeued
+        together from a federation queue such that pools are refreshed
+        once and placements account for earlier placements in the round
+        """
+        # pool refresh results and validity at the start of the round
+        self.refreshed = {}  # type: Dict[str, bool]
+        self.valid = {}  # type: Dict[str, bool]
+        # capacities net of placements made in the round
+        self.capacities = {}  # type: Dict[str, PoolCapacity]
+        # prefetched message data and planned pools by unique id
+        self.payloads = {}  # type: Dict[str, Tuple[Any, str, str, Dict]]
+        self.data_locations = {}  # type: Dict[str, Dict[str, int]]
+        self.reservations = {}  # type: Dict[str, str]
+
+    def capacity(self, rk: str, pool: FederationPool) -> PoolCapacity:
+        """Get the capacity of a pool net of placements in the round
+        :param rk: pool key
+        :param pool: federation pool
+        :return: pool capacity
+        """
+        try:
+            return self.capacities[rk]
+        except KeyError:
+            cap = copy.copy(pool.capacity)
+            self.capacities[rk] = cap
+            return cap
+
+
 class Federation():
     def __init__(self, fedhash: str, fedid: str) -> None:
         self.lock = threading.Lock()
         self.hash = fedhash
         self.id = fedid
         self.pools = {}  # type: Dict[str, FederationPool]
+        self.action_metrics = ActionLatencyMetrics()
+        self.scheduling_round = None  # type: SchedulingRound
 
     def update_pool(
             self,
@@ -2010,16 +3155,18 @@ class Federation():
             if pool.pool_requires_update:
                 pool.cloud_pool = bsh.get_pool_full_update(
                     pool.batch_account, pool.service_url, pool.pool_id)
-            # refresh node state counts
-            if pool.node_counts_requires_update:
-                pool.node_counts = bsh.get_node_state_counts(
+            # read node state and active task counts from the capacity
+            # cache, which is refreshed per account in the background
+            if pool.is_valid:
+                node_counts = bsh.capacity_cache.get_node_counts(
                     pool.batch_account, pool.service_url, pool.pool_id)
-            # refresh active task counts
-            if (active_tasks_count_update and
-                    pool.active_tasks_count_requires_update):
-                pool.active_tasks_count = \
-                    bsh.aggregate_active_task_count_on_pool(
+                if node_counts is not pool.node_counts:
+                    pool.node_counts = node_counts
+                if active_tasks_count_update:
+                    count = bsh.capacity_cache.get_active_tasks_count(
                         pool.batch_account, pool.service_url, pool.pool_id)
+                    if count != pool.active_tasks_count:
+                        pool.active_tasks_count = count
         else:
             logger.warning(
                 'pool id {} hash={} not in fed id {} fed hash {}'.format(
@@ -2027,260 +3174,62 @@ class Federation():
             return False
         return True
 
-    def _select_pool_for_target_required(
-            self,
-            unique_id: str,
-            using_slots: bool,
-            target_required: int,
-            allow_autoscale: bool,
-            num_pools: Dict[str, int],
-            binned: List[str],
-            pool_map: Dict[str, Dict[str, int]],
-    ) -> Optional[str]:
-        logger.debug(
-            'pool selection attempt for uid={} using_slots={} '
-            'target_required={} allow_autoscale={} num_pools={} '
-            'binned={}'.format(
-                unique_id, using_slots, target_required, allow_autoscale,
-                num_pools, binned))
-        # try to match against largest idle pool with sufficient capacity
-        if num_pools['idle'] > 0:
-            for rk in binned['idle']:
-                if pool_map['idle'][rk] >= target_required:
-                    return rk
-        # try to match against largest avail pool with sufficient capacity
-        if num_pools['avail'] > 0:
-            for rk in binned['avail']:
-                if pool_map['avail'][rk] >= target_required:
-                    return rk
-        # try to match against any autoscale-enabled pool that is steady
-        if allow_autoscale:
-            for rk in binned['idle']:
-                pool = self.pools[rk]
-                if (pool.cloud_pool.enable_auto_scale and
-                        pool.cloud_pool.allocation_state ==
-                        batchmodels.AllocationState.steady):
-                    return rk
-            for rk in binned['avail']:
-                pool = self.pools[rk]
-                if (pool.cloud_pool.enable_auto_scale and
-                        pool.cloud_pool.allocation_state ==
-                        batchmodels.AllocationState.steady):
-                    return rk
-        # if using slot scheduling, then attempt to schedule with backlog
-        if using_slots:
-            # try to match against largest idle pool
-            if num_pools['idle'] > 0:
-                for rk in binned['idle']:
-                    if pool_map['idle'][rk] >= 1:
-                        return rk
-            # try to match against largest avail pool
-            if num_pools['avail'] > 0:
-                for rk in binned['avail']:
-                    if pool_map['avail'][rk] >= 1:
-                        return rk
-        return None
-
-    def _greedy_best_fit_match_for_job(
-            self,
-            num_tasks: int,
-            constraints: Constraints,
-            unique_id: str,
-            dedicated_vms: Dict[str, Dict[str, int]],
-            dedicated_slots: Dict[str, Dict[str, int]],
-            low_priority_vms: Dict[str, Dict[str, int]],
-            low_priority_slots: Dict[str, Dict[str, int]],
-    ) -> Optional[str]:
-        # calculate pools of each
-        num_pools = {
-            'vms': {
-                'dedicated': {
-                    'idle': len(dedicated_vms['idle']),
-                    'avail': len(dedicated_vms['avail']),
-                },
-                'low_priority': {
-                    'idle': len(low_priority_vms['idle']),
-                    'avail': len(low_priority_vms['avail']),
-                }
-            },
-            'slots': {
-                'dedicated': {
-                    'idle': len(dedicated_slots['idle']),
-                    'avail': len(dedicated_slots['avail']),
-                },
-                'low_priority': {
-                    'idle': len(low_priority_slots['idle']),
-                    'avail': len(low_priority_slots['avail']),
-                }
-            }
-        }
-        # bin all maps
-        binned = {
-            'vms': {
-                'dedicated': {
-                    'idle': sorted(
-                        dedicated_vms['idle'],
-                        key=dedicated_vms['idle'].get,
-                        reverse=True),
-                    'avail': sorted(
-                        dedicated_vms['avail'],
-                        key=dedicated_vms['avail'].get,
-                        reverse=True),
-                },
-                'low_priority': {
-                    'idle': sorted(
-                        low_priority_vms['idle'],
-                        key=low_priority_vms['idle'].get,
-                        reverse=True),
-                    'avail': sorted(
-                        low_priority_vms['avail'],
-                        key=low_priority_vms['avail'].get,
-                        reverse=True),
-                }
-            },
-            'slots': {
-                'dedicated': {
-                    'idle': sorted(
-                        dedicated_slots['idle'],
-                        key=dedicated_slots['idle'].get,
-                        reverse=True),
-                    'avail': sorted(
-                        dedicated_slots['avail'],
-                        key=dedicated_slots['avail'].get,
-                        reverse=True),
-                },
-                'low_priority': {
-                    'idle': sorted(
-                        low_priority_slots['idle'],
-                        key=low_priority_slots['idle'].get,
-                        reverse=True),
-                    'avail': sorted(
-                        low_priority_slots['avail'],
-                        key=low_priority_slots['avail'].get,
-                        reverse=True),
-                }
-            }
-        }
-        # scheduling is done by slots (regular tasks) or vms (multi-instance)
-        if constraints.task.has_multi_instance:
-            total_slots_required = None
-            vms_required_per_task = constraints.task.instance_counts_max
-        else:
-            total_slots_required = constraints.task.instance_counts_total
-            vms_required_per_task = None
-        # greedy smallest-fit (by vms or slots) matching
-        selected = None
-        # constraint: dedicated only pools
-        if (constraints.pool.low_priority_nodes_allow is not None and
-                not constraints.pool.low_priority_nodes_allow):
-            if total_slots_required is not None:
-                selected = self._select_pool_for_target_required(
-                    unique_id, True, total_slots_required,
-                    constraints.pool.autoscale_allow,
-                    num_pools['slots']['dedicated'],
-                    binned['slots']['dedicated'], dedicated_slots)
-            else:
-                selected = self._select_pool_for_target_required(
-                    unique_id, False, vms_required_per_task,
-                    constraints.pool.autoscale_allow,
-                    num_pools['vms']['dedicated'],
-                    binned['vms']['dedicated'], dedicated_vms)
-        elif constraints.pool.low_priority_nodes_exclusive:
-            # constraint: low priority only pools
-            if total_slots_required is not None:
-                selected = self._select_pool_for_target_required(
-                    unique_id, True, total_slots_required,
-                    constraints.pool.autoscale_allow,
-                    num_pools['slots']['low_priority'],
-                    binned['slots']['low_priority'], low_priority_slots)
-            else:
-                selected = self._select_pool_for_target_required(
-                    unique_id, False, vms_required_per_task,
-                    constraints.pool.autoscale_allow,
-                    num_pools['vms']['low_priority'],
-                    binned['vms']['low_priority'], low_priority_vms)
-        else:
-            # no constraints, try scheduling on dedicated first, then low pri
-            if total_slots_required is not None:
-                selected = self._select_pool_for_target_required(
-                    unique_id, True, total_slots_required,
-                    constraints.pool.autoscale_allow,
-                    num_pools['slots']['dedicated'],
-                    binned['slots']['dedicated'], dedicated_slots)
-                if selected is None:
-                    selected = self._select_pool_for_target_required(
-                        unique_id, True, total_slots_required,
-                        constraints.pool.autoscale_allow,
-                        num_pools['slots']['low_priority'],
-                        binned['slots']['low_priority'], low_priority_slots)
-            else:
-                selected = self._select_pool_for_target_required(
-                    unique_id, False, vms_required_per_task,
-                    constraints.pool.autoscale_allow,
-                    num_pools['vms']['dedicated'],
-                    binned['vms']['dedicated'], dedicated_vms)
-                if selected is None:
-                    selected = self._select_pool_for_target_required(
-                        unique_id, False, vms_required_per_task,
-                        constraints.pool.autoscale_allow,
-                        num_pools['vms']['low_priority'],
-                        binned['vms']['low_priority'], low_priority_vms)
-        return selected
-
-    def find_target_pool_for_job(
+    def _refresh_pools(
             self,
             bsh: BatchServiceHandler,
             fdh: FederationDataHandler,
-            num_tasks: int,
+            rks: List[str],
+            active_tasks_count_update: bool,
+    ) -> Dict[str, bool]:
+        """Check and update pools in parallel
+        :param bsh: batch service handler
+        :param fdh: federation data handler
+        :param rks: pool keys to refresh
+        :param active_tasks_count_update: update active task counts
+        :return: map of pool key to refresh success
+        """
+        if len(rks) == 0:
+            return {}
+        update_futures = {}
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_workers_for_executor(rks)) as executor:
+            for rk in rks:
+                update_futures[rk] = executor.submit(
+                    self._pre_constraint_filter_pool_update, bsh, fdh, rk,
+                    active_tasks_count_update)
+        return {rk: update_futures[rk].result() for rk in rks}
+
+    def _filter_pools_for_job(
+            self,
             constraints: Constraints,
             blacklist: Set[str],
             unique_id: str,
             target: str,
-    ) -> Optional[str]:
-        """
-        This function should be called with lock already held!
+            refreshed: Dict[str, bool],
+            valid: Dict[str, bool],
+    ) -> Dict[str, PoolCapacity]:
+        """Filter pools with constraints
+        :param constraints: job constraints
+        :param blacklist: pools to exclude, added to on hard constraint
+            failure
+        :param unique_id: unique id
+        :param target: target
+        :param refreshed: map of pool key to refresh success
+        :param valid: map of pool key to validity overriding pool state
+        :return: capacities of pools passing constraint filtering
         """
-        dedicated_vms = {
-            'idle': {},
-            'avail': {},
-        }
-        dedicated_slots = {
-            'idle': {},
-            'avail': {},
-        }
-        low_priority_vms = {
-            'idle': {},
-            'avail': {},
-        }
-        low_priority_slots = {
-            'idle': {},
-            'avail': {},
-        }
-        # check and update pools in parallel
-        update_futures = {}
-        if len(self.pools) > 0:
-            with concurrent.futures.ThreadPoolExecutor(
-                    max_workers=max_workers_for_executor(
-                        self.pools)) as executor:
-                for rk in self.pools:
-                    if rk in blacklist:
-                        continue
-                    update_futures[rk] = executor.submit(
-                        self._pre_constraint_filter_pool_update, bsh, fdh, rk,
-                        constraints.pool.max_active_task_backlog_ratio
-                        is not None
-                    )
-        # perform constraint filtering
+        capacities = collections.OrderedDict()
+        sr = self.scheduling_round
         # TODO optimization -> fast match against last schedule?
         for rk in self.pools:
             pool = self.pools[rk]
             if rk in blacklist:
                 continue
             # check if update was successful for pool
-            if not update_futures[rk].result():
+            if not refreshed.get(rk, False):
                 continue
             # ensure pool is valid and node counts exist
-            if not pool.is_valid or pool.node_counts is None:
+            if not valid.get(rk, pool.is_valid) or pool.node_counts is None:
                 logger.warning(
                     'skipping invalid pool id {} hash={} node counts '
                     'valid={} in fed id {} fed hash {} uid={} '
@@ -2297,43 +3246,107 @@ class Federation():
             if self._filter_pool_nodes_with_constraints(
                     pool, constraints, unique_id):
                 continue
-            # add counts for pre-sort
-            if pool.node_counts.dedicated.idle > 0:
-                dedicated_vms['idle'][rk] = pool.node_counts.dedicated.idle
-                dedicated_slots['idle'][rk] = (
-                    pool.node_counts.dedicated.idle *
-                    pool.cloud_pool.max_tasks_per_node
-                )
-            if pool.node_counts.low_priority.idle > 0:
-                low_priority_vms['idle'][rk] = (
-                    pool.node_counts.low_priority.idle
-                )
-                low_priority_slots['idle'][rk] = (
-                    pool.node_counts.low_priority.idle *
-                    pool.cloud_pool.max_tasks_per_node
-                )
-            # for availbility counts, allow pools to be added to map even
-            # with zero nodes if they can autoscale
-            if (pool.schedulable_dedicated_nodes > 0 or
-                    pool.cloud_pool.enable_auto_scale):
-                dedicated_vms['avail'][rk] = pool.schedulable_dedicated_nodes
-                dedicated_slots['avail'][rk] = (
-                    pool.schedulable_dedicated_nodes *
-                    pool.cloud_pool.max_tasks_per_node
-                )
-            if (pool.schedulable_low_priority_nodes > 0 or
-                    pool.cloud_pool.enable_auto_scale):
-                low_priority_vms['avail'][rk] = (
-                    pool.schedulable_low_priority_nodes
-                )
-                low_priority_slots['avail'][rk] = (
-                    pool.schedulable_low_priority_nodes *
-                    pool.cloud_pool.max_tasks_per_node
-                )
-        del update_futures
+            if sr is not None:
+                capacities[rk] = sr.capacity(rk, pool)
+            else:
+                capacities[rk] = pool.capacity
+        return capacities
+
+    def plan_scheduling_round(
+            self,
+            bsh: BatchServiceHandler,
+            fdh: FederationDataHandler,
+            jobs: List[Tuple[str, str, Constraints, int]],
+    ) -> None:
+        """Refresh pools once for the scheduling round and jointly place
+        jobs, largest first, reserving pools for them in the round
+        :param bsh: batch service handler
+        :param fdh: federation data handler
+        :param jobs: list of (unique id, target, constraints, num tasks)
+        """
+        sr = self.scheduling_round
+        engine = fdh.placement_engine
+        sr.refreshed = self._refresh_pools(
+            bsh, fdh, list(self.pools.keys()),
+            engine.requires_active_tasks_count or any(
+                x[2].pool.max_active_task_backlog_ratio is not None
+                for x in jobs))
+        sr.valid = {rk: self.pools[rk].is_valid for rk in sr.refreshed}
+        if len(jobs) == 0:
+            return
+        # first-fit decreasing by required capacity
+        jobs = sorted(
+            jobs, key=lambda x: x[2].task.instance_counts_total or 0,
+            reverse=True)
+        for unique_id, target, constraints, num_tasks in jobs:
+            capacities = self._filter_pools_for_job(
+                constraints, set(), unique_id, target, sr.refreshed,
+                sr.valid)
+            if len(capacities) == 0:
+                continue
+            rk = engine.select_pool(
+                unique_id, constraints, capacities,
+                sr.data_locations.get(unique_id))
+            if rk is None:
+                continue
+            capacities[rk].consume(engine, constraints, num_tasks)
+            sr.reservations[unique_id] = rk
+        logger.debug(
+            'planned {} of {} jobs in scheduling round for fed {} '
+            'fed hash {}: {}'.format(
+                len(sr.reservations), len(jobs), self.id, self.hash,
+                sr.reservations))
+
+    def find_target_pool_for_job(
+            self,
+            bsh: BatchServiceHandler,
+            fdh: FederationDataHandler,
+            num_tasks: int,
+            constraints: Constraints,
+            blacklist: Set[str],
+            unique_id: str,
+            target: str,
+            data_locations: Optional[Dict[str, int]] = None,
+    ) -> Optional[str]:
+        """
+        This function should be called with lock already held!
+        """
+        sr = self.scheduling_round
+        active_tasks_count_update = (
+            constraints.pool.max_active_task_backlog_ratio is not None or
+            fdh.placement_engine.requires_active_tasks_count
+        )
+        if sr is None:
+            refreshed = self._refresh_pools(
+                bsh, fdh, [rk for rk in self.pools if rk not in blacklist],
+                active_tasks_count_update)
+            valid = {}
+        else:
+            # use the pool planned for the job in the scheduling round
+            rk = sr.reservations.pop(unique_id, None)
+            if rk is not None and rk not in blacklist and rk in self.pools:
+                logger.info(
+                    'selected planned pool id {} hash {} for uid {} '
+                    'target={} in fed {} fed hash {}'.format(
+                        self.pools[rk].pool_id, rk, unique_id, target,
+                        self.id, self.hash))
+                return rk
+            # pools are refreshed once per round, only refresh pools
+            # added since the start of the round
+            added = self._refresh_pools(
+                bsh, fdh, [
+                    rk for rk in self.pools
+                    if rk not in blacklist and rk not in sr.refreshed
+                ], active_tasks_count_update)
+            for rk in added:
+                sr.valid[rk] = self.pools[rk].is_valid
+            sr.refreshed.update(added)
+            refreshed = sr.refreshed
+            valid = sr.valid
+        capacities = self._filter_pools_for_job(
+            constraints, blacklist, unique_id, target, refreshed, valid)
         # check for non-availability
-        if (len(dedicated_vms['avail']) == 0 and
-                len(low_priority_vms['avail']) == 0 and
+        if (not any(cap.has_available for cap in capacities.values()) and
                 not constraints.pool.autoscale_allow):
             logger.error(
                 'no available nodes to schedule uid {} target={} in fed {} '
@@ -2347,10 +3360,12 @@ class Federation():
                     self.hash, target, unique_id, num_tasks,
                     'Constraint filtering: no available pools')
             return None
-        # perform greedy matching
-        schedule = self._greedy_best_fit_match_for_job(
-            num_tasks, constraints, unique_id, dedicated_vms, dedicated_slots,
-            low_priority_vms, low_priority_slots)
+        # perform matching
+        schedule = fdh.placement_engine.select_pool(
+            unique_id, constraints, capacities, data_locations)
+        if schedule is not None and sr is not None:
+            capacities[schedule].consume(
+                fdh.placement_engine, constraints, num_tasks)
         if schedule is None:
             logger.warning(
                 'could not match uid {} target={} in fed {} fed hash {} to '
@@ -2387,8 +3402,9 @@ class Federation():
                 'service_url={})'.format(
                     jobschedule.id, pool.pool_id, pool.batch_account,
                     pool.service_url))
-            bsh.add_job_schedule(
-                pool.batch_account, pool.service_url, jobschedule)
+            await bsh.service_proxy.run_blocking(
+                bsh.add_job_schedule, pool.batch_account, pool.service_url,
+                jobschedule)
             success = True
         except batchmodels.BatchErrorException as exc:
             if 'marked for deletion' in exc.message.value:
@@ -2447,7 +3463,8 @@ class Federation():
                 'service_url={})'.format(
                     job.id, pool.pool_id, pool.batch_account,
                     pool.service_url))
-            bsh.add_job(pool.batch_account, pool.service_url, job)
+            await bsh.service_proxy.run_blocking(
+                bsh.add_job, pool.batch_account, pool.service_url, job)
             success = True
             del_job = False
         except batchmodels.BatchErrorException as exc:
@@ -2474,8 +3491,9 @@ class Federation():
                     success = False
                 else:
                     # retrieve job and check for constraints
-                    ej = bsh.get_job(
-                        pool.batch_account, pool.service_url, job.id)
+                    ej = await bsh.service_proxy.run_blocking(
+                        bsh.get_job, pool.batch_account, pool.service_url,
+                        job.id)
                     # ensure the job's pool info matches
                     if ej.pool_info.pool_id != pool.pool_id:
                         logger.error(
@@ -2686,14 +3704,11 @@ class Federation():
             # 1. sort task map keys
             # 2. re-map task ids to current job
             # 3. re-gather merge task dependencies (shouldn't happen)
-            last_tid = None
-            tasklist = None
             merge_task_id = None
             for tid in task_ids:
                 is_merge_task = tid == constraints.task.merge_task_id
-                tasklist, new_tid = bsh.regenerate_next_generic_task_id(
+                new_tid = bsh.regenerate_next_generic_task_id(
                     pool.batch_account, pool.service_url, job_id, naming, tid,
-                    last_task_id=last_tid, tasklist=tasklist,
                     is_merge_task=is_merge_task)
                 task = task_map.pop(tid)
                 task = self.fixup_task_for_mismatch(
@@ -2702,8 +3717,6 @@ class Federation():
                 task_map[new_tid] = task
                 if is_merge_task:
                     merge_task_id = new_tid
-                tasklist.append(new_tid)
-                last_tid = new_tid
             if merge_task_id is not None:
                 merge_task = task_map.pop(merge_task_id)
                 merge_task = self.fixup_task_for_mismatch(
@@ -2721,7 +3734,8 @@ class Federation():
                 pool.batch_account, pool.service_url, job_id)
         # post scheduling actions
         pool.on_new_tasks_scheduled(
-            bsh, fdh.scheduling_blackout, fdh.scheduling_evaluate_autoscale)
+            bsh, fdh.scheduling_blackout, fdh.scheduling_evaluate_autoscale,
+            len(task_map))
 
 
 class FederationProcessor():
@@ -2740,12 +3754,18 @@ class FederationProcessor():
                 'actions', 5))
         except KeyError:
             self.action_refresh_interval = 5
+        self.max_concurrent_actions = \
+            self._service_proxy.max_concurrent_actions
         self.csh = ComputeServiceHandler(self._service_proxy)
         self.bsh = BatchServiceHandler(self._service_proxy)
         self.fdh = FederationDataHandler(self._service_proxy)
         # data structs
         self._federation_lock = threading.Lock()
         self.federations = {}  # type: Dict[str, Federation]
+        # action processing concurrency: the semaphore and scheduling
+        # locks are created on first use within the event loop
+        self._action_semaphore = None  # type: asyncio.Semaphore
+        self._scheduling_locks = {}  # type: Dict[str, asyncio.Lock]
 
     @property
     def federations_available(self) -> bool:
@@ -2771,6 +3791,26 @@ class FederationProcessor():
                     self.csh, self.bsh, pool, poolset)
         self.federations[fedhash].trim_orphaned_pools(poolset)
 
+    async def _run_blocking(self, func, *args) -> Any:
+        """Run a blocking call on the service executor
+        :param func: function to call
+        :param args: function arguments
+        :return: function result
+        """
+        return await self._service_proxy.run_blocking(func, *args)
+
+    def _scheduling_lock(self, fedhash: str) -> asyncio.Lock:
+        """Get the lock serializing pool matching within a federation
+        :param fedhash: federation hash
+        :return: scheduling lock
+        """
+        try:
+            return self._scheduling_locks[fedhash]
+        except KeyError:
+            lock = asyncio.Lock()
+            self._scheduling_locks[fedhash] = lock
+            return lock
+
     def update_federations(self) -> None:
         """Update federations"""
         entities = list(self.fdh.get_all_federations())
@@ -2802,37 +3842,57 @@ class FederationProcessor():
         logger.debug(
             'attempting to match job {} with {} tasks in fed {} uid={}'.format(
                 job.id, num_tasks, fedhash, unique_id))
+        federation = self.federations[fedhash]
         blacklist = set()
+        data_locations = None
+        sr = federation.scheduling_round
+        if sr is not None and unique_id in sr.data_locations:
+            data_locations = sr.data_locations[unique_id]
+        elif self.fdh.placement_engine.requires_data_locations:
+            data_locations = await self._run_blocking(
+                lambda: get_data_locations_for_tasks(
+                    task_map,
+                    self.fdh.service_proxy.get_storage_account_locations()))
         while True:
-            poolrk = self.federations[fedhash].find_target_pool_for_job(
-                self.bsh, self.fdh, num_tasks, constraints, blacklist,
-                unique_id, job.id)
-            if poolrk is not None:
-                cj = await self.federations[fedhash].create_job(
+            # pool matching and job creation must be serialized with other
+            # targets in the federation, task submission need not be
+            async with self._scheduling_lock(fedhash):
+                poolrk = await self._run_blocking(
+                    federation.find_target_pool_for_job, self.bsh, self.fdh,
+                    num_tasks, constraints, blacklist, unique_id, job.id,
+                    data_locations)
+                if poolrk is None:
+                    return False
+                cj = await federation.create_job(
                     self.bsh, poolrk, job, constraints)
-                if cj:
-                    # remove blocked action if any
-                    self.fdh.remove_blocked_action_for_job(fedhash, job.id)
-                    # track job prior to adding tasks in case task
-                    # addition fails
-                    self.federations[fedhash].track_job(
-                        self.fdh, poolrk, job.id, False, None)
-                    # schedule tasks
-                    self.federations[fedhash].schedule_tasks(
-                        self.bsh, self.fdh, poolrk, job.id, constraints,
-                        naming, task_map)
-                    # update job tracking
-                    self.federations[fedhash].track_job(
-                        self.fdh, poolrk, job.id, False, unique_id)
-                    break
-                else:
+                if not cj:
                     logger.debug(
                         'blacklisting pool hash={} in fed hash {} '
                         'uid={} for job {}'.format(
                             poolrk, fedhash, unique_id, job.id))
                     blacklist.add(poolrk)
-            else:
-                return False
+                    continue
+                # remove blocked action if any
+                await self._run_blocking(
+                    self.fdh.remove_blocked_action_for_job, fedhash, job.id)
+                # track job prior to adding tasks in case task
+                # addition fails
+                await self._run_blocking(
+                    federation.track_job, self.fdh, poolrk, job.id, False,
+                    None)
+                # start the blackout on the pool now so that concurrently
+                # matched targets do not select it with stale counts
+                federation.pools[poolrk].on_new_tasks_scheduled(
+                    self.bsh, self.fdh.scheduling_blackout, False)
+            # schedule tasks
+            await self._run_blocking(
+                federation.schedule_tasks, self.bsh, self.fdh, poolrk,
+                job.id, constraints, naming, task_map)
+            # update job tracking
+            await self._run_blocking(
+                federation.track_job, self.fdh, poolrk, job.id, False,
+                unique_id)
+            break
         return True
 
     async def add_job_schedule_v1(
@@ -2845,7 +3905,9 @@ class FederationProcessor():
         # ensure there is no existing job schedule. although this is checked
         # at submission time, a similarly named job schedule can be enqueued
         # multiple times before the action is dequeued
-        if self.fdh.location_entities_exist_for_job(fedhash, job_schedule.id):
+        if await self._run_blocking(
+                self.fdh.location_entities_exist_for_job, fedhash,
+                job_schedule.id):
             logger.error(
                 'job schedule {} already exists for fed {} uid={}'.format(
                     job_schedule.id, fedhash, unique_id))
@@ -2854,30 +3916,34 @@ class FederationProcessor():
         logger.debug(
             'attempting to match job schedule {} with {} tasks in fed {} '
             'uid={}'.format(job_schedule.id, num_tasks, fedhash, unique_id))
+        federation = self.federations[fedhash]
         blacklist = set()
         while True:
-            poolrk = self.federations[fedhash].find_target_pool_for_job(
-                self.bsh, self.fdh, num_tasks, constraints, blacklist,
-                unique_id, job_schedule.id)
-            if poolrk is not None:
-                cj = await self.federations[fedhash].create_job_schedule(
+            async with self._scheduling_lock(fedhash):
+                poolrk = await self._run_blocking(
+                    federation.find_target_pool_for_job, self.bsh, self.fdh,
+                    num_tasks, constraints, blacklist, unique_id,
+                    job_schedule.id)
+                if poolrk is None:
+                    return False
+                cj = await federation.create_job_schedule(
                     self.bsh, poolrk, job_schedule, constraints)
-                if cj:
-                    # remove blocked action if any
-                    self.fdh.remove_blocked_action_for_job(
-                        fedhash, job_schedule.id)
-                    # track job schedule
-                    self.federations[fedhash].track_job(
-                        self.fdh, poolrk, job_schedule.id, True, unique_id)
-                    break
-                else:
+                if not cj:
                     logger.debug(
                         'blacklisting pool hash={} in fed hash {} '
                         'uid={} for job schedule {}'.format(
                             poolrk, fedhash, unique_id, job_schedule.id))
                     blacklist.add(poolrk)
-            else:
-                return False
+                    continue
+            # remove blocked action if any
+            await self._run_blocking(
+                self.fdh.remove_blocked_action_for_job, fedhash,
+                job_schedule.id)
+            # track job schedule
+            await self._run_blocking(
+                federation.track_job, self.fdh, poolrk, job_schedule.id, True,
+                unique_id)
+            break
         return True
 
     async def _terminate_job(
@@ -2886,14 +3952,14 @@ class FederationProcessor():
         job_id: str,
         is_job_schedule: bool,
         entity: azure.cosmosdb.table.models.Entity,
-    ) -> None:
+    ) -> bool:
         if 'TerminateTimestamp' in entity:
             logger.debug(
                 '{} {} for fed {} has already been terminated '
                 'at {}'.format(
                     'job schedule' if is_job_schedule else 'job',
                     job_id, fedhash, entity['TerminateTimestamp']))
-            return
+            return False
         await self.bsh.delete_or_terminate_job(
             entity['BatchAccount'], entity['ServiceUrl'], job_id, False,
             is_job_schedule, wait=False)
@@ -2903,13 +3969,7 @@ class FederationProcessor():
                 'job schedule' if is_job_schedule else 'job',
                 job_id, entity['PoolId'], fedhash, entity['BatchAccount'],
                 entity['ServiceUrl']))
-        while True:
-            entity['TerminateTimestamp'] = datetime_utcnow(as_string=False)
-            if self.fdh.insert_or_update_entity_with_etag_for_job(entity):
-                break
-            else:
-                # force update
-                entity['etag'] = '*'
+        return True
 
     async def _delete_job(
         self,
@@ -2917,7 +3977,7 @@ class FederationProcessor():
         job_id: str,
         is_job_schedule: bool,
         entity: azure.cosmosdb.table.models.Entity,
-    ) -> None:
+    ) -> bool:
         await self.bsh.delete_or_terminate_job(
             entity['BatchAccount'], entity['ServiceUrl'], job_id, True,
             is_job_schedule, wait=False)
@@ -2927,7 +3987,7 @@ class FederationProcessor():
                 'job schedule' if is_job_schedule else 'job',
                 job_id, entity['PoolId'], fedhash, entity['BatchAccount'],
                 entity['ServiceUrl']))
-        self.fdh.delete_location_entity_for_job(entity)
+        return True
 
     async def delete_or_terminate_job_v1(
         self,
@@ -2937,24 +3997,52 @@ class FederationProcessor():
         is_job_schedule: bool,
         unique_id: str
     ) -> None:
+        method = 'delete' if delete else 'terminate'
+        kind = 'job schedule' if is_job_schedule else 'job'
         # find all jobs across federation mathching the id
-        entities = self.fdh.get_all_location_entities_for_job(fedhash, job_id)
-        # terminate each pool-level job representing federation job
-        tasks = []
-        coro = self._delete_job if delete else self._terminate_job
-        for entity in entities:
-            tasks.append(
-                asyncio.ensure_future(
-                    coro(fedhash, job_id, is_job_schedule, entity)))
-        if len(tasks) > 0:
-            await asyncio.wait(tasks)
-        else:
+        entities = await self._run_blocking(
+            lambda: list(self.fdh.get_all_location_entities_for_job(
+                fedhash, job_id) or []))
+        if len(entities) == 0:
             logger.error(
                 'cannot {} {} {} for fed {}, no location entities '
                 'exist (uid={})'.format(
-                    'delete' if delete else 'terminate',
-                    'job schedule' if is_job_schedule else 'job',
-                    job_id, fedhash, unique_id))
+                    method, kind, job_id, fedhash, unique_id))
+            return
+        # act on each pool-level job representing federation job
+        # concurrently, service calls are bounded by the service executor
+        coro = self._delete_job if delete else self._terminate_job
+        results = await asyncio.gather(
+            *[coro(fedhash, job_id, is_job_schedule, entity)
+              for entity in entities],
+            return_exceptions=True)
+        updated = []
+        failed = 0
+        for entity, result in zip(entities, results):
+            if isinstance(result, Exception):
+                failed += 1
+                logger.error(
+                    'could not {} {} {} on pool {} for fed {} '
+                    '(batch_account={} service_url={}): {}'.format(
+                        method, kind, job_id, entity['PoolId'], fedhash,
+                        entity['BatchAccount'], entity['ServiceUrl'],
+                        result), exc_info=result)
+            elif result:
+                updated.append(entity)
+        # update location entities in batch
+        if len(updated) > 0:
+            if delete:
+                await self._run_blocking(
+                    self.fdh.delete_location_entities_for_job, updated)
+            else:
+                await self._run_blocking(
+                    self.fdh.set_terminate_timestamp_for_location_entities,
+                    updated)
+        logger.info(
+            '{} {} {} for fed {} on {} of {} pools ({} failed, '
+            'uid={})'.format(
+                method, kind, job_id, fedhash, len(entities) - failed,
+                len(entities), failed, unique_id))
 
     async def process_message_action_v1(
         self,
@@ -3029,7 +4117,8 @@ class FederationProcessor():
     async def process_queue_message_v1(
             self,
             fedhash: str,
-            msg: Dict[str, Any]
+            msg: Dict[str, Any],
+            offset: int = 0,
     ) -> Tuple[bool, str]:
         result = True
         target_fedid = msg['federation_id']
@@ -3041,15 +4130,18 @@ class FederationProcessor():
             return result, None
         target = msg['target']
         unique_id = msg['uuid']
-        # get sequence from table
-        seq_id = self.fdh.get_first_sequence_id_for_job(fedhash, target)
+        # get sequence from table, skipping ids processed but not yet
+        # popped off of the sequence
+        seq_id = await self._run_blocking(
+            self.fdh.get_first_sequence_id_for_job, fedhash, target, offset)
         if seq_id is None:
             logger.error(
                 'sequence length is missing or non-positive for uid={} for '
                 'target {} on federation {}'.format(
                     unique_id, target, fedhash))
             # remove blocked action if any
-            self.fdh.remove_blocked_action_for_job(fedhash, target)
+            await self._run_blocking(
+                self.fdh.remove_blocked_action_for_job, fedhash, target)
             return result, None
         # if there is a sequence mismatch, then queue is no longer FIFO
         # get the appropriate next sequence id and construct the blob url
@@ -3064,21 +4156,34 @@ class FederationProcessor():
         else:
             blob_url = msg['blob_data']
         del seq_id
-        # retrieve message data from blob
+        # retrieve message data from blob if not prefetched for the
+        # scheduling round
         job_data = None
+        sr = self.federations[fedhash].scheduling_round
+        prefetched = (
+            sr.payloads.pop(unique_id, None) if sr is not None else None
+        )
         try:
-            blob_client, container, blob_name, data = \
-                self.fdh.retrieve_blob_data(blob_url)
+            if prefetched is not None:
+                blob_client, container, blob_name, job_data = prefetched
+                data = None
+            else:
+                blob_client, container, blob_name, data = \
+                    await self._run_blocking(
+                        self.fdh.retrieve_blob_data, blob_url)
         except Exception as exc:
             logger.exception(str(exc))
             logger.error(
                 'cannot process queue message for sequence id {} for '
                 'fed {}'.format(unique_id, fedhash))
             # remove blocked action if any
-            self.fdh.remove_blocked_action_for_job(fedhash, target)
+            await self._run_blocking(
+                self.fdh.remove_blocked_action_for_job, fedhash, target)
             return False, target
         else:
-            job_data = pickle.loads(data, fix_imports=True)
+            if data is not None:
+                job_data = await self._run_blocking(
+                    decode_federation_payload, data)
             del data
         del blob_url
         # process message
@@ -3087,40 +4192,242 @@ class FederationProcessor():
                 fedhash, job_data, unique_id)
             # cleanup
             if result:
-                self.fdh.delete_blob(blob_client, container, blob_name)
+                await self._run_blocking(
+                    self.fdh.delete_blob, blob_client, container, blob_name)
             else:
                 target = None
         return result, target
 
+    async def process_target_messages(
+            self,
+            fedhash: str,
+            msgs: List[Tuple[azure.storage.queue.models.QueueMessage,
+                             Dict[str, Any]]],
+            metrics: ActionLatencyMetrics,
+            leases: FederationMessageLeases,
+    ) -> None:
+        """Process messages for a single target in sequence order. The
+        target sequence is updated and messages are deleted once for all
+        processed messages.
+        :param fedhash: federation hash
+        :param msgs: list of queue message and decoded message data tuples
+        :param metrics: metrics to record action latencies to
+        :param leases: leases of dequeued messages
+        """
+        completed = []
+        seq_target = None
+        popped = 0
+        async with self._action_semaphore:
+            try:
+                for msg, msg_data in msgs:
+                    if not await self.check_global_lock(backoff=False):
+                        logger.error(
+                            'global lock lease lost while processing queue '
+                            'for fed {}'.format(fedhash))
+                        return
+                    try:
+                        queue_wait = (
+                            datetime_utcnow(as_string=False) -
+                            msg.insertion_time
+                        ).total_seconds()
+                    except TypeError:
+                        queue_wait = None
+                    start = time.perf_counter()
+                    if msg_data['version'] == '1':
+                        del_msg, target = \
+                            await self.process_queue_message_v1(
+                                fedhash, msg_data, popped)
+                    else:
+                        logger.error(
+                            'cannot process message version {} for '
+                            'fed {}'.format(msg_data['version'], fedhash))
+                        del_msg = True
+                        target = None
+                    metrics.record(time.perf_counter() - start, queue_wait)
+                    if is_not_empty(target):
+                        seq_target = target
+                        popped += 1
+                    if del_msg:
+                        completed.append(msg.id)
+                    else:
+                        # remaining actions for the target are blocked
+                        # behind this action, retry on the next dequeue
+                        break
+            finally:
+                # pop processed ids off of the sequence prior to deleting
+                # messages
+                if popped > 0:
+                    await self._run_blocking(
+                        self.fdh.dequeue_sequence_ids_from_federation_sequence,
+                        fedhash, seq_target, popped)
+                if len(completed) > 0:
+                    await self._run_blocking(leases.complete, completed)
+
+    def _message_visibility_timeout(self, federation: Federation) -> int:
+        """Get the visibility timeout for dequeued messages from the
+        observed action processing time
+        :param federation: federation
+        :return: visibility timeout in seconds
+        """
+        metrics = federation.action_metrics
+        if metrics.count == 0:
+            return _MIN_MESSAGE_VISIBILITY_TIMEOUT
+        return int(min((
+            max((2 * metrics.processing_total / metrics.count,
+                 _MIN_MESSAGE_VISIBILITY_TIMEOUT)),
+            _MAX_MESSAGE_VISIBILITY_TIMEOUT,
+        )))
+
+    async def renew_message_leases(
+            self,
+            fedhash: str,
+            leases: FederationMessageLeases,
+    ) -> None:
+        """Periodically extend leases on messages being processed
+        :param fedhash: federation hash
+        :param leases: leases of dequeued messages
+        """
+        while True:
+            await asyncio.sleep(leases.visibility_timeout / 2)
+            try:
+                await self._run_blocking(leases.renew)
+            except Exception as exc:
+                logger.error(
+                    'error renewing message leases for fed {}: {}'.format(
+                        fedhash, exc), exc_info=exc)
+
+    async def prefetch_target_head(
+            self,
+            fedhash: str,
+            msg_data: Dict[str, Any],
+    ) -> Optional[Tuple[str, str, Constraints, int]]:
+        """Prefetch the message data at the head of a target sequence into
+        the scheduling round
+        :param fedhash: federation hash
+        :param msg_data: decoded queue message data
+        :return: tuple of unique id, target, constraints and number of
+            tasks if the head action is a job add
+        """
+        if msg_data.get('version') != '1':
+            return None
+        sr = self.federations[fedhash].scheduling_round
+        target = msg_data['target']
+        async with self._action_semaphore:
+            unique_id = await self._run_blocking(
+                self.fdh.get_first_sequence_id_for_job, fedhash, target)
+            if unique_id is None:
+                return None
+            if unique_id == msg_data['uuid']:
+                blob_url = msg_data['blob_data']
+            else:
+                blob_url = self.fdh.construct_blob_url(fedhash, unique_id)
+            blob_client, container, blob_name, data = \
+                await self._run_blocking(
+                    self.fdh.retrieve_blob_data, blob_url)
+            job_data = await self._run_blocking(
+                decode_federation_payload, data)
+            del data
+        sr.payloads[unique_id] = (blob_client, container, blob_name, job_data)
+        if (job_data is None or job_data['version'] != '1' or
+                job_data['action']['kind'] != 'job' or
+                job_data['action']['method'] != 'add'):
+            return None
+        task_map = job_data['task_map']
+        if self.fdh.placement_engine.requires_data_locations:
+            sr.data_locations[unique_id] = await self._run_blocking(
+                lambda: get_data_locations_for_tasks(
+                    task_map,
+                    self.fdh.service_proxy.get_storage_account_locations()))
+        return (
+            unique_id, target, Constraints(job_data['job']['constraints']),
+            len(task_map),
+        )
+
+    async def prepare_scheduling_round(
+            self,
+            fedhash: str,
+            targets: Dict[str, List[Tuple[
+                azure.storage.queue.models.QueueMessage, Dict[str, Any]]]],
+    ) -> None:
+        """Start a scheduling round for the dequeued messages: prefetch
+        the head message of each target, refresh pools once and plan
+        placements for the job add actions jointly
+        :param fedhash: federation hash
+        :param targets: messages grouped by target
+        """
+        federation = self.federations[fedhash]
+        federation.scheduling_round = SchedulingRound()
+        heads = [
+            x[0][1] for x in targets.values() if 'target' in x[0][1]
+        ]
+        results = await asyncio.gather(
+            *[self.prefetch_target_head(fedhash, x) for x in heads],
+            return_exceptions=True)
+        jobs = []
+        for result in results:
+            if isinstance(result, Exception):
+                # the action is retried without prefetched data when the
+                # target is processed
+                logger.error(
+                    'error prefetching target for fed {}: {}'.format(
+                        fedhash, result), exc_info=result)
+            elif result is not None:
+                jobs.append(result)
+        async with self._scheduling_lock(fedhash):
+            await self._run_blocking(
+                federation.plan_scheduling_round, self.bsh, self.fdh, jobs)
+
     async def process_federation_queue(self, fedhash: str) -> None:
-        acquired = self.federations[fedhash].lock.acquire(blocking=False)
+        federation = self.federations[fedhash]
+        acquired = federation.lock.acquire(blocking=False)
         if not acquired:
             logger.debug('could not acquire lock on federation {}'.format(
                 fedhash))
             return
         try:
-            msgs = self.fdh.get_messages_from_federation_queue(fedhash)
+            start = time.perf_counter()
+            visibility_timeout = self._message_visibility_timeout(federation)
+            msgs = await self._run_blocking(
+                self.fdh.get_messages_from_federation_queue, fedhash,
+                visibility_timeout)
+            # group messages by target, retaining queue order within each
+            # target such that the per-target sequence is honored
+            targets = collections.OrderedDict()
             for msg in msgs:
-                if not await self.check_global_lock(backoff=False):
-                    logger.error(
-                        'global lock lease lost while processing queue for '
-                        'fed {}'.format(fedhash))
-                    return
                 msg_data = json.loads(msg.content, encoding='utf8')
-                if msg_data['version'] == '1':
-                    del_msg, target = await self.process_queue_message_v1(
-                        fedhash, msg_data)
-                else:
+                key = msg_data.get('target', msg.id)
+                targets.setdefault(key, []).append((msg, msg_data))
+            if len(targets) == 0:
+                return
+            leases = FederationMessageLeases(
+                self.fdh, fedhash, msgs, visibility_timeout)
+            renewer = asyncio.ensure_future(
+                self.renew_message_leases(fedhash, leases))
+            try:
+                await self.prepare_scheduling_round(fedhash, targets)
+                metrics = ActionLatencyMetrics()
+                results = await asyncio.gather(
+                    *[self.process_target_messages(
+                        fedhash, x, metrics, leases)
+                      for x in targets.values()],
+                    return_exceptions=True)
+            finally:
+                renewer.cancel()
+                await self._run_blocking(leases.release)
+            for result in results:
+                if isinstance(result, Exception):
                     logger.error(
-                        'cannot process message version {} for fed {}'.format(
-                            msg_data['version'], fedhash))
-                    del_msg = True
-                    target = None
-                # delete message
-                self.fdh.dequeue_sequence_id_from_federation_sequence(
-                    del_msg, fedhash, msg.id, msg.pop_receipt, target)
+                        'error processing target for fed {}: {}'.format(
+                            fedhash, result), exc_info=result)
+            federation.action_metrics.merge(metrics)
+            logger.info(
+                'processed fed {} queue in {:.3f}s across {} targets: {} '
+                '(cumulative: {})'.format(
+                    fedhash, time.perf_counter() - start, len(targets),
+                    metrics, federation.action_metrics))
         finally:
-            self.federations[fedhash].lock.release()
+            federation.scheduling_round = None
+            federation.lock.release()
 
     async def check_global_lock(
         self,
@@ -3135,20 +4442,42 @@ class FederationProcessor():
     async def iterate_and_process_federation_queues(
         self
     ) -> Generator[None, None, None]:
+        self._action_semaphore = asyncio.Semaphore(
+            self.max_concurrent_actions)
         while True:
             if not await self.check_global_lock():
                 continue
             if self.federations_available:
-                # TODO process in parallel
-                for fedhash in self.federations:
-                    try:
-                        await self.process_federation_queue(fedhash)
-                    except Exception as exc:
-                        logger.exception(str(exc))
-                    if not await self.check_global_lock(backoff=False):
-                        break
+                fedhashes = list(self.federations.keys())
+                results = await asyncio.gather(
+                    *[self.process_federation_queue(x) for x in fedhashes],
+                    return_exceptions=True)
+                for fedhash, result in zip(fedhashes, results):
+                    if isinstance(result, Exception):
+                        logger.error(
+                            'error processing queue for fed {}: {}'.format(
+                                fedhash, result), exc_info=result)
             await asyncio.sleep(self.action_refresh_interval)
 
+    async def iterate_and_refresh_pool_capacities(
+        self
+    ) -> Generator[None, None, None]:
+        """Refresh pool capacities of accounts as they become due"""
+        cache = self.bsh.capacity_cache
+        while True:
+            if not await self.check_global_lock():
+                continue
+            accounts = cache.accounts_due_for_refresh()
+            results = await asyncio.gather(
+                *[self._run_blocking(cache.refresh, *x) for x in accounts],
+                return_exceptions=True)
+            for account, result in zip(accounts, results):
+                if isinstance(result, Exception):
+                    logger.error(
+                        'error refreshing pool capacities for account '
+                        '{}: {}'.format(account[0], result), exc_info=result)
+            await asyncio.sleep(1)
+
     async def poll_for_federations(
         self,
         loop: asyncio.BaseEventLoop,
@@ -3173,21 +4502,97 @@ class FederationProcessor():
         # begin message processing
         asyncio.ensure_future(
             self.iterate_and_process_federation_queues(), loop=loop)
+        asyncio.ensure_future(
+            self.iterate_and_refresh_pool_capacities(), loop=loop)
         # continuously update federations
         while True:
             if not await self.check_global_lock():
                 continue
             try:
-                self.update_federations()
+                # update off of the event loop as pool updates contend
+                # for federation locks held while processing actions and
+                # would otherwise stall action processing and lock renewal
+                await loop.run_in_executor(None, self.update_federations)
             except Exception as exc:
                 logger.exception(str(exc))
             await asyncio.sleep(self.fed_refresh_interval)
 
 
+def simulate_placement(trace: Dict[str, Any]) -> Dict[str, Any]:
+    """Replay a queue of jobs against a snapshot of pool capacities with
+    each placement policy
+    :param trace: trace with placement options, pools and jobs
+    :return: placement results per policy
+    """
+    results = {}
+    for policy in trace.get('policies', sorted(_PLACEMENT_ENGINES.keys())):
+        options = dict(trace.get('placement', {}))
+        options['policy'] = policy
+        options = PlacementOptions(options)
+        engine = create_placement_engine(options)
+        capacities = collections.OrderedDict()
+        for rk, conf in trace['pools'].items():
+            dedicated = conf.get('dedicated', {})
+            low_priority = conf.get('low_priority', {})
+            capacities[rk] = PoolCapacity(
+                location=conf['location'].lower(),
+                vm_size=conf['vm_size'].lower(),
+                slots_per_node=conf.get('task_slots_per_node', 1),
+                dedicated_idle=dedicated.get('idle', 0),
+                dedicated_available=dedicated.get('available', 0),
+                low_priority_idle=low_priority.get('idle', 0),
+                low_priority_available=low_priority.get('available', 0),
+                active_tasks=conf.get('active_tasks', 0),
+                autoscale=conf.get('autoscale', False),
+                autoscale_steady=conf.get('autoscale', False),
+            )
+        placements = []
+        locality = []
+        price = 0.0
+        for job in trace['jobs']:
+            jc = job.get('constraints', {})
+            constraints = Constraints({
+                'pool': jc.get('pool', {}),
+                'compute_node': jc.get('compute_node', {}),
+                'task': jc.get('task', {}),
+            })
+            data_locations = job.get('data_locations')
+            rk = engine.select_pool(
+                job['id'], constraints, capacities, data_locations)
+            placements.append({'job': job['id'], 'pool': rk})
+            if rk is None:
+                continue
+            cap = capacities[rk]
+            nodes = cap.consume(engine, constraints, job.get(
+                'num_tasks', constraints.task.instance_counts_total))
+            if is_not_empty(data_locations):
+                locality.append(ScoredPlacementEngine.locality_score(
+                    cap, data_locations))
+            vm_price = options.vm_prices.get(cap.vm_size)
+            if vm_price is not None:
+                price += vm_price * nodes
+        results[policy] = {
+            'placed': sum(1 for x in placements if x['pool'] is not None),
+            'unplaced': sum(1 for x in placements if x['pool'] is None),
+            'data_locality': (
+                sum(locality) / len(locality) if len(locality) > 0 else None
+            ),
+            'price_per_hour': price,
+            'placements': placements,
+        }
+    return results
+
+
 def main() -> None:
     """Main function"""
     # get command-line args
     args = parseargs()
+    # replay a trace with placement policies
+    if is_not_empty(args.simulate):
+        with open(args.simulate, 'rb') as f:
+            trace = json.load(f)
+        print(json.dumps(simulate_placement(trace), indent=4))
+        return
     # load configuration
     if is_none_or_empty(args.conf):
         raise ValueError('config file not specified')
@@ -3223,6 +4628,9 @@ def parseargs() -> argparse.Namespace:
     parser = argparse.ArgumentParser(
         description='federation: Azure Batch Shipyard Federation Controller')
     parser.add_argument('--conf', help='configuration file')
+    parser.add_argument(
+        '--simulate',
+        help='replay a placement trace file with each placement policy')
     return parser.parse_args()
 
 
@@ -27,11 +27,17 @@
 # stdlib imports
 import argparse
 import asyncio
+import collections
+import concurrent.futures
 import hashlib
+import http.server
 import json
 import logging
 import logging.handlers
+import multiprocessing
 import pathlib
+import threading
+import time
 from typing import (
     Any,
     Dict,
@@ -42,11 +48,14 @@ from typing import (
 # non-stdlib imports
 import azure.batch
 import azure.batch.models as batchmodels
+import azure.common
 import azure.cosmosdb.table
 import azure.mgmt.compute
 import azure.mgmt.network
 import azure.mgmt.resource
 import azure.mgmt.storage
+import azure.storage.queue
+import msrest.exceptions
 import msrestazure.azure_active_directory
 import msrestazure.azure_cloud
 
@@ -55,6 +64,23 @@ logger = logging.getLogger(__name__)
 # global defines
 _BATCH_SHIPYARD_VERSION = None
 _BATCH_CLIENTS = {}
+_BATCH_CLIENTS_LOCK = threading.Lock()
+_DISCOVERY_METRICS = {}
+_DISCOVERY_METRICS_LOCK = threading.Lock()
+_BATCH_METRICS = {}
+_BATCH_METRICS_LOCK = threading.Lock()
+_PRIVATE_IP_CACHE = {}
+_PRIVATE_IP_CACHE_LOCK = threading.Lock()
+_BATCH_METRICS_HELP = collections.OrderedDict((
+    ('batch_pool_nodes', 'Number of compute nodes in a pool by state'),
+    ('batch_pool_current_nodes', 'Current number of compute nodes in a pool'),
+    ('batch_pool_target_nodes', 'Target number of compute nodes in a pool'),
+    ('batch_pool_resize_errors', 'Number of resize errors of a pool'),
+    ('batch_job_tasks', 'Number of tasks in an active job by state'),
+    ('batch_shipyard_federation_queue_messages',
+     'Approximate number of action messages queued for a federation'),
+))
+_MAX_EXECUTOR_WORKERS = min((multiprocessing.cpu_count() * 4, 32))
 _VALID_NODE_STATES = frozenset((
     batchmodels.ComputeNodeState.idle,
     batchmodels.ComputeNodeState.offline,
@@ -65,6 +91,10 @@ _VALID_NODE_STATES = frozenset((
 ))
 _MONITOR_BATCHPOOL_PK = 'BatchPool'
 _MONITOR_REMOTEFS_PK = 'RemoteFS'
+_MONITOR_HEIMDALL_PK = 'Heimdall'
+_ALL_FEDERATIONS_PK = '!!FEDERATIONS'
+_TARGETS_FULL_REFRESH_INTERVAL = 300
+_PRIVATE_IP_CACHE_TTL = 3600
 
 
 def _setup_logger() -> None:
@@ -99,6 +129,14 @@ def is_not_empty(obj):
     return obj is not None and len(obj) > 0
 
 
+def max_workers_for_executor(iterable: Any) -> int:
+    """Get max number of workers for executor given an iterable
+    :param iterable: an iterable
+    :return: number of workers for executor
+    """
+    return max((min((len(iterable), _MAX_EXECUTOR_WORKERS)), 1))
+
+
 def convert_cloud_type(cloud_type: str) -> msrestazure.azure_cloud.Cloud:
     """Convert clout type string to object
     :param cloud_type: cloud type to convert
@@ -225,6 +263,30 @@ def create_table_client(
     )
 
 
+def create_queue_client(
+        cloud: msrestazure.azure_cloud.Cloud,
+        arm_creds: msrestazure.azure_active_directory.MSIAuthentication,
+        sub_id: str,
+        storage_account: str,
+        resource_group: str
+) -> azure.storage.queue.QueueService:
+    """Create a queue client for the given storage account
+    :param cloud: cloud object
+    :param arm_creds: ARM creds
+    :param sub_id: subscription id
+    :param storage_account: storage account name
+    :param resource_group: resource group
+    :return: queue client
+    """
+    key, ep = _get_storage_account_key(
+        cloud, arm_creds, sub_id, storage_account, resource_group)
+    return azure.storage.queue.QueueService(
+        account_name=storage_account,
+        account_key=key,
+        endpoint_suffix=ep,
+    )
+
+
 def create_compute_client(
         cloud: msrestazure.azure_cloud.Cloud,
         arm_creds: msrestazure.azure_active_directory.MSIAuthentication,
@@ -277,16 +339,20 @@ def _get_batch_credentials(
     :return: batch client
     """
     global _BATCH_CLIENTS
-    try:
-        return _BATCH_CLIENTS[batch_account]
-    except KeyError:
-        creds = create_msi_credentials(cloud, resource_id=resource_id)
-        client = azure.batch.BatchServiceClient(creds, batch_url=service_url)
-        _modify_client_for_retry_and_user_agent(client)
-        _BATCH_CLIENTS[batch_account] = client
-        logger.debug('batch client created for account: {}'.format(
-            batch_account))
-        return client
+    key = (batch_account, service_url)
+    with _BATCH_CLIENTS_LOCK:
+        try:
+            return _BATCH_CLIENTS[key]
+        except KeyError:
+            creds = create_msi_credentials(cloud, resource_id=resource_id)
+            client = azure.batch.BatchServiceClient(
+                creds, batch_url=service_url)
+            _modify_client_for_retry_and_user_agent(client)
+            _BATCH_CLIENTS[key] = client
+            logger.debug(
+                'batch client created for account: {} ({})'.format(
+                    batch_account, service_url))
+            return client
 
 
 def _construct_batch_monitoring_list(
@@ -376,25 +442,189 @@ def _construct_batch_monitoring_list(
     return targets
 
 
+def _write_targets_file(
+        targets_file: pathlib.Path,
+        targets: List[Dict],
+        last_hash: bytes
+) -> bytes:
+    """Write a prometheus targets file if its targets changed
+    :param targets_file: prom targets file
+    :param targets: targets
+    :param last_hash: last SHA256 digest of targets
+    :returned: hashed targets
+    """
+    ret = None
+    if is_none_or_empty(targets):
+        if last_hash is not None or targets_file.exists():
+            logger.debug('removing prometheus targets file {}'.format(
+                targets_file.name))
+        try:
+            targets_file.unlink()
+        except OSError:
+            pass
+    else:
+        output = json.dumps(
+            targets, ensure_ascii=False, sort_keys=True).encode('utf8')
+        sha = hashlib.sha256()
+        sha.update(output)
+        ret = sha.digest()
+        if ret != last_hash:
+            logger.debug('prometheus targets for {}: {}'.format(
+                targets_file.name, targets))
+            with targets_file.open('wb') as f:
+                f.write(output)
+    return ret
+
+
+def _query_account_pools(
+        batch_client: azure.batch.BatchServiceClient,
+        batch_account: str,
+        poolids: List[str]
+) -> Tuple[Dict[str, List], List[Tuple[str, Dict[str, str], int]]]:
+    """Get markers which change with pool allocation and node states and
+    pool metrics for pools in an account with account level calls
+    :param batch_client: batch client
+    :param batch_account: batch account name
+    :param poolids: pool ids
+    :return: tuple of map of pool id -> marker and metric samples, both
+        None on error
+    """
+    markers = {}
+    samples = []
+    try:
+        pools = batch_client.pool.list(
+            pool_list_options=batchmodels.PoolListOptions(
+                select='id,state,allocationState,'
+                'allocationStateTransitionTime,currentDedicatedNodes,'
+                'currentLowPriorityNodes,targetDedicatedNodes,'
+                'targetLowPriorityNodes,resizeErrors',
+            ),
+        )
+        for pool in pools:
+            if pool.id not in poolids:
+                continue
+            markers[pool.id] = [
+                pool.state, pool.allocation_state,
+                pool.allocation_state_transition_time,
+            ]
+            labels = {'account': batch_account, 'pool': pool.id}
+            for node_type, current, target in (
+                    ('dedicated', pool.current_dedicated_nodes,
+                     pool.target_dedicated_nodes),
+                    ('low_priority', pool.current_low_priority_nodes,
+                     pool.target_low_priority_nodes),
+            ):
+                type_labels = dict(labels, node_type=node_type)
+                samples.append(
+                    ('batch_pool_current_nodes', type_labels, current or 0))
+                samples.append(
+                    ('batch_pool_target_nodes', type_labels, target or 0))
+            samples.append((
+                'batch_pool_resize_errors', labels,
+                len(pool.resize_errors or [])))
+        for pnc in batch_client.account.list_pool_node_counts():
+            if pnc.pool_id not in markers:
+                continue
+            markers[pnc.pool_id].extend((
+                pnc.dedicated.as_dict(), pnc.low_priority.as_dict()))
+            for node_type, counts in (
+                    ('dedicated', pnc.dedicated),
+                    ('low_priority', pnc.low_priority),
+            ):
+                for state, count in counts.as_dict().items():
+                    if state == 'total':
+                        continue
+                    samples.append((
+                        'batch_pool_nodes', {
+                            'account': batch_account,
+                            'pool': pnc.pool_id,
+                            'node_type': node_type,
+                            'state': state,
+                        }, count))
+    except (batchmodels.BatchErrorException,
+            msrest.exceptions.ClientRequestError) as e:
+        logger.error('could not query pools of account {}: {}'.format(
+            batch_account, e))
+        return None, None
+    return markers, samples
+
+
+def _query_account_job_task_counts(
+        batch_client: azure.batch.BatchServiceClient,
+        batch_account: str,
+        poolids: List[str]
+) -> List[Tuple[str, Dict[str, str], int]]:
+    """Get task count metrics of active jobs on pools in an account
+    :param batch_client: batch client
+    :param batch_account: batch account name
+    :param poolids: pool ids
+    :return: metric samples or None on error
+    """
+    try:
+        jobs = [
+            job for job in batch_client.job.list(
+                job_list_options=batchmodels.JobListOptions(
+                    filter='state eq \'active\'',
+                    select='id,executionInfo',
+                ),
+            )
+            if job.execution_info is not None and
+            job.execution_info.pool_id in poolids
+        ]
+    except (batchmodels.BatchErrorException,
+            msrest.exceptions.ClientRequestError) as e:
+        logger.error('could not list jobs of account {}: {}'.format(
+            batch_account, e))
+        return None
+
+    def _get_task_counts(job):
+        try:
+            return batch_client.job.get_task_counts(job.id)
+        except (batchmodels.BatchErrorException,
+                msrest.exceptions.ClientRequestError) as e:
+            logger.error('could not get task counts of job {}: {}'.format(
+                job.id, e))
+            return None
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers_for_executor(jobs)) as executor:
+        results = list(executor.map(_get_task_counts, jobs))
+    # keep all prior samples of the account if any job could not be queried
+    if any(task_counts is None for task_counts in results):
+        return None
+    samples = []
+    for job, task_counts in zip(jobs, results):
+        for state, count in task_counts.as_dict().items():
+            samples.append((
+                'batch_job_tasks', {
+                    'account': batch_account,
+                    'job': job.id,
+                    'pool': job.execution_info.pool_id,
+                    'state': state,
+                }, count))
+    return samples
+
+
 def _construct_pool_monitoring_targets(
         cloud: msrestazure.azure_cloud.Cloud,
         table_client: azure.cosmosdb.table.TableService,
         table_name: str,
-        pool_targets_file: pathlib.Path,
-        last_hash: bytes
-) -> bytes:
-    """Read table for pool monitoring
+        prom_var_dir: pathlib.Path,
+        pool_states: Dict[Tuple[str, str], Dict]
+) -> None:
+    """Read table for pool monitoring, collect pool and job metrics and
+    update the targets file of each pool whose allocation or node states
+    changed
     :param cloud: cloud object
     :param table_client: table client
     :param table_name: table name
-    :param pool_targets_file: prom pool targets
-    :param last_hash: last SHA256 digest of pool targets
-    :returned: hashed target dict
+    :param prom_var_dir: prometheus var dir
+    :param pool_states: map of (account, pool id) -> pool target state
     """
-    targets = []
     entities = table_client.query_entities(
         table_name,
         filter='PartitionKey eq \'{}\''.format(_MONITOR_BATCHPOOL_PK))
+    accounts = {}
     for entity in entities:
         batch_account, poolid = entity['RowKey'].split('$')
         logger.debug('{} entity read for account={} poolid={}'.format(
@@ -402,50 +632,103 @@ def _construct_pool_monitoring_targets(
         client = _get_batch_credentials(
             cloud, entity['AadEndpoint'], batch_account,
             entity['BatchServiceUrl'])
-        pt = _construct_batch_monitoring_list(client, poolid)
-        if is_not_empty(pt):
-            targets.extend(pt)
-    ret = None
-    if is_none_or_empty(targets):
-        logger.debug('no prometheus targets for pools found')
-        try:
-            pool_targets_file.unlink()
-        except OSError:
-            pass
-    else:
-        output = json.dumps(
-            targets, ensure_ascii=False, sort_keys=True).encode('utf8')
-        sha = hashlib.sha256()
-        sha.update(output)
-        ret = sha.digest()
-        if ret != last_hash:
-            logger.debug('prometheus targets for pools: {}'.format(targets))
-            with pool_targets_file.open('wb') as f:
-                f.write(output)
-        else:
-            logger.debug('prometheus targets for pools unchanged')
-    return ret
+        accounts.setdefault(batch_account, (client, []))[1].append(poolid)
+
+    def _query_account(batch_account):
+        client, poolids = accounts[batch_account]
+        markers, samples = _query_account_pools(
+            client, batch_account, poolids)
+        return markers, samples, _query_account_job_task_counts(
+            client, batch_account, poolids)
+
+    # check for changes and collect metrics with account level calls
+    # concurrently
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers_for_executor(accounts)) as executor:
+        results = dict(zip(accounts, executor.map(_query_account, accounts)))
+    account_markers = {
+        batch_account: results[batch_account][0] for batch_account in results
+    }
+    samples = {}
+    for batch_account in results:
+        samples['{}$pools'.format(batch_account)] = results[batch_account][1]
+        samples['{}$jobs'.format(batch_account)] = results[batch_account][2]
+    _update_batch_metrics(_MONITOR_BATCHPOOL_PK, samples)
+    now = time.monotonic()
+    changed = []
+    for batch_account in accounts:
+        markers = account_markers[batch_account]
+        for poolid in accounts[batch_account][1]:
+            key = (batch_account, poolid)
+            marker = markers.get(poolid) if markers is not None else None
+            state = pool_states.get(key)
+            if (state is None or markers is None or
+                    state['marker'] != marker or
+                    now - state['refreshed'] >
+                    _TARGETS_FULL_REFRESH_INTERVAL):
+                changed.append((key, marker))
+    logger.debug('{} of {} monitored pools changed'.format(
+        len(changed), sum(len(x[1]) for x in accounts.values())))
+    # re-query changed pools concurrently
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers_for_executor(changed)) as executor:
+        results = list(executor.map(
+            lambda x: _construct_batch_monitoring_list(
+                accounts[x[0][0]][0], x[0][1]),
+            changed))
+    for (key, marker), pt in zip(changed, results):
+        state = pool_states.setdefault(key, {'hash': None})
+        # pools without targets, possibly due to errors, are re-queried
+        state['marker'] = marker if is_not_empty(pt) else None
+        state['refreshed'] = now
+        state['hash'] = _write_targets_file(
+            prom_var_dir / 'batchpool-{}-{}.json'.format(*key), pt,
+            state['hash'])
+    # remove targets of pools no longer monitored
+    for key in list(pool_states):
+        if key[0] not in accounts or key[1] not in accounts[key[0]][1]:
+            _write_targets_file(
+                prom_var_dir / 'batchpool-{}-{}.json'.format(*key), None,
+                pool_states.pop(key)['hash'])
 
 
 def _get_private_ip_from_vm_name(
         compute_client: azure.mgmt.compute.ComputeManagementClient,
         network_client: azure.mgmt.network.NetworkManagementClient,
         vm_rg: str,
-        vm_name: str) -> str:
-    """Get private ip address from vm name
+        vm_name: str,
+        revalidate: bool = False) -> str:
+    """Get private ip address from vm name. Resolved addresses are cached
+    by vm resource id and are only revalidated once the cache entry expires
+    or if requested. The network interface is only re-read if the
+    provisioning state or network interface of the vm changed.
     :param compute_client: compute client
     :param network_client: network client
     :param str vm_rg: resource group name
     :param str vm_name: vm name
+    :param bool revalidate: revalidate cached address
     :return: private ip
     """
+    vm_id = (
+        '/subscriptions/{}/resourceGroups/{}/providers/Microsoft.Compute/'
+        'virtualMachines/{}'
+    ).format(compute_client.config.subscription_id, vm_rg, vm_name).lower()
+    with _PRIVATE_IP_CACHE_LOCK:
+        cached = _PRIVATE_IP_CACHE.get(vm_id)
+    now = time.monotonic()
+    if (cached is not None and not revalidate and
+            now - cached['validated'] <= _PRIVATE_IP_CACHE_TTL):
+        return cached['ip']
     vm = compute_client.virtual_machines.get(
         resource_group_name=vm_rg,
         vm_name=vm_name,
-        expand=compute_client.virtual_machines.models.
-        InstanceViewTypes.instance_view,
     )
     nic_id = vm.network_profile.network_interfaces[0].id
+    if (cached is not None and cached['nic_id'] == nic_id and
+            cached['provisioning_state'] == vm.provisioning_state):
+        with _PRIVATE_IP_CACHE_LOCK:
+            cached['validated'] = now
+        return cached['ip']
     tmp = nic_id.split('/')
     if tmp[-2] != 'networkInterfaces':
         logger.error('could not parse network interface id')
@@ -455,20 +738,44 @@ def _get_private_ip_from_vm_name(
         resource_group_name=vm_rg,
         network_interface_name=nic_name,
     )
-    return nic.ip_configurations[0].private_ip_address
+    ip = nic.ip_configurations[0].private_ip_address
+    with _PRIVATE_IP_CACHE_LOCK:
+        # only cache addresses of vms that are not in transition
+        if ip is not None and vm.provisioning_state == 'Succeeded':
+            _PRIVATE_IP_CACHE[vm_id] = {
+                'ip': ip,
+                'nic_id': nic_id,
+                'provisioning_state': vm.provisioning_state,
+                'validated': now,
+            }
+        else:
+            _PRIVATE_IP_CACHE.pop(vm_id, None)
+    return ip
+
+
+def _prune_private_ip_cache() -> None:
+    """Remove private ip cache entries of vms no longer resolved"""
+    now = time.monotonic()
+    with _PRIVATE_IP_CACHE_LOCK:
+        for vm_id in list(_PRIVATE_IP_CACHE):
+            if (now - _PRIVATE_IP_CACHE[vm_id]['validated'] >
+                    2 * _PRIVATE_IP_CACHE_TTL):
+                _PRIVATE_IP_CACHE.pop(vm_id)
 
 
 def _construct_remotefs_monitoring_list(
         compute_client: azure.mgmt.compute.ComputeManagementClient,
         network_client: azure.mgmt.network.NetworkManagementClient,
         sc_id: str,
-        entity: Dict
+        entity: Dict,
+        revalidate: bool
 ) -> List[Dict]:
     """Construct the remotefs monitoring list
     :param compute_client: compute client
     :param network_client: network client
     :param sc_id: storage cluster id
     :param entity: entity
+    :param revalidate: revalidate cached private ip addresses
     """
     nodelist = []
     ne_port = int(entity['NodeExporterPort'])
@@ -480,21 +787,22 @@ def _construct_remotefs_monitoring_list(
         vm_rg = entity['ResourceGroup']
         vm_name = vms[0]
         pip = _get_private_ip_from_vm_name(
-            compute_client, network_client, vm_rg, vm_name)
+            compute_client, network_client, vm_rg, vm_name, revalidate)
         if pip is not None:
             nodelist.append(pip)
     elif fstype == 'glusterfs':
         rg = entity['ResourceGroup']
         avset = compute_client.availability_sets.get(
             rg, entity['AvailabilitySet'])
-        for sr in avset.virtual_machines:
-            tmp = sr.id.split('/')
-            vm_rg = tmp[4].lower()
-            vm_name = tmp[8].lower()
-            pip = _get_private_ip_from_vm_name(
-                compute_client, network_client, vm_rg, vm_name)
-            if pip is not None:
-                nodelist.append(pip)
+        vm_ids = [sr.id.split('/') for sr in avset.virtual_machines]
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_workers_for_executor(vm_ids)) as executor:
+            pips = list(executor.map(
+                lambda tmp: _get_private_ip_from_vm_name(
+                    compute_client, network_client, tmp[4].lower(),
+                    tmp[8].lower(), revalidate),
+                vm_ids))
+        nodelist.extend(pip for pip in pips if pip is not None)
     else:
         logger.error('unknown fstype {}'.format(fstype))
     if is_none_or_empty(nodelist):
@@ -526,51 +834,269 @@ def _construct_remotefs_monitoring_targets(
         compute_client: azure.mgmt.compute.ComputeManagementClient,
         network_client: azure.mgmt.network.NetworkManagementClient,
         table_name: str,
-        remotefs_targets_file: pathlib.Path,
-        last_hash: bytes
-) -> bytes:
-    """Read table for remotefs monitoring
+        prom_var_dir: pathlib.Path,
+        remotefs_states: Dict[str, Dict]
+) -> None:
+    """Read table for remotefs monitoring and update the targets file of
+    each storage cluster whose entity changed
     :param cloud: cloud object
     :param table_client: table client
     :param compute_client: compute client
     :param network_client: network client
     :param table_name: table name
-    :param remotefs_targets_file: prom remotefs targets
-    :param last_hash: last SHA256 digest of remotefs targets
-    :returned: hashed target dict
+    :param prom_var_dir: prometheus var dir
+    :param remotefs_states: map of storage cluster id -> target state
     """
-    targets = []
-    entities = table_client.query_entities(
-        table_name,
-        filter='PartitionKey eq \'{}\''.format(_MONITOR_REMOTEFS_PK))
-    for entity in entities:
-        sc_id = entity['RowKey']
+    entities = {
+        entity['RowKey']: entity for entity in table_client.query_entities(
+            table_name,
+            filter='PartitionKey eq \'{}\''.format(_MONITOR_REMOTEFS_PK))
+    }
+    now = time.monotonic()
+    changed = []
+    for sc_id in entities:
         logger.debug('{} entity read for sc_id={}'.format(
             _MONITOR_REMOTEFS_PK, sc_id))
-        rfst = _construct_remotefs_monitoring_list(
-            compute_client, network_client, sc_id, entity)
-        if is_not_empty(rfst):
-            targets.extend(rfst)
-    ret = None
-    if is_none_or_empty(targets):
-        logger.debug('no prometheus targets for remotefs found')
+        state = remotefs_states.get(sc_id)
+        # revalidate cached addresses of vms if the entity changed
+        if state is None or state['marker'] != entities[sc_id]['etag']:
+            changed.append((sc_id, True))
+        elif now - state['refreshed'] > _TARGETS_FULL_REFRESH_INTERVAL:
+            changed.append((sc_id, False))
+    # query changed storage clusters concurrently
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers_for_executor(changed)) as executor:
+        results = list(executor.map(
+            lambda x: _construct_remotefs_monitoring_list(
+                compute_client, network_client, x[0], entities[x[0]], x[1]),
+            changed))
+    _prune_private_ip_cache()
+    for (sc_id, _), rfst in zip(changed, results):
+        state = remotefs_states.setdefault(sc_id, {'hash': None})
+        state['marker'] = (
+            entities[sc_id]['etag'] if is_not_empty(rfst) else None
+        )
+        state['refreshed'] = now
+        state['hash'] = _write_targets_file(
+            prom_var_dir / 'remotefs-{}.json'.format(sc_id), rfst,
+            state['hash'])
+    # remove targets of storage clusters no longer monitored
+    for sc_id in list(remotefs_states):
+        if sc_id not in entities:
+            _write_targets_file(
+                prom_var_dir / 'remotefs-{}.json'.format(sc_id), None,
+                remotefs_states.pop(sc_id)['hash'])
+
+
+def _construct_federation_metrics(
+        table_client: azure.cosmosdb.table.TableService,
+        queue_client: azure.storage.queue.QueueService,
+        entity_prefix: str
+) -> None:
+    """Collect federation action queue depths
+    :param table_client: table client
+    :param queue_client: queue client
+    :param entity_prefix: storage entity prefix
+    """
+    try:
+        entities = list(table_client.query_entities(
+            '{}fedglobal'.format(entity_prefix),
+            filter='PartitionKey eq \'{}\''.format(_ALL_FEDERATIONS_PK)))
+    except azure.common.AzureMissingResourceHttpError:
+        entities = []
+    except azure.common.AzureException as e:
+        # keep prior samples on transient errors
+        logger.error('could not query federations: {}'.format(e))
+        return
+    with _BATCH_METRICS_LOCK:
+        previous = {
+            labels['federation']: depth
+            for _, labels, depth in _BATCH_METRICS.get('Federation', [])
+        }
+
+    def _get_queue_depth(entity):
         try:
-            remotefs_targets_file.unlink()
-        except OSError:
-            pass
-    else:
-        output = json.dumps(
-            targets, ensure_ascii=False, sort_keys=True).encode('utf8')
-        sha = hashlib.sha256()
-        sha.update(output)
-        ret = sha.digest()
-        if ret != last_hash:
-            logger.debug('prometheus targets for remotefs: {}'.format(targets))
-            with remotefs_targets_file.open('wb') as f:
-                f.write(output)
-        else:
-            logger.debug('prometheus targets for remotefs unchanged')
-    return ret
+            return queue_client.get_queue_metadata(
+                '{}fed-{}'.format(entity_prefix, entity['RowKey'])
+            ).approximate_message_count
+        except azure.common.AzureMissingResourceHttpError:
+            return None
+        except azure.common.AzureException as e:
+            logger.error(
+                'could not get queue depth of federation {}: {}'.format(
+                    entity['FederationId'], e))
+            return previous.get(entity['FederationId'])
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers_for_executor(entities)) as executor:
+        results = list(executor.map(_get_queue_depth, entities))
+    _replace_batch_metrics('Federation', [
+        ('batch_shipyard_federation_queue_messages',
+         {'federation': entity['FederationId']}, depth)
+        for entity, depth in zip(entities, results) if depth is not None
+    ])
+
+
+def _replace_batch_metrics(
+        kind: str,
+        samples: List[Tuple[str, Dict[str, str], int]]
+) -> None:
+    """Replace cached Batch metric samples of a kind
+    :param kind: metrics kind
+    :param samples: list of (metric name, labels, value)
+    """
+    with _BATCH_METRICS_LOCK:
+        _BATCH_METRICS[kind] = samples
+
+
+def _update_batch_metrics(
+        prefix: str,
+        samples: Dict[str, List[Tuple[str, Dict[str, str], int]]]
+) -> None:
+    """Update cached Batch metric samples of kinds under a prefix. Kinds
+    without samples, due to errors, keep their prior samples and kinds
+    which are no longer present are removed.
+    :param prefix: metrics kind prefix
+    :param samples: map of kind -> list of (metric name, labels, value) or
+        None to keep prior samples
+    """
+    prefix = '{}$'.format(prefix)
+    with _BATCH_METRICS_LOCK:
+        for kind in list(_BATCH_METRICS):
+            if (kind.startswith(prefix) and
+                    kind[len(prefix):] not in samples):
+                _BATCH_METRICS.pop(kind)
+        for kind in samples:
+            if samples[kind] is not None:
+                _BATCH_METRICS[prefix + kind] = samples[kind]
+
+
+def _render_batch_metrics() -> List[str]:
+    """Render cached Batch metrics in the Prometheus text format
+    :return: lines
+    """
+    with _BATCH_METRICS_LOCK:
+        samples = [
+            sample for kind in sorted(_BATCH_METRICS)
+            for sample in _BATCH_METRICS[kind]
+        ]
+    by_name = collections.defaultdict(list)
+    for name, labels, value in samples:
+        by_name[name].append((labels, value))
+    lines = []
+    for name in _BATCH_METRICS_HELP:
+        if name not in by_name:
+            continue
+        lines.append('# HELP {} {}'.format(name, _BATCH_METRICS_HELP[name]))
+        lines.append('# TYPE {} gauge'.format(name))
+        for labels, value in by_name[name]:
+            lines.append('{}{{{}}} {}'.format(name, ','.join(
+                '{}="{}"'.format(k, str(labels[k]).replace(
+                    '\\', '\\\\').replace('"', '\\"'))
+                for k in sorted(labels)), value))
+    return lines
+
+
+def _record_discovery_metrics(kind: str, duration: float) -> None:
+    """Record the latency of a monitoring target discovery
+    :param kind: discovery kind
+    :param duration: discovery duration in seconds
+    """
+    with _DISCOVERY_METRICS_LOCK:
+        metrics = _DISCOVERY_METRICS.setdefault(
+            kind, {'count': 0, 'sum': 0.0, 'last': 0.0})
+        metrics['count'] += 1
+        metrics['sum'] += duration
+        metrics['last'] = duration
+
+
+def _render_metrics() -> bytes:
+    """Render discovery and Batch metrics in the Prometheus text format
+    :return: metrics
+    """
+    lines = [
+        '# HELP heimdall_discovery_duration_seconds Duration of the last '
+        'monitoring target discovery',
+        '# TYPE heimdall_discovery_duration_seconds gauge',
+    ]
+    with _DISCOVERY_METRICS_LOCK:
+        metrics = {
+            kind: dict(_DISCOVERY_METRICS[kind])
+            for kind in _DISCOVERY_METRICS
+        }
+    for kind in sorted(metrics):
+        lines.append(
+            'heimdall_discovery_duration_seconds{{kind="{}"}} {}'.format(
+                kind, metrics[kind]['last']))
+    lines.append(
+        '# HELP heimdall_discovery_seconds Monitoring target discovery '
+        'durations')
+    lines.append('# TYPE heimdall_discovery_seconds summary')
+    for kind in sorted(metrics):
+        lines.append('heimdall_discovery_seconds_sum{{kind="{}"}} {}'.format(
+            kind, metrics[kind]['sum']))
+        lines.append(
+            'heimdall_discovery_seconds_count{{kind="{}"}} {}'.format(
+                kind, metrics[kind]['count']))
+    lines.extend(_render_batch_metrics())
+    return ('\n'.join(lines) + '\n').encode('utf8')
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        output = _render_metrics()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(output)))
+        self.end_headers()
+        self.wfile.write(output)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+def _start_metrics_server(
+        port: int,
+        prom_var_dir: pathlib.Path,
+) -> None:
+    """Serve heimdall metrics and register them as a Prometheus target
+    :param port: metrics port
+    :param prom_var_dir: prometheus var dir
+    """
+    server = http.server.ThreadingHTTPServer(('', port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    targets = [
+        {
+            'targets': ['heimdall:{}'.format(port)],
+            'labels': {
+                'env': _MONITOR_HEIMDALL_PK,
+                'job': 'heimdall',
+            }
+        }
+    ]
+    heimdall_targets_file = prom_var_dir / 'heimdall.json'
+    with heimdall_targets_file.open('wb') as f:
+        f.write(json.dumps(
+            targets, ensure_ascii=False, sort_keys=True).encode('utf8'))
+    logger.debug('serving heimdall metrics on port {}'.format(port))
+
+
+def _timed_discovery(kind: str, func: Any, *args: Any) -> Any:
+    """Run a monitoring target discovery and record its latency
+    :param kind: discovery kind
+    :param func: discovery function
+    :return: discovery result
+    """
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        duration = time.perf_counter() - start
+        _record_discovery_metrics(kind, duration)
+        logger.debug('{} discovery took {:.3f} sec'.format(kind, duration))
 
 
 async def poll_for_monitoring_changes(
@@ -578,6 +1104,7 @@ async def poll_for_monitoring_changes(
     config: Dict,
     cloud: msrestazure.azure_cloud.Cloud,
     table_client: azure.cosmosdb.table.TableService,
+    queue_client: azure.storage.queue.QueueService,
     compute_client: azure.mgmt.compute.ComputeManagementClient,
     network_client: azure.mgmt.network.NetworkManagementClient
 ) -> Generator[None, None, None]:
@@ -586,24 +1113,55 @@ async def poll_for_monitoring_changes(
     :param config: configuration
     :param cloud: cloud object
     :param table_client: table client
+    :param queue_client: queue client
     :param compute_client: compute client
     :param network_client: network client
     """
     polling_interval = config.get('polling_interval', 10)
     table_name = config['storage']['table_name']
-    prom_var_dir = config['prometheus_var_dir']
-    pool_targets_file = pathlib.Path(prom_var_dir) / 'batch_pools.json'
-    remotefs_targets_file = pathlib.Path(prom_var_dir) / 'remotefs.json'
+    # the monitoring table is named after the storage entity prefix
+    entity_prefix = config['storage'].get(
+        'entity_prefix', table_name[:-len('monitor')])
+    prom_var_dir = pathlib.Path(config['prometheus_var_dir'])
     logger.debug('polling table {} every {} sec'.format(
         table_name, polling_interval))
-    last_pool_hash = None
-    last_remotefs_hash = None
+    # remove any combined target files and per pool and storage cluster
+    # target files of a prior run, targets are rewritten on the first poll
+    # and those no longer monitored would otherwise never be removed
+    for pattern in (
+            'batch_pools.json', 'remotefs.json', 'batchpool-*.json',
+            'remotefs-*.json'):
+        for targets_file in prom_var_dir.glob(pattern):
+            try:
+                targets_file.unlink()
+            except OSError:
+                pass
+    _start_metrics_server(config.get('metrics_port', 9099), prom_var_dir)
+    pool_states = {}
+    remotefs_states = {}
     while True:
-        last_pool_hash = _construct_pool_monitoring_targets(
-            cloud, table_client, table_name, pool_targets_file, last_pool_hash)
-        last_remotefs_hash = _construct_remotefs_monitoring_targets(
-            cloud, table_client, compute_client, network_client, table_name,
-            remotefs_targets_file, last_remotefs_hash)
+        # discover pool and remotefs targets and collect federation
+        # metrics concurrently, a failure of one must not stop polling
+        results = await asyncio.gather(
+            loop.run_in_executor(
+                None, _timed_discovery, 'batch_pools',
+                _construct_pool_monitoring_targets, cloud, table_client,
+                table_name, prom_var_dir, pool_states),
+            loop.run_in_executor(
+                None, _timed_discovery, 'remotefs',
+                _construct_remotefs_monitoring_targets, cloud, table_client,
+                compute_client, network_client, table_name, prom_var_dir,
+                remotefs_states),
+            loop.run_in_executor(
+                None, _timed_discovery, 'federations',
+                _construct_federation_metrics, table_client, queue_client,
+                entity_prefix),
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error('monitoring discovery failed: {}'.format(
+                    result))
         await asyncio.sleep(polling_interval)
 
 
@@ -631,6 +1189,9 @@ def main() -> None:
     table_client = create_table_client(
         cloud, arm_creds, sub_id, config['storage']['account'],
         config['storage']['resource_group'])
+    queue_client = create_queue_client(
+        cloud, arm_creds, sub_id, config['storage']['account'],
+        config['storage']['resource_group'])
     compute_client = create_compute_client(
         cloud, arm_creds, sub_id, config['storage']['resource_group'])
     network_client = create_network_client(
@@ -639,7 +1200,8 @@ def main() -> None:
     loop = asyncio.get_event_loop()
     loop.run_until_complete(
         poll_for_monitoring_changes(
-            loop, config, cloud, table_client, compute_client, network_client
+            loop, config, cloud, table_client, queue_client, compute_client,
+            network_client
         )
     )
 
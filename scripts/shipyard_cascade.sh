@@ -15,6 +15,7 @@ concurrent_source_downloads=10
 envfile=
 is_start_task=0
 log_directory=
+p2p=0
 prefix=
 singularity_basedir=
 
@@ -97,14 +98,43 @@ if [ -z "$prefix" ]; then
     exit 1
 fi
 
+if [ -n "$SHIPYARD_P2P_PORT" ]; then
+    p2p=1
+fi
+
+wait_for_cascade() {
+    local pid=$1
+    local mode=$2
+    if [ $p2p -eq 0 ]; then
+        wait "$pid"
+        return $?
+    fi
+    # cascade continues to seed images to peers once all images are
+    # loaded, only wait until the loaded marker appears or cascade exits
+    local loaded="${AZ_BATCH_TASK_WORKING_DIR}/.cascade_${mode}_loaded"
+    while kill -0 "$pid" 2> /dev/null; do
+        if [ -f "$loaded" ]; then
+            return 0
+        fi
+        sleep 1
+    done
+    wait "$pid"
+}
+
 spawn_cascade_process() {
     set +e
     local cascade_docker_pid
     local cascade_singularity_pid
     local detached
+    local network
     if [ -z "$block" ]; then
         detached="-d"
     fi
+    if [ $p2p -eq 1 ]; then
+        # peers must be able to connect to the cascade image server
+        network="--network host"
+        rm -f "${AZ_BATCH_TASK_WORKING_DIR}"/.cascade_*_loaded
+    fi
     if [ $cascadecontainer -eq 1 ]; then
         tmp_envfile="$envfile.tmp"
         cp "$envfile" "$tmp_envfile"
@@ -112,7 +142,8 @@ spawn_cascade_process() {
         # run cascade for docker
         log DEBUG "Starting $cascade_docker_image"
         # shellcheck disable=SC2086
-        docker run $detached --rm --runtime runc --env-file "$tmp_envfile" \
+        docker run $detached --rm --runtime runc $network \
+            --env-file "$tmp_envfile" \
             -e "cascade_mode=docker" \
             -e "is_start_task=$is_start_task" \
             -v /var/run/docker.sock:/var/run/docker.sock \
@@ -131,7 +162,8 @@ spawn_cascade_process() {
                 -v $singularity_basedir:$singularity_basedir \
                 -v $singularity_basedir/mnt:/var/lib/singularity/mnt"
             # shellcheck disable=SC2086
-            docker run $detached --rm --runtime runc --env-file $tmp_envfile \
+            docker run $detached --rm --runtime runc $network \
+                --env-file $tmp_envfile \
                 -e "cascade_mode=singularity" \
                 -v /etc/passwd:/etc/passwd:ro \
                 -v /etc/group:/etc/group:ro \
@@ -146,7 +178,7 @@ spawn_cascade_process() {
         if [[ -n ${SHIPYARD_TIMING+x} ]]; then
             # mark start cascade
             # shellcheck disable=SC2086
-            ./perf.py cascade start --prefix "$prefix"
+            ./perf.py cascade start --prefix "$prefix" --spool
         fi
         log DEBUG "Starting Cascade Docker mode"
         # shellcheck disable=SC2086
@@ -170,7 +202,7 @@ spawn_cascade_process() {
     # wait for cascade exit
     if [ -n "$block" ]; then
         local rc
-        wait $cascade_docker_pid
+        wait_for_cascade $cascade_docker_pid docker
         rc=$?
         if [ $rc -eq 0 ]; then
             log DEBUG "Cascade Docker exited successfully"
@@ -179,7 +211,7 @@ spawn_cascade_process() {
             exit $rc
         fi
         if [ -n "$singularity_basedir" ]; then
-            wait $cascade_singularity_pid
+            wait_for_cascade $cascade_singularity_pid singularity
             rc=$?
             if [ $rc -eq 0 ]; then
                 log DEBUG "Cascade Singularity exited successfully"
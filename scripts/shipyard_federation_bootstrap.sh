@@ -66,11 +66,15 @@ fi
 
 # globals
 aad_cloud=
+concurrency_max_actions=16
 log_level=
 log_persist=
 log_filename=
 post_success_blackout=
 post_success_autoscale=
+placement_policy=greedy
+placement_weights=(1.0 1.0 1.0 0.0)
+placement_vm_prices=
 prefix=
 refresh_interval_actions=5
 refresh_interval_federation=30
@@ -79,23 +83,28 @@ storage_rg=
 shipyardversion=
 
 # process command line options
-while getopts "h?a:l:p:r:s:v:" opt; do
+while getopts "h?a:c:l:p:r:s:v:x:" opt; do
     case "$opt" in
         h|\?)
             echo "shipyard_federation_bootstrap.sh parameters"
             echo ""
             echo "-a [aad cloud type] AAD cloud type for MSI"
+            echo "-c [max actions] maximum concurrent actions"
             echo "-l [persistence:level:filename] logging options"
             echo "-p [blackout interval:evaluate autoscale] post-success scheduling options"
             echo "-r [federation:actions] refresh intervals"
             echo "-s [storage account:resource group:prefix] storage config"
             echo "-v [version] batch-shipyard version"
+            echo "-x [policy:fit:backlog:locality:price:vm prices] placement options"
             echo ""
             exit 1
             ;;
         a)
             aad_cloud=${OPTARG,,}
             ;;
+        c)
+            concurrency_max_actions=$OPTARG
+            ;;
         p)
             IFS=':' read -ra p <<< "${OPTARG}"
             post_success_blackout=${p[0]}
@@ -121,6 +130,12 @@ while getopts "h?a:l:p:r:s:v:" opt; do
         v)
             shipyardversion=$OPTARG
             ;;
+        x)
+            IFS=':' read -ra x <<< "${OPTARG,,}"
+            placement_policy=${x[0]}
+            placement_weights=("${x[@]:1:4}")
+            placement_vm_prices=${x[5]}
+            ;;
     esac
 done
 shift $((OPTIND-1))
@@ -249,6 +264,13 @@ install_packages() {
 create_batch_shipyard_federation_config() {
     mkdir -p ${SHIPYARD_VAR_DIR}
     chmod 755 ${SHIPYARD_VAR_DIR}
+    local vm_prices=
+    local vp
+    IFS=',' read -ra vp <<< "$placement_vm_prices"
+    for i in "${vp[@]}"; do
+        vm_prices+="\"${i%%=*}\": ${i#*=}, "
+    done
+    vm_prices="{${vm_prices%, }}"
 cat > ${SHIPYARD_CONF_FILE} << EOF
 {
     "aad_cloud": "$aad_cloud",
@@ -270,10 +292,23 @@ cat > ${SHIPYARD_CONF_FILE} << EOF
         "federations": $refresh_interval_federation,
         "actions": $refresh_interval_actions
     },
+    "concurrency": {
+        "max_actions": $concurrency_max_actions
+    },
     "scheduling": {
         "after_success": {
             "blackout_interval": $post_success_blackout,
             "evaluate_autoscale": $post_success_autoscale
+        },
+        "placement": {
+            "policy": "$placement_policy",
+            "weights": {
+                "fit": ${placement_weights[0]},
+                "backlog": ${placement_weights[1]},
+                "locality": ${placement_weights[2]},
+                "price": ${placement_weights[3]}
+            },
+            "vm_prices": $vm_prices
         }
     }
 }
@@ -375,6 +410,8 @@ echo "Batch Shipyard version: $shipyardversion"
 echo "AAD cloud: $aad_cloud"
 echo "Storage: $storage_account:$storage_rg:$prefix"
 echo "Refresh intervals: feds=$refresh_interval_federation actions=$refresh_interval_actions"
+echo "Concurrency: max actions=$concurrency_max_actions"
+echo "Placement: policy=$placement_policy weights=${placement_weights[*]} vm prices=$placement_vm_prices"
 echo "Logging: persist=$log_persist level=$log_level filename=$log_filename"
 echo ""
 
@@ -1708,10 +1708,10 @@ EOF
         if [[ -n ${SHIPYARD_TIMING+x} ]]; then
             # backfill node prep start
             # shellcheck disable=SC2086
-            ./perf.py nodeprep start --prefix "$prefix" --ts "$npstart" --message "offer=$DISTRIB_ID,sku=$DISTRIB_RELEASE"
+            ./perf.py nodeprep start --prefix "$prefix" --spool --ts "$npstart" --message "offer=$DISTRIB_ID,sku=$DISTRIB_RELEASE"
             # mark node prep finished
             # shellcheck disable=SC2086
-            ./perf.py nodeprep end --prefix "$prefix" --ts "$npend"
+            ./perf.py nodeprep end --prefix "$prefix" --spool --ts "$npend"
         fi
         # create env file
 cat > "$envfile" << EOF
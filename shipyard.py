@@ -1745,8 +1745,8 @@ def images_update(
     """Update container images in a pool"""
     ctx.initialize_for_batch()
     convoy.fleet.action_pool_images_update(
-        ctx.batch_client, ctx.config, docker_image, docker_image_digest,
-        singularity_image, ssh)
+        ctx.batch_client, ctx.table_client, ctx.config, docker_image,
+        docker_image_digest, singularity_image, ssh)
 
 
 @images.command('list')
@@ -44,6 +44,7 @@ import threading
 import time
 from typing import (
     Any,
+    Callable,
     Dict,
     List,
     Optional,
@@ -68,6 +69,10 @@ logger = logging.getLogger(__name__)
 _MAX_EXECUTOR_WORKERS = min((multiprocessing.cpu_count() * 4, 32))
 _MAX_AUTH_FAILURE_RETRIES = 10
 _MAX_RESUME_FAILURE_ATTEMPTS = 10
+_MAX_ACTION_MESSAGES_PER_DEQUEUE = 32
+_MAX_TABLE_BATCH_OPERATIONS = 100
+_MAX_SCONTROL_UPDATE_NODES = 128
+_WARM_BUFFER_INTERVAL = 30
 
 
 class Actions(enum.IntEnum):
@@ -142,6 +147,53 @@ def hash_string(strdata: str) -> str:
     return hashlib.sha1(strdata.encode('utf8')).hexdigest()
 
 
+def group_action_msgs(
+        msgs: List[Tuple[Dict[str, Any], str, str]]
+) -> List[List[List[Tuple[Dict[str, Any], str, str]]]]:
+    """Merge compatible action messages into groups, each serviced as a
+    single action, and order the groups into waves of groups which do not
+    share hosts and can be processed concurrently
+    :param msgs: action messages in dequeue order
+    :return: list of waves of action message groups
+    """
+    groups = []
+    group_hosts = []
+    open_groups = {}
+    last_group = {}
+    for msg in msgs:
+        key = (msg[0]['action'], msg[0].get('retry_count'))
+        hosts = [he.split()[0] for he in msg[0]['hosts']]
+        # a message cannot be merged ahead of a later group touching any
+        # of its hosts
+        index = open_groups.get(key)
+        if index is not None and any(
+                last_group.get(host, -1) > index for host in hosts):
+            index = None
+        if index is None:
+            index = len(groups)
+            groups.append([])
+            group_hosts.append(set())
+            open_groups[key] = index
+        groups[index].append(msg)
+        group_hosts[index].update(hosts)
+        for host in hosts:
+            last_group[host] = max((last_group.get(host, -1), index))
+    # a group runs in the wave after the last earlier group sharing a host
+    group_wave = []
+    waves = []
+    for i in range(len(groups)):
+        wave = 0
+        for j in range(i):
+            if (group_wave[j] >= wave and
+                    not group_hosts[i].isdisjoint(group_hosts[j])):
+                wave = group_wave[j] + 1
+        group_wave.append(wave)
+        if wave == len(waves):
+            waves.append([])
+        waves[wave].append(groups[i])
+    return waves
+
+
 def random_blocking_sleep(min: int, max: int) -> None:
     time.sleep(random.randint(min, max))
 
@@ -268,6 +320,7 @@ class ServiceProxy():
         prefix = config['storage']['entity_prefix']
         self.cluster_id = config['cluster_id']
         self.logging_id = config['logging_id']
+        self.is_primary = str(config.get('is_primary')) == '1'
         self.table_name = '{}slurm'.format(prefix)
         try:
             self.queue_assign = config['storage']['queues']['assign']
@@ -427,6 +480,46 @@ class StorageServiceHandler():
             '{}${}'.format(self._HOSTS_PREFIX, self.service_proxy.cluster_id),
             host)
 
+    def get_host_assignment_entities(
+            self,
+            hosts: List[str],
+    ) -> Dict[str, azure.cosmosdb.table.Entity]:
+        """Get host assignment entities for hosts with a single range
+        query over the hosts partition
+        :param hosts: hosts
+        :return: map of host -> entity for hosts with an entity
+        """
+        if len(hosts) == 0:
+            return {}
+        sorted_hosts = sorted(hosts)
+        entities = self.service_proxy.table_client.query_entities(
+            self.service_proxy.table_name,
+            filter=(
+                'PartitionKey eq \'{}${}\' and RowKey ge \'{}\' and '
+                'RowKey le \'{}\''
+            ).format(
+                self._HOSTS_PREFIX, self.service_proxy.cluster_id,
+                sorted_hosts[0], sorted_hosts[-1]))
+        wanted = set(hosts)
+        return {
+            entity['RowKey']: entity for entity in entities
+            if entity['RowKey'] in wanted
+        }
+
+    def list_host_assignment_entities_resumed_since(
+            self,
+            since: datetime.datetime,
+    ) -> List[azure.cosmosdb.table.Entity]:
+        return self.service_proxy.table_client.query_entities(
+            self.service_proxy.table_name,
+            filter=(
+                'PartitionKey eq \'{}${}\' and '
+                'ResumedAt ge datetime\'{}\''
+            ).format(
+                self._HOSTS_PREFIX, self.service_proxy.cluster_id,
+                since.strftime('%Y-%m-%dT%H:%M:%SZ')),
+            select='RowKey,Partition,ResumedAt')
+
     def delete_node_assignment_entity(
             self,
             entity: azure.cosmosdb.table.Entity,
@@ -452,6 +545,26 @@ class StorageServiceHandler():
         self.service_proxy.queue_client.put_message(
             qname, msg_data, time_to_live=-1)
 
+    def insert_queue_assignment_msgs(
+            self,
+            assignments: List[Tuple[str, str]],
+    ) -> None:
+        """Insert host assignment tokens concurrently
+        :param assignments: list of (partition row key, host)
+        """
+        if len(assignments) == 0:
+            return
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_workers_for_executor(
+                    assignments)) as executor:
+            futures = [
+                executor.submit(
+                    self.insert_queue_assignment_msg, rowkey, host)
+                for rowkey, host in assignments
+            ]
+        for future in futures:
+            future.result()
+
     def get_queue_assignment_msg(self) -> None:
         logger.debug('getting queue assignment from {}'.format(
             self.service_proxy.queue_assign))
@@ -497,30 +610,35 @@ class StorageServiceHandler():
             self.service_proxy.queue_action, msg_data,
             visibility_timeout=visibility_timeout, time_to_live=-1)
 
-    def get_queue_action_msg(
+    def get_queue_action_msgs(
             self
-    ) -> Optional[Tuple[Dict[str, Any], str, str]]:
+    ) -> List[Tuple[Dict[str, Any], str, str]]:
         msgs = self.service_proxy.queue_client.get_messages(
-            self.service_proxy.queue_action, num_messages=1,
+            self.service_proxy.queue_action,
+            num_messages=_MAX_ACTION_MESSAGES_PER_DEQUEUE,
             visibility_timeout=self.service_proxy.resume_timeout)
+        ret = []
         for msg in msgs:
             msg_data = json.loads(msg.content, encoding='utf8')
             logger.debug(
                 'got message {} from queue {}: {}'.format(
                     msg.id, self.service_proxy.queue_action, msg_data))
-            return (msg_data, msg.id, msg.pop_receipt)
-        return None
+            ret.append((msg_data, msg.id, msg.pop_receipt))
+        return ret
 
     def update_queue_action_msg(
             self,
             id: str,
             pop_receipt: str,
+            visibility_timeout: int = 20,
     ) -> None:
         logger.debug(
-            'updating queue {} message id {} pop receipt {}'.format(
-                self.service_proxy.queue_action, id, pop_receipt))
+            'updating queue {} message id {} pop receipt {} (vt={})'.format(
+                self.service_proxy.queue_action, id, pop_receipt,
+                visibility_timeout))
         self.service_proxy.queue_client.update_message(
-            self.service_proxy.queue_action, id, pop_receipt, 20)
+            self.service_proxy.queue_action, id, pop_receipt,
+            visibility_timeout)
 
     def delete_queue_action_msg(
             self,
@@ -533,25 +651,86 @@ class StorageServiceHandler():
         self.service_proxy.queue_client.delete_message(
             self.service_proxy.queue_action, id, pop_receipt)
 
-    def insert_host_assignment_entity(
+    def _commit_host_assignment_entity_batches(
             self,
-            host: str,
-            partition_name: str,
-            service_url: str,
-            pool_id: str
+            entities: List[Dict[str, Any]],
+            merge: bool,
     ) -> None:
-        entity = {
-            'PartitionKey': '{}${}'.format(
-                self._HOSTS_PREFIX, self.service_proxy.cluster_id),
-            'RowKey': host,
-            'Partition': partition_name,
-            'State': HostStates.Resuming.value,
-            'BatchServiceUrl': service_url,
-            'BatchPoolId': pool_id,
-            'BatchShipyardSlurmVersion': 1,
-        }
-        self.service_proxy.table_client.insert_or_replace_entity(
-            self.service_proxy.table_name, entity)
+        """Insert or merge host assignment entities, which share a
+        partition, in entity group transactions
+        :param entities: host assignment entities
+        :param merge: merge instead of insert or replace
+        """
+        # a transaction cannot operate on the same entity more than once
+        entities = list(collections.OrderedDict(
+            (entity['RowKey'], entity) for entity in entities).values())
+        for i in range(0, len(entities), _MAX_TABLE_BATCH_OPERATIONS):
+            chunk = entities[i:i + _MAX_TABLE_BATCH_OPERATIONS]
+            tb = azure.cosmosdb.table.TableBatch()
+            for entity in chunk:
+                if merge:
+                    tb.merge_entity(entity)
+                else:
+                    tb.insert_or_replace_entity(entity)
+            while True:
+                try:
+                    self.service_proxy.table_client.commit_batch(
+                        self.service_proxy.table_name, tb)
+                    break
+                except azure.common.AzureHttpError as ex:
+                    if ex.status_code != 409:
+                        raise
+                    random_blocking_sleep(1, 3)
+
+    def insert_host_assignment_entities(
+            self,
+            assignments: List[Tuple[str, str, str, str]],
+    ) -> None:
+        """Insert host assignment entities in the resuming state
+        :param assignments: list of (host, partition name, service url,
+            pool id)
+        """
+        now = datetime_utcnow()
+        entities = [
+            {
+                'PartitionKey': '{}${}'.format(
+                    self._HOSTS_PREFIX, self.service_proxy.cluster_id),
+                'RowKey': host,
+                'Partition': partition_name,
+                'State': HostStates.Resuming.value,
+                'BatchServiceUrl': service_url,
+                'BatchPoolId': pool_id,
+                'ResumedAt': now,
+                'BatchShipyardSlurmVersion': 1,
+            }
+            for host, partition_name, service_url, pool_id in assignments
+        ]
+        logger.debug('inserting {} host assignment entities'.format(
+            len(entities)))
+        self._commit_host_assignment_entity_batches(entities, False)
+
+    def merge_host_assignment_entities_state(
+            self,
+            hosts: List[str],
+            state: HostStates,
+    ) -> None:
+        """Merge state into host assignment entities
+        :param hosts: hosts
+        :param state: host state
+        """
+        entities = [
+            {
+                'PartitionKey': '{}${}'.format(
+                    self._HOSTS_PREFIX, self.service_proxy.cluster_id),
+                'RowKey': host,
+                'State': state.value,
+            }
+            for host in hosts
+        ]
+        logger.debug(
+            'merging state {} into {} host assignment entities'.format(
+                state, len(entities)))
+        self._commit_host_assignment_entity_batches(entities, True)
 
     def merge_host_assignment_entity_for_compute_node(
             self,
@@ -601,60 +780,73 @@ class StorageServiceHandler():
         self.service_proxy.table_client.update_entity(
             self.service_proxy.table_name, entity)
 
+    def _update_slurm_node_addresses(
+            self,
+            entities: List[azure.cosmosdb.table.Entity],
+            set_idle_state: Optional[bool],
+    ) -> None:
+        """Update Slurm node addresses for provisioned hosts with one
+        scontrol call per chunk of hosts
+        :param entities: provisioned host assignment entities
+        :param set_idle_state: set nodes idle
+        """
+        for i in range(0, len(entities), _MAX_SCONTROL_UPDATE_NODES):
+            chunk = entities[i:i + _MAX_SCONTROL_UPDATE_NODES]
+            for entity in chunk:
+                logger.debug(
+                    'updating host {} with ip {} node id {} pool id {}'.format(
+                        entity['RowKey'], entity['IpAddress'],
+                        entity['BatchNodeId'], entity['BatchPoolId']))
+            names = ','.join(entity['RowKey'] for entity in chunk)
+            cmd = ['scontrol', 'update', 'NodeName={}'.format(names),
+                   'NodeAddr={}'.format(
+                       ','.join(entity['IpAddress'] for entity in chunk)),
+                   'NodeHostname={}'.format(names)]
+            if set_idle_state:
+                cmd.append('State=Idle')
+            logger.debug('command: {}'.format(' '.join(cmd)))
+            subprocess.check_call(cmd)
+
     def wait_for_host_assignment_entities(
             self,
             start_time: datetime.datetime,
             hosts: List[str],
             timeout: Optional[int] = None,
             set_idle_state: Optional[bool] = None,
-    ) -> None:
+    ) -> Optional[List[str]]:
         if timeout is None:
             timeout = self.service_proxy.resume_timeout
         logger.info('waiting for {} hosts to spin up in {} sec'.format(
             len(hosts), timeout))
-        host_queue = collections.deque(hosts)
-        i = 0
-        while len(host_queue) > 0:
-            host = host_queue.popleft()
-            try:
-                entity = self.get_host_assignment_entity(host)
-                ip = entity['IpAddress']
+        pending = list(collections.OrderedDict.fromkeys(hosts))
+        while True:
+            # sweep all pending hosts with a single query
+            entities = self.get_host_assignment_entities(pending)
+            ready = []
+            for host in pending:
+                entity = entities.get(host)
+                if entity is None or 'IpAddress' not in entity:
+                    continue
                 state = HostStates(entity['State'])
                 if state != HostStates.Provisioned:
                     logger.error('unexpected state for host {}: {}'.format(
                         host, state))
-                    raise KeyError()
-            except (azure.common.AzureMissingResourceHttpError, KeyError):
-                host_queue.append(host)
-            else:
-                logger.debug(
-                    'updating host {} with ip {} node id {} pool id {}'.format(
-                        host, ip, entity['BatchNodeId'],
-                        entity['BatchPoolId']))
-                cmd = ['scontrol', 'update', 'NodeName={}'.format(host),
-                       'NodeAddr={}'.format(ip),
-                       'NodeHostname={}'.format(host)]
-                if set_idle_state:
-                    cmd.append('State=Idle')
-                logger.debug('command: {}'.format(' '.join(cmd)))
-                subprocess.check_call(cmd)
-                # update entity state
-                m_entity = {
-                    'PartitionKey': entity['PartitionKey'],
-                    'RowKey': entity['RowKey'],
-                    'State': HostStates.Up.value,
-                }
-                self.service_proxy.table_client.merge_entity(
-                    self.service_proxy.table_name, m_entity)
-                continue
-            i += 1
-            if i % 6 == 0:
-                i = 0
-                logger.debug('still waiting for {} hosts'.format(
-                    len(host_queue)))
+                    continue
+                ready.append(entity)
+            if len(ready) > 0:
+                self._update_slurm_node_addresses(ready, set_idle_state)
+                ready_hosts = [entity['RowKey'] for entity in ready]
+                self.merge_host_assignment_entities_state(
+                    ready_hosts, HostStates.Up)
+                ready_hosts = set(ready_hosts)
+                pending = [host for host in pending if host not in ready_hosts]
+                del ready_hosts
+            if len(pending) == 0:
+                break
+            logger.debug('still waiting for {} hosts'.format(len(pending)))
             diff = datetime_utcnow() - start_time
             if diff.total_seconds() > timeout:
-                return host_queue
+                return pending
             random_blocking_sleep(5, 10)
         logger.info('{} host spin up completed'.format(len(hosts)))
         return None
@@ -912,6 +1104,7 @@ class CommandProcessor():
         """
         self._service_proxy = ServiceProxy(config)
         self._partitions = None
+        self._prewarmed = {}
         self.ssh = StorageServiceHandler(self._service_proxy)
         self.bsh = BatchServiceHandler(self._service_proxy)
 
@@ -966,6 +1159,49 @@ class CommandProcessor():
         # dump configuration
         self._service_proxy.log_configuration()
 
+    def _run_pool_operations(
+            self,
+            operation: str,
+            func: Callable,
+            pool_args: Dict[str, Tuple],
+    ) -> Dict[str, bool]:
+        """Run a Batch pool operation concurrently across pools
+        :param operation: operation name for logging
+        :param func: function taking service url, pool id and args
+        :param pool_args: map of service url$pool id -> args
+        :return: map of service url$pool id -> success
+        """
+        def _timed_operation(service_url, pool_id, *args):
+            start = time.perf_counter()
+            func(service_url, pool_id, *args)
+            return time.perf_counter() - start
+
+        if len(pool_args) == 0:
+            return {}
+        futures = {}
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_workers_for_executor(pool_args)) as executor:
+            for key in pool_args:
+                service_url, pool_id = key.split('$')
+                futures[key] = executor.submit(
+                    _timed_operation, service_url, pool_id, *pool_args[key])
+        results = {}
+        for key in futures:
+            service_url, pool_id = key.split('$')
+            try:
+                elapsed = futures[key].result()
+            except Exception:
+                logger.exception(
+                    'could not {} pool {} (service_url={})'.format(
+                        operation, pool_id, service_url))
+                results[key] = False
+            else:
+                logger.info(
+                    '{} of pool {} took {:.3f} sec (service_url={})'.format(
+                        operation, pool_id, elapsed, service_url))
+                results[key] = True
+        return results
+
     def process_resume_action(self, hosts: List[str]) -> None:
         if len(hosts) == 0:
             logger.error('host list is empty for resume')
@@ -976,14 +1212,14 @@ class CommandProcessor():
         # be called multiple times for the same set of hosts due to
         # controller failover
         hosts_modified = []
+        entities = self.ssh.get_host_assignment_entities(
+            [he.split()[0] for he in hosts])
         for he in hosts:
             host, partname = he.split()
-            try:
-                entity = self.ssh.get_host_assignment_entity(host)
-                state = HostStates(entity['State'])
-            except azure.common.AzureMissingResourceHttpError:
+            if host not in entities:
                 hosts_modified.append(he)
             else:
+                state = HostStates(entities[host]['State'])
                 logger.debug(
                     'host entry {} found for partition {} but state '
                     'is {}'.format(host, partname, state))
@@ -991,6 +1227,7 @@ class CommandProcessor():
                     hosts_modified.append(he)
         hosts = hosts_modified
         del hosts_modified
+        del entities
         logger.debug('resuming hosts: {}'.format(', '.join(hosts)))
         if len(hosts) == 0:
             logger.error('modified host list is empty for resume')
@@ -1005,8 +1242,9 @@ class CommandProcessor():
                 'num_hosts': 0,
                 'compute_node_type': entity['ComputeNodeType'],
             }
-        # insert host assignment entity and message
-        total_hosts = 0
+        # map hosts to partitions
+        host_assignments = []
+        queue_assignments = []
         for he in hosts:
             host, partname = he.split()
             for entity in partitions:
@@ -1016,30 +1254,29 @@ class CommandProcessor():
                     key = '{}${}'.format(
                         entity['BatchServiceUrl'], entity['BatchPoolId'])
                     pool_map[key]['num_hosts'] += 1
-                    self.ssh.insert_host_assignment_entity(
+                    host_assignments.append((
                         host, partname, entity['BatchServiceUrl'],
-                        entity['BatchPoolId'])
-                    self.ssh.insert_queue_assignment_msg(
-                        entity['RowKey'], host)
-                    total_hosts += 1
+                        entity['BatchPoolId']))
+                    queue_assignments.append((entity['RowKey'], host))
                     break
-        if total_hosts != len(hosts):
+        if len(host_assignments) != len(hosts):
             logger.error(
                 'total host {} to number of hosts to resume '
-                '{} mismatch'.format(total_hosts, len(hosts)))
-        del total_hosts
-        # resize batch pools to specified number of hosts
-        resize_futures = {}
-        with concurrent.futures.ThreadPoolExecutor(
-                max_workers=max_workers_for_executor(pool_map)) as executor:
-            for key in pool_map:
-                service_url, pool_id = key.split('$')
-                resize_futures[key] = executor.submit(
-                    self.bsh.add_nodes_to_pool(
-                        service_url, pool_id,
-                        pool_map[key]['compute_node_type'],
-                        pool_map[key]['num_hosts'])
+                '{} mismatch'.format(len(host_assignments), len(hosts)))
+        # insert host assignment entities prior to their messages
+        self.ssh.insert_host_assignment_entities(host_assignments)
+        self.ssh.insert_queue_assignment_msgs(queue_assignments)
+        del host_assignments
+        del queue_assignments
+        # resize batch pools by the number of hosts mapped to each
+        self._run_pool_operations(
+            'resize up', self.bsh.add_nodes_to_pool, {
+                key: (
+                    pool_map[key]['compute_node_type'],
+                    pool_map[key]['num_hosts'],
                 )
+                for key in pool_map if pool_map[key]['num_hosts'] > 0
+            })
 
     def process_suspend_action(self, hosts: List[str]) -> bool:
         if len(hosts) == 0:
@@ -1051,10 +1288,11 @@ class CommandProcessor():
         suspended = []
         pool_map = {}
         entities = []
+        host_entities = self.ssh.get_host_assignment_entities(hosts)
         for host in hosts:
             try:
-                entity = self.ssh.get_host_assignment_entity(host)
-            except azure.common.AzureMissingResourceHttpError:
+                entity = host_entities[host]
+            except KeyError:
                 logger.error('host {} entity not found'.format(host))
                 continue
             logger.debug('found host {} mapping: {}'.format(host, entity))
@@ -1081,26 +1319,12 @@ class CommandProcessor():
             logger.info('no hosts to suspend after analyzing host entities')
         else:
             # remove nodes
-            with concurrent.futures.ThreadPoolExecutor(
-                    max_workers=max_workers_for_executor(
-                        pool_map)) as executor:
-                for key in pool_map:
-                    service_url, pool_id = key.split('$')
-                    executor.submit(
-                        self.bsh.remove_nodes_from_pool(
-                            service_url, pool_id, pool_map[key])
-                    )
+            self._run_pool_operations(
+                'resize down', self.bsh.remove_nodes_from_pool,
+                {key: (pool_map[key], ) for key in pool_map})
             # mark entities suspended
-            with concurrent.futures.ThreadPoolExecutor(
-                    max_workers=max_workers_for_executor(
-                        suspended)) as executor:
-                for host in suspended:
-                    executor.submit(
-                        self.ssh.
-                        merge_host_assignment_entity_for_compute_node(
-                            host, HostStates.Suspended, True,
-                            retry_on_conflict=True)
-                    )
+            self.ssh.merge_host_assignment_entities_state(
+                suspended, HostStates.Suspended)
         # delete log files
         for host in suspended:
             file = pathlib.Path(
@@ -1239,9 +1463,8 @@ class CommandProcessor():
                 Actions.WaitForResume, list(hosts_update), retry_count=0)
         del hosts_update
         # clean pools
-        for key in clean_pools:
-            service_url, pool_id = key.split('$')
-            self.bsh.clean_pool(service_url, pool_id)
+        self._run_pool_operations(
+            'clean', self.bsh.clean_pool, {key: () for key in clean_pools})
         del clean_pools
         # recover hosts
         for key in pool_map:
@@ -1350,37 +1573,205 @@ class CommandProcessor():
             sys.exit(1)
         return entity
 
+    def process_action_msgs(
+            self,
+            msgs: List[Tuple[Dict[str, Any], str, str]],
+    ) -> None:
+        start = time.perf_counter()
+        action = msgs[0][0]['action']
+        if len(msgs) == 1:
+            hosts = msgs[0][0]['hosts']
+        else:
+            # merge host lists of coalesced messages, preserving order
+            hosts = list(collections.OrderedDict.fromkeys(
+                he for msg in msgs for he in msg[0]['hosts']))
+            logger.debug('coalesced {} action {} messages for {} hosts'.format(
+                len(msgs), action, len(hosts)))
+        del_msg = True
+        if action == Actions.Suspend:
+            del_msg = self.process_suspend_action(hosts)
+        elif action == Actions.Resume:
+            self.process_resume_action(hosts)
+        elif action == Actions.ResumeFailed:
+            del_msg = self.process_resume_failed_action(
+                hosts, msgs[0][0]['retry_count'])
+        elif action == Actions.WaitForResume:
+            del_msg = self.process_wait_for_resume_action(
+                hosts, msgs[0][0]['retry_count'])
+        else:
+            logger.error('unknown action {} for hosts {}'.format(
+                action, ', '.join(hosts)))
+        for msg in msgs:
+            if del_msg:
+                self.ssh.delete_queue_action_msg(msg[1], msg[2])
+            else:
+                self.ssh.update_queue_action_msg(msg[1], msg[2])
+        logger.info(
+            'processed action {} for {} hosts from {} messages in {:.3f} '
+            'sec'.format(
+                action, len(hosts), len(msgs), time.perf_counter() - start))
+
+    def _get_slurm_node_states(self) -> Dict[str, List[Tuple[str, str]]]:
+        """Get Slurm node states
+        :return: map of partition -> list of (host, compact state)
+        """
+        output = subprocess.check_output(
+            ['sinfo', '-h', '-N', '-o', '%N %R %t']).decode('utf8')
+        node_states = {}
+        for line in output.splitlines():
+            try:
+                host, partname, state = line.split()
+            except ValueError:
+                continue
+            node_states.setdefault(partname, []).append((host, state))
+        return node_states
+
+    def _get_slurm_pending_node_counts(self) -> Dict[str, int]:
+        """Get the number of nodes requested by pending jobs
+        :return: map of partition -> number of nodes
+        """
+        output = subprocess.check_output(
+            ['squeue', '-h', '-t', 'PD', '-o', '%P %D']).decode('utf8')
+        pending = collections.Counter()
+        for line in output.splitlines():
+            try:
+                partnames, num_nodes = line.split()
+                num_nodes = int(num_nodes)
+            except ValueError:
+                continue
+            # a job submitted to multiple partitions counts against each
+            for partname in partnames.split(','):
+                pending[partname] += num_nodes
+        return pending
+
+    def prewarm_partitions(self) -> None:
+        """Power up nodes in partitions with a warm buffer such that idle
+        and powering up nodes meet the demand predicted from pending jobs
+        and the demand in the previous lookback interval
+        """
+        warm_buffers = {}
+        for entity in self.slurm_partitions:
+            max_idle_nodes = entity.get('WarmBufferMaxIdleNodes', 0)
+            if max_idle_nodes > 0:
+                warm_buffers[entity['RowKey'].split('$')[0]] = (
+                    entity['WarmBufferMinIdleNodes'], max_idle_nodes,
+                    entity['WarmBufferLookbackInterval'],
+                )
+        if len(warm_buffers) == 0:
+            return
+        now = datetime_utcnow()
+        lookback = max(wb[2] for wb in warm_buffers.values())
+        # forget hosts powered up by the warm buffer outside of lookback
+        self._prewarmed = {
+            host: ts for host, ts in self._prewarmed.items()
+            if (now - ts).total_seconds() <= lookback
+        }
+        node_states = self._get_slurm_node_states()
+        pending = self._get_slurm_pending_node_counts()
+        resumed = self.ssh.list_host_assignment_entities_resumed_since(
+            now - datetime.timedelta(seconds=lookback))
+        resumed_counts = collections.Counter()
+        for entity in resumed:
+            partname = entity['Partition']
+            if partname not in warm_buffers:
+                continue
+            # resumes issued by the warm buffer are not demand
+            if entity['RowKey'] in self._prewarmed:
+                continue
+            age = (now - entity['ResumedAt']).total_seconds()
+            if age <= warm_buffers[partname][2]:
+                resumed_counts[partname] += 1
+        for partname in warm_buffers:
+            min_idle_nodes, max_idle_nodes, _ = warm_buffers[partname]
+            num_idle = 0
+            num_powering_up = 0
+            demand = resumed_counts[partname]
+            powered_down = []
+            for host, state in node_states.get(partname, []):
+                if state == 'idle':
+                    num_idle += 1
+                elif state.endswith('#'):
+                    num_powering_up += 1
+                elif state == 'idle~':
+                    powered_down.append(host)
+                # warm nodes taken up by jobs are demand
+                if (host in self._prewarmed and
+                        state.rstrip('*~#%$@') in ('alloc', 'mix', 'comp')):
+                    demand += 1
+            target = min((
+                max_idle_nodes,
+                max((min_idle_nodes, demand, pending[partname])),
+            ))
+            deficit = target - num_idle - num_powering_up
+            logger.debug(
+                'warm buffer for partition {}: target={} idle={} '
+                'powering_up={} demand={} pending={}'.format(
+                    partname, target, num_idle, num_powering_up, demand,
+                    pending[partname]))
+            if deficit <= 0 or len(powered_down) == 0:
+                continue
+            hosts = powered_down[:deficit]
+            logger.info('powering up {} nodes in partition {}: {}'.format(
+                len(hosts), partname, ', '.join(hosts)))
+            for i in range(0, len(hosts), _MAX_SCONTROL_UPDATE_NODES):
+                subprocess.check_call([
+                    'scontrol', 'update', 'NodeName={}'.format(
+                        ','.join(hosts[i:i + _MAX_SCONTROL_UPDATE_NODES])),
+                    'State=POWER_UP'])
+            for host in hosts:
+                self._prewarmed[host] = now
+
+    def prewarm_processor(self) -> None:
+        logger.info('warm buffer processor starting')
+        while True:
+            try:
+                self.prewarm_partitions()
+            except Exception:
+                logger.exception('could not maintain warm buffers')
+            time.sleep(_WARM_BUFFER_INTERVAL)
+
     def daemon_processor(self) -> None:
         # set logging config for daemon processor
         self.set_log_configuration()
         logger.info('daemon processor starting')
+        # maintain warm buffers from the primary controller only
+        if self._service_proxy.is_primary:
+            threading.Thread(
+                target=self.prewarm_processor, daemon=True).start()
         while True:
-            msg = self.ssh.get_queue_action_msg()
-            if msg is None:
+            msgs = self.ssh.get_queue_action_msgs()
+            if len(msgs) == 0:
                 random_blocking_sleep(1, 3)
-            else:
-                del_msg = True
-                action = msg[0]['action']
-                hosts = msg[0]['hosts']
-                msg_id = msg[1]
-                pop_receipt = msg[2]
-                if action == Actions.Suspend:
-                    del_msg = self.process_suspend_action(hosts)
-                elif action == Actions.Resume:
-                    self.process_resume_action(hosts)
-                elif action == Actions.ResumeFailed:
-                    del_msg = self.process_resume_failed_action(
-                        hosts, msg[0]['retry_count'])
-                elif action == Actions.WaitForResume:
-                    del_msg = self.process_wait_for_resume_action(
-                        hosts, msg[0]['retry_count'])
-                else:
-                    logger.error('unknown action {} for hosts {}'.format(
-                        action, ', '.join(hosts)))
-                if del_msg:
-                    self.ssh.delete_queue_action_msg(msg_id, pop_receipt)
-                else:
-                    self.ssh.update_queue_action_msg(msg_id, pop_receipt)
+                continue
+            # release messages that cannot be started well within their
+            # visibility timeout back to the queue
+            deadline = time.monotonic() + (
+                self._service_proxy.resume_timeout / 2)
+            for wave in group_action_msgs(msgs):
+                if time.monotonic() > deadline:
+                    for group in wave:
+                        for msg in group:
+                            self.ssh.update_queue_action_msg(
+                                msg[1], msg[2], visibility_timeout=0)
+                    continue
+                # groups within a wave do not share hosts
+                with concurrent.futures.ThreadPoolExecutor(
+                        max_workers=max_workers_for_executor(
+                            wave)) as executor:
+                    futures = [
+                        executor.submit(self.process_action_msgs, group)
+                        for group in wave
+                    ]
+                for group, future in zip(wave, futures):
+                    try:
+                        future.result()
+                    except Exception:
+                        # messages become visible again on expiry of
+                        # their visibility timeout
+                        logger.exception(
+                            'could not process action {} for {} '
+                            'messages'.format(
+                                group[0][0]['action'], len(group)))
 
     def execute(
             self,